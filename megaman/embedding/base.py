@@ -35,15 +35,19 @@ class BaseEmbedding(BaseEstimator, TransformerMixin):
         specification of geometry parameters: keys are
         ["adjacency_method", "adjacency_kwds", "affinity_method",
          "affinity_kwds", "laplacian_method", "laplacian_kwds"]
+    dtype : numpy float dtype (optional)
+        precision of the geometry computations, overriding the dtype of
+        `geom` (see megaman.geometry.Geometry).
 
     Attributes
     ----------
     geom_ : a fitted megaman.geometry.Geometry object.
     """
-    def __init__(self, n_components=2, radius=None, geom=None):
+    def __init__(self, n_components=2, radius=None, geom=None, dtype=None):
         self.n_components = n_components
         self.radius = radius
         self.geom = geom
+        self.dtype = dtype
 
     def _validate_input(self, X, input_type):
         if input_type == 'data':
@@ -101,6 +105,9 @@ class BaseEmbedding(BaseEstimator, TransformerMixin):
         if self.radius is not None:
             self.geom_.set_radius(self.radius, override=False)
 
+        if self.dtype is not None:
+            self.geom_.dtype = np.dtype(self.dtype)
+
         # if self.radius == 'auto':
         #     if X is not None and input_type != 'affinity':
         #         self.geom_.set_radius(self.estimate_radius(X, input_type),
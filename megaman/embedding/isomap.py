@@ -99,7 +99,8 @@ def isomap(geom, n_components=8, eigen_solver='auto',
                                                  largest=True,
                                                  eigen_solver=eigen_solver,
                                                  random_state=random_state,
-                                                 solver_kwds=solver_kwds)
+                                                 solver_kwds=solver_kwds,
+                                                 dtype=geom.dtype)
     # Step 5:
     # return Y = [sqrt(lambda_1)*V_1, ..., sqrt(lambda_d)*V_d]
     ind = np.argsort(lambdas); ind = ind[::-1] # sort largest
@@ -151,6 +152,9 @@ class Isomap(BaseEmbedding):
         One of ['auto', 'D', 'FW', 'BF', 'J'].
         See `scipy.sparse.csgraph.shortest_path` for more information.
     solver_kwds : any additional keyword arguments to pass to the selected eigen_solver
+    dtype : numpy float dtype (optional)
+        precision of the geometry computations, overriding the dtype of
+        `geom` (see megaman.geometry.Geometry).
 
     Attributes
     ----------
@@ -165,10 +169,11 @@ class Isomap(BaseEmbedding):
     """
     def __init__(self, n_components=2, radius=None, geom=None,
                  eigen_solver='auto', random_state=None,
-                 path_method='auto', solver_kwds=None):
+                 path_method='auto', solver_kwds=None, dtype=None):
         self.n_components = n_components
         self.radius = radius
         self.geom = geom
+        self.dtype = dtype
         self.eigen_solver = eigen_solver
         self.random_state = random_state
         self.path_method = path_method
@@ -124,7 +124,7 @@ def locally_linear_embedding(geom, n_components, reg=1e-3,
         M = (W.T * W - W.T - W).toarray()
         M.flat[::M.shape[0] + 1] += 1  # W = W - I = W - I
     return null_space(M, n_components, k_skip=1, eigen_solver=eigen_solver,
-                      random_state=random_state)
+                      random_state=random_state, dtype=geom.dtype)
 
 
 class LocallyLinearEmbedding(BaseEmbedding):
@@ -169,6 +169,9 @@ class LocallyLinearEmbedding(BaseEmbedding):
         regularization constant, multiplies the trace of the local covariance
         matrix of the distances.
     solver_kwds : any additional keyword arguments to pass to the selected eigen_solver
+    dtype : numpy float dtype (optional)
+        precision of the geometry computations, overriding the dtype of
+        `geom` (see megaman.geometry.Geometry).
 
     References
     ----------
@@ -177,10 +180,11 @@ class LocallyLinearEmbedding(BaseEmbedding):
     """
     def __init__(self, n_components=2, radius=None, geom=None,
                  eigen_solver='auto', random_state=None,
-                 reg=1e3,solver_kwds=None):
+                 reg=1e3,solver_kwds=None, dtype=None):
         self.n_components = n_components
         self.radius = radius
         self.geom = geom
+        self.dtype = dtype
         self.eigen_solver = eigen_solver
         self.random_state = random_state
         self.reg = reg
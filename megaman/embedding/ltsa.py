@@ -107,7 +107,8 @@ def ltsa(geom, n_components, eigen_solver='auto',
             M[nbrs_x, nbrs_y] -= GiGiT
             M[neighbors_i, neighbors_i] += 1
     return null_space(M, n_components, k_skip=1, eigen_solver=eigen_solver,
-                      random_state=random_state,solver_kwds=solver_kwds)
+                      random_state=random_state,solver_kwds=solver_kwds,
+                      dtype=geom.dtype)
 
 
 class LTSA(BaseEmbedding):
@@ -148,6 +149,9 @@ class LTSA(BaseEmbedding):
         The generator or seed used to determine the starting vector for arpack
         iterations.  Defaults to numpy.random.RandomState
     solver_kwds : any additional keyword arguments to pass to the selected eigen_solver
+    dtype : numpy float dtype (optional)
+        precision of the geometry computations, overriding the dtype of
+        `geom` (see megaman.geometry.Geometry).
 
     References
     ----------
@@ -157,10 +161,11 @@ class LTSA(BaseEmbedding):
     """
     def __init__(self, n_components=2, radius=None, geom=None,
                  eigen_solver='auto', random_state=None,
-                 tol=1e-6, max_iter=100, solver_kwds=None):
+                 tol=1e-6, max_iter=100, solver_kwds=None, dtype=None):
         self.n_components = n_components
         self.radius = radius
         self.geom = geom
+        self.dtype = dtype
         self.eigen_solver = eigen_solver
         self.random_state = random_state
         self.solver_kwds = solver_kwds
@@ -101,7 +101,8 @@ def compute_diffusion_maps(lapl_type, diffusion_map, lambdas, diffusion_time):
 
 def spectral_embedding(geom, n_components=8, eigen_solver='auto',
                        random_state=None, drop_first=True,
-                       diffusion_maps = False, diffusion_time = 0, solver_kwds = None):
+                       diffusion_maps = False, diffusion_time = 0, solver_kwds = None,
+                       matrix_free = False):
     """
     Project the sample on the first eigen vectors of the graph Laplacian.
 
@@ -172,6 +173,11 @@ def spectral_embedding(geom, n_components=8, eigen_solver='auto',
         region is low (within a certain time t).
         Credit to Satrajit Ghosh (http://satra.cogitatum.org/) for description
     solver_kwds : any additional keyword arguments to pass to the selected eigen_solver
+    matrix_free : bool, optional, default=False
+        Whether to solve the eigenproblem on a matrix-free Laplacian operator
+        (see Geometry.compute_laplacian_operator), which only stores the
+        affinity matrix and O(N) vectors, instead of the Laplacian matrix and
+        its symmetrized copies. Not available with the 'amg' eigen_solver.
 
     Returns
     -------
@@ -201,23 +207,36 @@ def spectral_embedding(geom, n_components=8, eigen_solver='auto',
         warnings.warn("Graph is not fully connected: "
                       "spectral embedding may not work as expected.")
 
-    if geom.laplacian_matrix is None:
+    if matrix_free:
+        laplacian = None
+    elif geom.laplacian_matrix is None:
         laplacian = geom.compute_laplacian_matrix(copy=False,
                                                   return_lapsym=True)
     else:
         laplacian = geom.laplacian_matrix
 
-    n_nodes = laplacian.shape[0]
+    n_nodes = geom.affinity_matrix.shape[0]
     lapl_type = geom.laplacian_method
     eigen_solver, solver_kwds = check_eigen_solver(eigen_solver,solver_kwds,
-                                                   size=laplacian.shape[0],
+                                                   size=n_nodes,
                                                    nvec=n_components + 1)
+    if matrix_free and eigen_solver == 'amg':
+        raise ValueError("the 'amg' eigen_solver requires the Laplacian "
+                         "matrix: use matrix_free=False")
     re_normalize = False
     PD_solver = False
     if eigen_solver in ['amg', 'lobpcg']: # these methods require a symmetric positive definite matrix!
         epsilon = 2
         PD_solver = True
-        if lapl_type not in ['symmetricnormalized', 'unnormalized']:
+        if matrix_free:
+            # the operator of (1+epsilon)*I - L*, with L* the laplacian for
+            # symmetric laplacians and W^{-1/2}SW^{-1/2} otherwise (see below)
+            symmetrized_laplacian = geom.compute_laplacian_operator(
+                symmetrized=True, shift=1 + epsilon)
+            if lapl_type not in ['symmetricnormalized', 'unnormalized']:
+                re_normalize = True
+                w = symmetrized_laplacian.weights
+        elif lapl_type not in ['symmetricnormalized', 'unnormalized']:
             re_normalize = True
             # If lobpcg (or amg with lobpcg) is chosen and
             # If the Laplacian is non-symmetric then we need to extract:
@@ -243,7 +262,7 @@ def spectral_embedding(geom, n_components=8, eigen_solver='auto',
             if sparse.isspmatrix(symmetrized_laplacian):
                 symmetrized_laplacian.data /= np.sqrt(w[symmetrized_laplacian.row])
                 symmetrized_laplacian.data /= np.sqrt(w[symmetrized_laplacian.col])
-                symmetrized_laplacian = (1+epsilon)*sparse.identity(n_nodes) - symmetrized_laplacian
+                symmetrized_laplacian = (1+epsilon)*sparse.identity(n_nodes, dtype=geom.dtype) - symmetrized_laplacian
             else:
                 symmetrized_laplacian /= np.sqrt(w)
                 symmetrized_laplacian /= np.sqrt(w[:,np.newaxis])
@@ -251,19 +270,21 @@ def spectral_embedding(geom, n_components=8, eigen_solver='auto',
         else: # using a symmetric laplacian but adjust to avoid positive definite errors
             symmetrized_laplacian = geom.laplacian_matrix.copy()
             if sparse.isspmatrix(symmetrized_laplacian):
-                symmetrized_laplacian = (1+epsilon)*sparse.identity(n_nodes) - symmetrized_laplacian
+                symmetrized_laplacian = (1+epsilon)*sparse.identity(n_nodes, dtype=geom.dtype) - symmetrized_laplacian
             else:
                 symmetrixed_laplacian = (1+epsilon)*np.identity(n_nodes) - symmetrized_laplacian
 
     if PD_solver: # then eI - L was used, fix the eigenvalues
         lambdas, diffusion_map = eigen_decomposition(symmetrized_laplacian, n_components+1, eigen_solver=eigen_solver,
                                                      random_state=random_state, drop_first=drop_first, largest = False,
-                                                     solver_kwds=solver_kwds)
+                                                     solver_kwds=solver_kwds, dtype=geom.dtype)
         lambdas = -lambdas + epsilon
     else:
+        if matrix_free:
+            laplacian = geom.compute_laplacian_operator()
         lambdas, diffusion_map = eigen_decomposition(laplacian, n_components+1, eigen_solver=eigen_solver,
                                                      random_state=random_state, drop_first=drop_first, largest = True,
-                                                     solver_kwds=solver_kwds)
+                                                     solver_kwds=solver_kwds, dtype=geom.dtype)
     if re_normalize:
         diffusion_map /= np.sqrt(w[:, np.newaxis]) # put back on original Laplacian space
         diffusion_map /= np.linalg.norm(diffusion_map, axis = 0) # norm 1 vectors
@@ -337,6 +358,12 @@ class SpectralEmbedding(BaseEmbedding):
     diffusion_map : boolean, optional. Whether to return the diffusion map
         version by re-scaling the embedding by the eigenvalues.
     solver_kwds : any additional keyword arguments to pass to the selected eigen_solver
+    dtype : numpy float dtype (optional)
+        precision of the geometry computations, overriding the dtype of
+        `geom` (see megaman.geometry.Geometry).
+    matrix_free : bool, optional, default=False
+        Whether to solve the eigenproblem on a matrix-free Laplacian operator
+        instead of the Laplacian matrix (see spectral_embedding).
 
     References
     ----------
@@ -354,16 +381,19 @@ class SpectralEmbedding(BaseEmbedding):
     """
     def __init__(self, n_components=2, radius=None, geom=None,
                  eigen_solver='auto', random_state=None,
-                 drop_first=True, diffusion_maps=False, diffusion_time=0,solver_kwds=None):
+                 drop_first=True, diffusion_maps=False, diffusion_time=0,solver_kwds=None,
+                 dtype=None, matrix_free=False):
         self.n_components = n_components
         self.radius = radius
         self.geom = geom
+        self.dtype = dtype
         self.eigen_solver = eigen_solver
         self.random_state = random_state
         self.drop_first = drop_first
         self.diffusion_maps = diffusion_maps
         self.diffusion_time = diffusion_time
         self.solver_kwds = solver_kwds
+        self.matrix_free = matrix_free
 
     def fit(self, X, y=None, input_type='data'):
         """
@@ -398,7 +428,8 @@ class SpectralEmbedding(BaseEmbedding):
                                              drop_first = self.drop_first,
                                              diffusion_maps = self.diffusion_maps,
                                              diffusion_time = self.diffusion_time,
-                                             solver_kwds = self.solver_kwds)
+                                             solver_kwds = self.solver_kwds,
+                                             matrix_free = self.matrix_free)
         self.affinity_matrix_ = self.geom_.affinity_matrix
         self.laplacian_matrix_ = self.geom_.laplacian_matrix
         self.laplacian_matrix_type_ = self.geom_.laplacian_method
@@ -416,7 +447,9 @@ class SpectralEmbedding(BaseEmbedding):
             raise RuntimeError('the .fit() function must be called before the .predict() function')
         if self.geom_.X is None:
             raise NotImplementedError('method only implemented when X passed as data')
-        # Complete the adjacency matrix
+        # Complete the adjacency matrix (not stored by fused affinities)
+        if self.geom_.adjacency_matrix is None:
+            self.geom_.compute_adjacency_matrix()
         adjacency_kwds = self.geom_.adjacency_kwds
         if self.geom_.adjacency_method == 'cyflann':
             if 'cyflann_kwds' in adjacency_kwds.keys():
@@ -425,12 +458,12 @@ class SpectralEmbedding(BaseEmbedding):
                 cyflann_kwds = {}
         total_adjacency_matrix = complete_adjacency_matrix(self.geom_.adjacency_matrix, 
                                                            self.geom_.X,
-                                                           X_test,adjacency_kwds)
+                                                           X_test,adjacency_kwds,
+                                                           flann_index=self.geom_.flann_index)
         # Compute the affinity matrix, check method and kwds
+        affinity_kwds = {'dtype': self.geom_.dtype}
         if self.geom_.affinity_kwds is not None:
-            affinity_kwds = self.geom_.affinity_kwds
-        else:
-            affinity_kwds = {}
+            affinity_kwds.update(self.geom_.affinity_kwds)
         if self.geom_.affinity_method is not None:
             affinity_method = self.geom_.affinity_method
         else:
@@ -438,10 +471,9 @@ class SpectralEmbedding(BaseEmbedding):
         total_affinity_matrix = compute_affinity_matrix(total_adjacency_matrix, affinity_method,
                                                        **affinity_kwds)
         # Compute the affinity matrix, check method and kwds
+        laplacian_kwds = {'dtype': self.geom_.dtype}
         if self.geom_.laplacian_kwds is not None:
-            laplacian_kwds = self.geom_.laplacian_kwds
-        else:
-            laplacian_kwds = {}
+            laplacian_kwds.update(self.geom_.laplacian_kwds)
         if self.geom_.laplacian_method is not None:
             laplacian_method = self.geom_.laplacian_method
         else:
@@ -53,3 +53,21 @@ def test_embeddings_bad_arguments():
 
     for Embedding in EMBEDDINGS:
         yield check_bad_args, Embedding
+
+
+def test_embeddings_dtype():
+    rand = np.random.RandomState(42)
+    X = rand.rand(100, 5)
+
+    def check_dtype(Embedding, dtype):
+        geom = Geometry(adjacency_kwds = {'radius':1.0},
+                        affinity_kwds = {'radius':1.0})
+        model = Embedding(n_components=2, geom=geom, random_state=rand,
+                          dtype=dtype)
+        model.fit(X)
+        # the eigensolver runs in the requested precision
+        assert model.embedding_.dtype == dtype
+
+    for Embedding in EMBEDDINGS:
+        for dtype in [np.float32, np.float64]:
+            yield check_dtype, Embedding, dtype
@@ -274,3 +274,41 @@ def test_predict_error_no_data(seed=36):
     embed = se.fit_transform(A, input_type = 'affinity')
     msg = 'method only implemented when X passed as data'
     assert_raise_message(NotImplementedError, msg, se.predict, S_test)
+
+
+def test_spectral_embedding_float32(seed=36):
+    """Test spectral embedding computed in single precision"""
+    radius = 4.0
+    geom_params = {'affinity_kwds':{'radius':radius},
+                   'adjacency_kwds':{'radius':radius},
+                   'adjacency_method':'brute'}
+    embeddings = {}
+    for dtype in [np.float64, np.float32]:
+        se = SpectralEmbedding(n_components=2, eigen_solver='arpack',
+                               random_state=np.random.RandomState(seed),
+                               geom=geom_params, dtype=dtype)
+        embeddings[dtype] = se.fit_transform(S)
+        assert_equal(se.affinity_matrix_.dtype, dtype)
+        assert_equal(embeddings[dtype].dtype, dtype)
+    assert_true(_check_with_col_sign_flipping(embeddings[np.float32],
+                                              embeddings[np.float64], 0.05))
+
+
+def test_spectral_embedding_matrix_free(seed=36):
+    """Test spectral embedding on the matrix-free Laplacian operator"""
+    radius = 4.0
+    geom_params = {'affinity_kwds':{'radius':radius},
+                   'adjacency_kwds':{'radius':radius},
+                   'adjacency_method':'brute'}
+    for laplacian_method in ['geometric', 'symmetricnormalized']:
+        for eigen_solver in ['arpack', 'lobpcg']:
+            params = dict(geom_params, laplacian_method=laplacian_method)
+            embeddings = []
+            for matrix_free in [False, True]:
+                se = SpectralEmbedding(n_components=2,
+                                       eigen_solver=eigen_solver,
+                                       random_state=np.random.RandomState(seed),
+                                       geom=params, matrix_free=matrix_free)
+                embeddings.append(se.fit_transform(S))
+            assert_true(_check_with_col_sign_flipping(embeddings[0],
+                                                      embeddings[1], 0.05))
@@ -5,3 +5,6 @@ from .geometry import Geometry
 from .adjacency import Adjacency, compute_adjacency_matrix, adjacency_methods
 from .affinity import Affinity, compute_affinity_matrix, affinity_methods
 from .laplacian import Laplacian, compute_laplacian_matrix, laplacian_methods
+from .out_of_core import compute_adjacency_shards, load_adjacency_shards
+from .radius_family import RadiusFamily
+from .utils import set_n_threads, get_n_threads
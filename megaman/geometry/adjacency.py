@@ -1,11 +1,23 @@
 # LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
 
+import inspect
+import multiprocessing
+
 import numpy as np
 from sklearn import neighbors
 from scipy import sparse
+from scipy.spatial import cKDTree
+
+from .hnsw.index import Index as HnswIndex
+from .utils import (RegisterSubclasses, flag_symmetric, scaled_exp,
+                    set_n_threads)
+from ..utils.validation import check_random_state
 
-from .cyflann.index import Index as CyIndex
-from .utils import RegisterSubclasses
+try:
+    from .cyflann.index import Index as CyIndex
+    CYFLANN_LOADED = True
+except ImportError:
+    CYFLANN_LOADED = False
 
 try:
     import pyflann as pyf
@@ -16,12 +28,35 @@ except ImportError:
 
 def compute_adjacency_matrix(X, method='auto', **kwargs):
     """Compute an adjacency matrix with the given method"""
+    method = resolve_adjacency_method(X, method,
+                                      radius=kwargs.get('radius'),
+                                      n_neighbors=kwargs.get('n_neighbors'),
+                                      max_neighbors=kwargs.get('max_neighbors'),
+                                      keywords=kwargs)
+    # no copy for float64 inputs, e.g. memory-mapped arrays
+    X = X.astype('float', copy=False)
+    return Adjacency.init(method, **kwargs).adjacency_graph(X)
+
+
+def resolve_adjacency_method(X, method='auto', radius=None, n_neighbors=None,
+                             max_neighbors=None, methods=None, keywords=None):
+    """Return the adjacency method to use for X, resolving method='auto'
+
+    The 'auto' method is the available method with the lowest estimated
+    cost for the size, dimension and sparsity of X and the expected number
+    of neighbors per point, among ``methods`` (default: all) accepting the
+    keyword arguments named in ``keywords``, see
+    cost_model.select_adjacency_method.
+    """
     if method == 'auto':
-        if X.shape[0] > 10000:
-            method = 'cyflann'
-        else:
-            method = 'kd_tree'
-    return Adjacency.init(method, **kwargs).adjacency_graph(X.astype('float'))
+        # imported here because the cost model depends on this module
+        from .cost_model import select_adjacency_method
+        method = select_adjacency_method(X, radius=radius,
+                                         n_neighbors=n_neighbors,
+                                         max_neighbors=max_neighbors,
+                                         methods=methods,
+                                         keywords=keywords)['method']
+    return method
 
 
 def adjacency_methods():
@@ -29,23 +64,256 @@ def adjacency_methods():
     return ['auto'] + list(Adjacency.methods())
 
 
+def index_query_methods():
+    """Return the adjacency methods which query a prebuilt index
+
+    These methods implement build_index and query_adjacency, and so support
+    n_processes and out-of-core computations (iter_adjacency_blocks).
+    """
+    return [method for method in Adjacency.methods()
+            if Adjacency.get_method(method).build_index
+            is not Adjacency.build_index]
+
+
+def method_keywords(method):
+    """Return the names of the keyword arguments of an adjacency method"""
+    init = Adjacency.get_method(method).__init__
+    try:
+        parameters = inspect.signature(init).parameters
+    except AttributeError:
+        # Python 2
+        return inspect.getargspec(init).args[1:]
+    return [name for name in parameters if name != 'self']
+
+
+def _symmetric_pairs_graph(i, j, data, n_samples):
+    """Build the symmetric CSR graph of the pairs (i, j), i < j
+
+    Each pair is stored in both directions, the diagonal holds explicit
+    zeros, and the result is flagged as symmetric.
+    """
+    diag = np.arange(n_samples)
+    rows = np.concatenate([i, j, diag])
+    cols = np.concatenate([j, i, diag])
+    data = np.concatenate([data, data, np.zeros(n_samples, dtype=data.dtype)])
+    order = np.lexsort((cols, rows))
+    indptr = np.zeros(n_samples + 1, dtype=np.intp)
+    np.cumsum(np.bincount(rows, minlength=n_samples), out=indptr[1:])
+    G = sparse.csr_matrix((data[order], cols[order], indptr),
+                          shape=(n_samples, n_samples))
+    return flag_symmetric(G)
+
+
+def _knn_within_radius_graph(dist, ind, radius, n_cols):
+    """Build the CSR graph of the kNN results (dist, ind) within the radius
+
+    dist and ind are the (N_queries, k) distances and indices of the nearest
+    neighbors of each query. Neighbors farther than the radius, or missing
+    (with an infinite distance), are dropped.
+    """
+    n_queries = dist.shape[0]
+    within = dist <= radius
+    indptr = np.zeros(n_queries + 1, dtype=np.intp)
+    np.cumsum(within.sum(1), out=indptr[1:])
+    return sparse.csr_matrix((dist[within], ind[within], indptr),
+                             shape=(n_queries, n_cols))
+
+
+def _cap_row_neighbors(G, max_neighbors):
+    """Keep the max_neighbors smallest stored entries of each row of G"""
+    G = G.tocsr()
+    n_rows = G.shape[0]
+    rows = np.repeat(np.arange(n_rows), np.diff(G.indptr))
+    order = np.lexsort((G.data, rows))
+    # rank of each entry within its row, in order of increasing distance
+    rank = np.arange(G.nnz) - np.repeat(G.indptr[:-1], np.diff(G.indptr))
+    keep = order[rank < max_neighbors]
+    keep.sort()
+    indptr = np.zeros(n_rows + 1, dtype=np.intp)
+    np.cumsum(np.bincount(rows[keep], minlength=n_rows), out=indptr[1:])
+    return sparse.csr_matrix((G.data[keep], G.indices[keep], indptr),
+                             shape=G.shape)
+
+
+def _csr_index_dtype(maxval):
+    """Index dtype scipy uses for CSR arrays, so that it does not convert"""
+    if maxval < np.iinfo(np.int32).max:
+        return np.int32
+    else:
+        return np.int64
+
+
+def _stack_csr_rows(blocks, n_cols):
+    """Stack CSR row blocks into one CSR matrix, copying each block once"""
+    n_rows = sum(G.shape[0] for G in blocks)
+    nnz = sum(G.nnz for G in blocks)
+    idx_dtype = _csr_index_dtype(max(nnz, n_rows, n_cols))
+    data = np.empty(nnz, dtype=blocks[0].data.dtype)
+    indices = np.empty(nnz, dtype=idx_dtype)
+    indptr = np.empty(n_rows + 1, dtype=idx_dtype)
+    indptr[0] = 0
+    row = nnz = 0
+    while blocks:
+        G = blocks.pop(0)
+        data[nnz:nnz + G.nnz] = G.data
+        indices[nnz:nnz + G.nnz] = G.indices
+        indptr[row + 1:row + G.shape[0] + 1] = nnz + G.indptr[1:]
+        row += G.shape[0]
+        nnz += G.nnz
+    return sparse.csr_matrix((data, indices, indptr), shape=(n_rows, n_cols))
+
+
+# state shared with the forked worker processes of _parallel_adjacency_graph
+_PARALLEL_STATE = {}
+
+
+def _init_worker():
+    # OpenMP (libgomp) is not fork-safe: a multi-threaded parallel region
+    # entered in a child forked after the parent started its OpenMP threads
+    # deadlocks. The workers run every threaded search and kernel on a
+    # single thread; the processes provide the parallelism.
+    adjacency = _PARALLEL_STATE['args'][0]
+    if hasattr(adjacency, 'n_jobs'):
+        adjacency.n_jobs = 1
+    set_n_threads(1)
+
+
+def _query_rows(rows):
+    adjacency, index, X = _PARALLEL_STATE['args']
+    return adjacency.query_adjacency(index, X[rows[0]:rows[1]]).tocsr()
+
+
+def _fork_pool(n_processes):
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork').Pool(n_processes,
+                                                        _init_worker)
+    # Python 2 always forks the pool workers on POSIX
+    return multiprocessing.Pool(n_processes, _init_worker)
+
+
+def _parallel_adjacency_graph(adjacency, X):
+    """Compute the adjacency graph of X on a pool of processes
+
+    The index is built once in the parent process. The worker processes are
+    forked afterwards, so they share the index and the data with the parent
+    (copy-on-write) instead of receiving copies of them; each worker queries
+    blocks of rows on a single thread and returns the corresponding CSR rows.
+    """
+    n_samples = X.shape[0]
+    n_processes = adjacency.n_processes
+    if n_processes < 0:
+        n_processes = max(1, multiprocessing.cpu_count() + 1 + n_processes)
+    n_blocks = min(n_samples, 4 * n_processes)
+    bounds = np.linspace(0, n_samples, n_blocks + 1).astype(int)
+
+    index = adjacency.build_index(X)
+    _PARALLEL_STATE['args'] = (adjacency, index, X)
+    try:
+        pool = _fork_pool(n_processes)
+        try:
+            blocks = pool.map(_query_rows, list(zip(bounds[:-1], bounds[1:])))
+        finally:
+            pool.terminate()
+    finally:
+        _PARALLEL_STATE.clear()
+    return _stack_csr_rows(blocks, blocks[0].shape[1])
+
+
+ADJACENCY_MODES = ['distance', 'connectivity', 'squared_distance', 'gaussian']
+
+
 class Adjacency(RegisterSubclasses):
-    """Base class for computing adjacency matrices"""
-    def __init__(self, radius=None, n_neighbors=None, mode='distance'):
+    """Base class for computing adjacency matrices
+
+    The entries of the graph are given by ``mode``: the distances, ones
+    ('connectivity'), the squared distances, or the gaussian affinities
+    exp(-d^2 / affinity_radius^2) ('gaussian'). The squared distance and
+    gaussian modes are computed from the squared distances of the search
+    when the method has them, without taking their square roots, and
+    transform the data of the graph in place: the gaussian graph is the
+    unsymmetrized affinity matrix (see GaussianAffinity).
+
+    Methods implementing build_index and query_adjacency can split the
+    queries across ``n_processes`` processes (-1 means one per core), and
+    compute the graph one block of rows at a time (iter_adjacency_blocks).
+
+    Radius graphs can be capped with ``max_neighbors``: each row then holds
+    the neighbors within the radius, up to the ``max_neighbors`` nearest
+    (including the point itself). This bounds the size of the graph when
+    the density of the data is uneven. The capped graph is not symmetric.
+    """
+    def __init__(self, radius=None, n_neighbors=None, mode='distance',
+                 n_processes=1, max_neighbors=None, affinity_radius=None):
         self.radius = radius
         self.n_neighbors = n_neighbors
         self.mode = mode
+        self.n_processes = n_processes
+        self.max_neighbors = max_neighbors
+        self.affinity_radius = affinity_radius
 
         if (radius is None) == (n_neighbors is None):
            raise ValueError("Must specify either radius or n_neighbors, "
                             "but not both.")
+        if n_processes == 0:
+            raise ValueError("n_processes must be nonzero")
+        if max_neighbors is not None:
+            if radius is None:
+                raise ValueError("max_neighbors caps the rows of radius "
+                                 "graphs: radius must be specified")
+            if max_neighbors < 1:
+                raise ValueError("max_neighbors must be positive")
+        if mode not in ADJACENCY_MODES:
+            raise ValueError("mode={0} not valid. Must be one of "
+                             "{1}".format(mode, ADJACENCY_MODES))
+        if mode == 'gaussian' and affinity_radius is None:
+            raise ValueError("mode='gaussian' requires an affinity_radius")
+
+    def _output_data(self, data, squared=False):
+        """Convert distances to the entries of self.mode, in place
+
+        data holds the distances, or the squared distances if squared is
+        True. Returns the converted array.
+        """
+        if self.mode == 'connectivity':
+            return np.ones_like(data)
+        elif self.mode == 'distance':
+            return np.sqrt(data, out=data) if squared else data
+        if self.mode == 'gaussian':
+            return scaled_exp(data, -self.affinity_radius ** 2,
+                              square=not squared)
+        if not squared:
+            data **= 2
+        return data
 
     def adjacency_graph(self, X):
+        if self.n_processes != 1:
+            return _parallel_adjacency_graph(self, X)
         if self.n_neighbors is not None:
             return self.knn_adjacency(X)
         elif self.radius is not None:
             return self.radius_adjacency(X)
 
+    def build_index(self, X):
+        """Return a neighbor index over X, used by query_adjacency"""
+        raise NotImplementedError()
+
+    def query_adjacency(self, index, queries):
+        """Return the rows of the adjacency graph for the query points"""
+        raise NotImplementedError()
+
+    def iter_adjacency_blocks(self, X, block_size):
+        """Yield (start, stop, rows start:stop of the adjacency graph)
+
+        The index is built on X, then X is queried one block of rows at a
+        time, so that only one block of queries and of graph rows is in
+        memory at once (besides the index).
+        """
+        index = self.build_index(X)
+        n_samples = X.shape[0]
+        for start in range(0, n_samples, block_size):
+            stop = min(start + block_size, n_samples)
+            yield start, stop, self.query_adjacency(index, X[start:stop])
+
     def knn_adjacency(self, X):
         raise NotImplementedError()
 
@@ -56,17 +324,43 @@ class Adjacency(RegisterSubclasses):
 class BruteForceAdjacency(Adjacency):
     name = 'brute'
 
+    def build_index(self, X):
+        return neighbors.NearestNeighbors(algorithm=self.name).fit(X)
+
+    def _sklearn_graph(self, G):
+        # sklearn computes distance or connectivity graphs
+        if self.mode != 'connectivity':
+            G.data = self._output_data(G.data)
+        return G
+
+    def _capped_radius_graph(self, model, queries):
+        # a single kNN search, cut off at the radius
+        n_samples = model.n_samples_fit_
+        dist, ind = model.kneighbors(queries, n_neighbors=min(
+            self.max_neighbors, n_samples))
+        G = _knn_within_radius_graph(dist, ind, self.radius, n_samples)
+        G.data = self._output_data(G.data)
+        return G
+
+    def query_adjacency(self, model, queries):
+        mode = 'connectivity' if self.mode == 'connectivity' else 'distance'
+        if self.n_neighbors is not None:
+            G = model.kneighbors_graph(queries, n_neighbors=self.n_neighbors,
+                                       mode=mode)
+        elif self.max_neighbors is not None:
+            return self._capped_radius_graph(model, queries)
+        else:
+            G = model.radius_neighbors_graph(queries, radius=self.radius,
+                                             mode=mode)
+        return self._sklearn_graph(G)
+
     def radius_adjacency(self, X):
-        model = neighbors.NearestNeighbors(algorithm=self.name).fit(X)
         # pass X so that diagonal will have explicit zeros
-        return model.radius_neighbors_graph(X, radius=self.radius,
-                                            mode=self.mode)
+        return self.query_adjacency(self.build_index(X), X)
 
     def knn_adjacency(self, X):
-        model = neighbors.NearestNeighbors(algorithm=self.name).fit(X)
         # pass X so that diagonal will have explicit zeros
-        return model.kneighbors_graph(X, n_neighbors=self.n_neighbors,
-                                      mode=self.mode)
+        return self.query_adjacency(self.build_index(X), X)
 
 
 class KDTreeAdjacency(BruteForceAdjacency):
@@ -77,65 +371,516 @@ class BallTreeAdjacency(BruteForceAdjacency):
     name = 'ball_tree'
 
 
+class BlockedBruteForceAdjacency(Adjacency):
+    """Exact brute-force adjacency computed in memory-bounded tiles
+
+    Pairwise squared distances are computed one (rows x columns) tile at a
+    time using ||x||^2 - 2 x.y + ||y||^2, so that the dense working set never
+    exceeds ``memory_budget`` megabytes. Only the entries within the radius
+    (or the k nearest entries) of each tile are retained, and the sparse
+    graph is assembled block of rows by block of rows. Radius graphs only
+    compute the tiles on and above the diagonal and are mirrored from the
+    pairs i < j, giving an exactly symmetric graph. Radius graphs capped at
+    max_neighbors are computed as kNN graphs cut off at the radius.
+    """
+    name = 'blocked_brute'
+
+    def __init__(self, radius=None, n_neighbors=None, mode='distance',
+                 memory_budget=256, max_neighbors=None, affinity_radius=None):
+        if memory_budget <= 0:
+            raise ValueError("memory_budget must be positive")
+        self.memory_budget = memory_budget
+        super(BlockedBruteForceAdjacency, self).__init__(
+            radius=radius, n_neighbors=n_neighbors, mode=mode,
+            max_neighbors=max_neighbors, affinity_radius=affinity_radius)
+
+    def _tile_shape(self, n_samples):
+        # about three float64 temporaries of the tile size are alive at once
+        n_elements = max(1, int(self.memory_budget * 2 ** 20) // (3 * 8))
+        n_cols = min(n_samples, n_elements)
+        n_rows = min(n_samples, max(1, n_elements // n_cols))
+        return n_rows, n_cols
+
+    @staticmethod
+    def _squared_norms(X):
+        if sparse.issparse(X):
+            return np.asarray(X.multiply(X).sum(1)).ravel()
+        else:
+            return np.einsum('ij,ij->i', X, X)
+
+    def _iter_tiles(self, X, upper=False):
+        """Yield (row_slice, col_slice, squared distance tile)
+
+        If upper is True, tiles lying entirely below the diagonal are skipped.
+        """
+        if sparse.issparse(X):
+            X = X.tocsr()
+        n_samples = X.shape[0]
+        n_rows, n_cols = self._tile_shape(n_samples)
+        sqnorms = self._squared_norms(X)
+
+        for row_start in range(0, n_samples, n_rows):
+            rows = slice(row_start, min(row_start + n_rows, n_samples))
+            first_col = row_start if upper else 0
+            for col_start in range(first_col, n_samples, n_cols):
+                cols = slice(col_start, min(col_start + n_cols, n_samples))
+                D2 = X[rows].dot(X[cols].T)
+                if sparse.issparse(D2):
+                    D2 = D2.toarray()
+                D2 *= -2
+                D2 += sqnorms[rows, np.newaxis]
+                D2 += sqnorms[np.newaxis, cols]
+                np.maximum(D2, 0, out=D2)
+
+                # diagonal entries should be exactly zero
+                diag_start = max(rows.start, cols.start)
+                diag_stop = min(rows.stop, cols.stop)
+                if diag_start < diag_stop:
+                    diag = np.arange(diag_start, diag_stop)
+                    D2[diag - rows.start, diag - cols.start] = 0
+                yield rows, cols, D2
+
+    def radius_adjacency(self, X):
+        n_samples = X.shape[0]
+        if self.max_neighbors is not None:
+            D2, ind = self._nearest_neighbors(
+                X, min(self.max_neighbors, n_samples))
+            G = _knn_within_radius_graph(D2, ind, self.radius ** 2,
+                                         n_samples)
+            G.data = self._output_data(G.data, squared=True)
+            return G
+
+        # distances are symmetric, so only the pairs i < j are computed and
+        # the graph is mirrored from them
+        radius2 = self.radius ** 2
+
+        pairs_i, pairs_j, pairs_d = [], [], []
+        for rows, cols, D2 in self._iter_tiles(X, upper=True):
+            i, j = np.nonzero(D2 <= radius2)
+            i += rows.start
+            j += cols.start
+            keep = i < j
+            i, j = i[keep], j[keep]
+            pairs_d.append(D2[i - rows.start, j - cols.start])
+            pairs_i.append(i)
+            pairs_j.append(j)
+
+        G = _symmetric_pairs_graph(np.concatenate(pairs_i),
+                                   np.concatenate(pairs_j),
+                                   np.concatenate(pairs_d), n_samples)
+        # converted with the zeros of the diagonal
+        G.data = self._output_data(G.data, squared=True)
+        return G
+
+    def _nearest_neighbors(self, X, n_neighbors):
+        """Return the (N_obs, n_neighbors) squared distances and indices of
+        the nearest neighbors of each point, sorted by distance"""
+        indices = []
+        data = []
+        best_d = best_j = None
+        for rows, cols, D2 in self._iter_tiles(X):
+            j = np.broadcast_to(np.arange(cols.start, cols.stop), D2.shape)
+            if best_d is not None:
+                D2 = np.hstack([best_d, D2])
+                j = np.hstack([best_j, j])
+            if D2.shape[1] > n_neighbors:
+                keep = np.argpartition(D2, n_neighbors - 1,
+                                       axis=1)[:, :n_neighbors]
+                D2 = np.take_along_axis(D2, keep, axis=1)
+                j = np.take_along_axis(j, keep, axis=1)
+            best_d, best_j = D2, j
+
+            if cols.stop == X.shape[0]:
+                order = np.argsort(best_d, axis=1, kind='mergesort')
+                data.append(np.take_along_axis(best_d, order, axis=1))
+                indices.append(np.take_along_axis(best_j, order, axis=1))
+                best_d = best_j = None
+        return np.vstack(data), np.vstack(indices)
+
+    def knn_adjacency(self, X):
+        n_samples = X.shape[0]
+        n_neighbors = self.n_neighbors
+        if n_neighbors > n_samples:
+            raise ValueError("n_neighbors must be at most n_samples")
+
+        data, indices = self._nearest_neighbors(X, n_neighbors)
+        data = self._output_data(data.ravel(), squared=True)
+        indptr = n_neighbors * np.arange(n_samples + 1)
+        return sparse.csr_matrix((data, indices.ravel(), indptr),
+                                 shape=(n_samples, n_samples))
+
+
+def _ckdtree_threads_keyword():
+    """Return the keyword of cKDTree.query setting its number of threads"""
+    try:
+        cKDTree(np.zeros((1, 1))).query(np.zeros((1, 1)), workers=1)
+    except TypeError:
+        # scipy < 1.6
+        return 'n_jobs'
+    return 'workers'
+
+_CKDTREE_THREADS = _ckdtree_threads_keyword()
+
+
+class CKDTreeAdjacency(Adjacency):
+    """Exact adjacency using scipy's cKDTree
+
+    The radius graph is computed with a single self-join of the tree
+    (``query_pairs``), which returns every pair i < j within the radius once;
+    the graph is mirrored from these pairs, so it is symmetric by
+    construction and flagged as such. The squared distances of the pairs
+    are computed ``batch_size`` pairs at a time, so that the temporary
+    coordinate differences stay small. kNN queries, and radius queries
+    capped at max_neighbors (kNN queries bounded by the radius), are
+    distributed over ``n_jobs`` worker threads.
+    """
+    name = 'ckdtree'
+
+    def __init__(self, radius=None, n_neighbors=None, mode='distance',
+                 leafsize=16, n_jobs=-1, max_neighbors=None,
+                 affinity_radius=None, batch_size=65536):
+        self.leafsize = leafsize
+        self.n_jobs = n_jobs
+        self.batch_size = batch_size
+        super(CKDTreeAdjacency, self).__init__(radius=radius,
+                                               n_neighbors=n_neighbors,
+                                               mode=mode,
+                                               max_neighbors=max_neighbors,
+                                               affinity_radius=affinity_radius)
+
+    def _build_tree(self, X):
+        if sparse.issparse(X):
+            raise ValueError("method='ckdtree' does not support sparse input")
+        return cKDTree(X, leafsize=self.leafsize)
+
+    def _query_tree(self, tree, X, **kwargs):
+        kwargs[_CKDTREE_THREADS] = self.n_jobs
+        return tree.query(X, **kwargs)
+
+    def radius_adjacency(self, X):
+        tree = self._build_tree(X)
+        if self.max_neighbors is not None:
+            # the search bound is strict: nudge it to include the radius
+            bound = np.nextafter(self.radius, np.inf)
+            n_samples = X.shape[0]
+            dist, ind = self._query_tree(tree, X,
+                                         k=min(self.max_neighbors, n_samples),
+                                         distance_upper_bound=bound)
+            G = _knn_within_radius_graph(dist.reshape(n_samples, -1),
+                                         ind.reshape(n_samples, -1),
+                                         self.radius, n_samples)
+            G.data = self._output_data(G.data)
+            return G
+        # dual-tree self-join returning each pair i < j once
+        pairs = tree.query_pairs(self.radius, output_type='ndarray')
+        i, j = pairs[:, 0], pairs[:, 1]
+        D2 = np.empty(len(pairs), dtype=np.result_type(X.dtype, np.float32))
+        for start in range(0, len(pairs), self.batch_size):
+            stop = start + self.batch_size
+            diff = X[i[start:stop]] - X[j[start:stop]]
+            np.einsum('ij,ij->i', diff, diff, out=D2[start:stop])
+        G = _symmetric_pairs_graph(i, j, D2, X.shape[0])
+        G.data = self._output_data(G.data, squared=True)
+        return G
+
+    def knn_adjacency(self, X):
+        n_samples = X.shape[0]
+        if self.n_neighbors > n_samples:
+            raise ValueError("n_neighbors must be at most n_samples")
+        tree = self._build_tree(X)
+        dist, ind = self._query_tree(tree, X, k=self.n_neighbors)
+        data = self._output_data(dist.reshape(-1))
+        indptr = self.n_neighbors * np.arange(n_samples + 1)
+        return sparse.csr_matrix((data, ind.reshape(-1), indptr),
+                                 shape=(n_samples, n_samples))
+
+
 class CyFLANNAdjacency(Adjacency):
+    """Approximate adjacency using the cyflann wrapper of FLANN
+
+    The FLANN index is built on the first query and kept in
+    ``self.flann_index``. An index passed as ``flann_index`` (e.g. one loaded
+    from a file) is only built if it has not been built yet. Radius queries
+    capped at max_neighbors keep the nearest neighbors during the FLANN
+    search itself. The squared distance and gaussian modes are computed
+    from the squared distances returned by FLANN.
+    """
     name = 'cyflann'
 
 
     def __init__(self, radius=None, n_neighbors=None, flann_index=None,
-                 target_precision=None, cyflann_kwds=None):
+                 target_precision=None, cyflann_kwds=None, n_jobs=1,
+                 n_processes=1, max_neighbors=None, mode='distance',
+                 affinity_radius=None):
+        if not CYFLANN_LOADED:
+            raise ValueError("the cyflann extension must be compiled "
+                             "to use method='cyflann'")
         self.flann_index = flann_index
         self.target_precision = target_precision
-        self.cyflann_kwds = cyflann_kwds
-        if cyflann_kwds is not None:
-            if 'num_checks' in cyflann_kwds.keys():
-                self.check_kwds = {'num_checks':self.cyflann_kwds['num_checks']}
-                del cyflann_kwds['num_checks']
-            else:
-                self.check_kwds = {}
+        self.cyflann_kwds = dict(cyflann_kwds or {})
+        self.n_jobs = n_jobs
+        if 'num_checks' in self.cyflann_kwds:
+            self.check_kwds = {'num_checks':self.cyflann_kwds.pop('num_checks')}
         else:
             self.check_kwds = {}
-            
+
         super(CyFLANNAdjacency, self).__init__(radius=radius,
                                                n_neighbors=n_neighbors,
-                                               mode='distance')
+                                               mode=mode,
+                                               n_processes=n_processes,
+                                               max_neighbors=max_neighbors,
+                                               affinity_radius=affinity_radius)
+        if max_neighbors is not None:
+            self.check_kwds['max_neighbors'] = max_neighbors
 
     def _get_built_index(self, X):
         if self.flann_index is None:
-            cyindex = CyIndex(X, target_precision=self.target_precision,
-                              **(self.cyflann_kwds or {}))
-        else:
-            cyindex = self.flann_index
-        cyindex.buildIndex()
-        return cyindex
+            self.flann_index = CyIndex(X, target_precision=self.target_precision,
+                                       **self.cyflann_kwds)
+        if not self.flann_index.built:
+            self.flann_index.buildIndex()
+        return self.flann_index
 
 
     def build_index(self, X):
         return self._get_built_index(X)
 
 
-    def radius_adjacency(self, index, queries):
-        return index.radius_neighbors_graph(queries, self.radius, **self.check_kwds)
+    def query_adjacency(self, index, queries):
+        squared = self.mode != 'distance'
+        if self.n_neighbors is not None:
+            G = index.knn_neighbors_graph(queries, self.n_neighbors,
+                                          n_jobs=self.n_jobs, squared=squared)
+        else:
+            G = index.radius_neighbors_graph(queries, self.radius,
+                                             n_jobs=self.n_jobs,
+                                             squared=squared,
+                                             **self.check_kwds)
+        if squared:
+            G.data = self._output_data(G.data, squared=True)
+        return G
+
+
+    def radius_adjacency(self, X):
+        return self.query_adjacency(self._get_built_index(X), X)
 
 
-    def knn_addjacency(self, index, queries):
-        return index.knn_neighbors_graph(queries, self.n_neighbors)
+    def knn_adjacency(self, X):
+        return self.query_adjacency(self._get_built_index(X), X)
+
+
+class HNSWAdjacency(Adjacency):
+    """Approximate adjacency using a hierarchical navigable small world graph
+
+    The graph index (megaman.geometry.hnsw) is built with ``n_jobs`` threads
+    on the first query and kept in ``self.hnsw_index``; an index passed as
+    ``hnsw_index`` (e.g. loaded from a file) is used as is. ``M`` and
+    ``ef_construction`` set the quality of the graph, ``ef`` the size of the
+    candidate lists of the queries. Larger values improve the recall, which
+    remains good in high dimensional spaces. Radius queries capped at
+    max_neighbors stop growing their candidate lists once max_neighbors
+    neighbors within the radius are found. The squared distance and gaussian
+    modes are computed from the squared distances of the index.
+    """
+    name = 'hnsw'
+
+    def __init__(self, radius=None, n_neighbors=None, hnsw_index=None, M=16,
+                 ef_construction=200, ef=50, random_seed=0, n_jobs=1,
+                 n_processes=1, max_neighbors=None, mode='distance',
+                 affinity_radius=None):
+        self.hnsw_index = hnsw_index
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef = ef
+        self.random_seed = random_seed
+        self.n_jobs = n_jobs
+        super(HNSWAdjacency, self).__init__(radius=radius,
+                                            n_neighbors=n_neighbors,
+                                            mode=mode,
+                                            n_processes=n_processes,
+                                            max_neighbors=max_neighbors,
+                                            affinity_radius=affinity_radius)
 
+    def build_index(self, X):
+        if self.hnsw_index is None:
+            self.hnsw_index = HnswIndex(X.shape[1], M=self.M,
+                                        ef_construction=self.ef_construction,
+                                        random_seed=self.random_seed)
+            self.hnsw_index.add_points(X, n_jobs=self.n_jobs)
+        return self.hnsw_index
+
+    def query_adjacency(self, index, queries):
+        squared = self.mode != 'distance'
+        if self.n_neighbors is not None:
+            G = index.knn_neighbors_graph(queries, self.n_neighbors,
+                                          ef=self.ef, n_jobs=self.n_jobs,
+                                          squared=squared)
+        else:
+            G = index.radius_neighbors_graph(
+                queries, self.radius, ef=self.ef, n_jobs=self.n_jobs,
+                max_neighbors=self.max_neighbors or -1, squared=squared)
+        if squared:
+            G.data = self._output_data(G.data, squared=True)
+        return G
 
     def radius_adjacency(self, X):
-        cyindex = self._get_built_index(X)
-        return cyindex.radius_neighbors_graph(X, self.radius, **self.check_kwds)
-
+        return self.query_adjacency(self.build_index(X), X)
 
     def knn_adjacency(self, X):
-        cyindex = self._get_built_index(X)
-        return cyindex.knn_neighbors_graph(X, self.n_neighbors)
+        return self.query_adjacency(self.build_index(X), X)
+
+
+class LSHAdjacency(Adjacency):
+    """Approximate radius adjacency using random-projection hashing
+
+    Each of the ``n_tables`` hash tables projects the data on
+    ``n_projections`` random gaussian directions and quantizes the
+    projections into buckets of width ``bucket_width`` (default: 4 *
+    radius, at most twice the standard deviation of the projections).
+    Points sharing a bucket in a table are candidate pairs. The candidates
+    are generated one table and ``batch_size`` pairs at a time, and their
+    exact distances computed right away, so that only the pairs within the
+    radius are kept and deduplicated; they are mirrored into a symmetric
+    graph. Only matrix products with X and row-wise dot products are used,
+    so sparse, very high dimensional X is handled without densifying it.
+
+    More tables (or wider buckets) find more of the true pairs; more
+    projections per table give fewer, more selective candidates. The
+    number of candidate pairs checked by the last search is kept in
+    ``n_candidates``. With max_neighbors, the rows of the graph are capped
+    after the search.
+    """
+    name = 'lsh'
+
+    def __init__(self, radius=None, n_neighbors=None, mode='distance',
+                 n_tables=8, n_projections=4, bucket_width=None,
+                 batch_size=65536, random_state=None, max_neighbors=None,
+                 affinity_radius=None):
+        if n_neighbors is not None:
+            raise ValueError("method='lsh' only supports radius queries")
+        if n_tables <= 0 or n_projections <= 0:
+            raise ValueError("n_tables and n_projections must be positive")
+        self.n_tables = n_tables
+        self.n_projections = n_projections
+        self.bucket_width = bucket_width
+        self.batch_size = batch_size
+        self.random_state = random_state
+        super(LSHAdjacency, self).__init__(radius=radius,
+                                           n_neighbors=n_neighbors,
+                                           mode=mode,
+                                           max_neighbors=max_neighbors,
+                                           affinity_radius=affinity_radius)
+
+    def _bucket_width(self, H):
+        """Return the bucket width for the (N_obs, n_hashes) projections H"""
+        if self.bucket_width is not None:
+            return self.bucket_width
+        # buckets as wide as the spread of the projections pair up most of
+        # the points: cap the width at two standard deviations
+        spread = np.sqrt(np.mean(np.var(H, axis=0)))
+        if spread == 0:
+            return 4 * self.radius
+        return min(4 * self.radius, 2 * spread)
+
+    def _hash_keys(self, X):
+        """Return the (n_tables, N_obs) bucket keys of the points"""
+        rng = check_random_state(self.random_state)
+        n_hashes = self.n_tables * self.n_projections
+        projections = rng.randn(X.shape[1], n_hashes)
+        H = np.asarray(X.dot(projections))
+        width = self._bucket_width(H)
+        H += rng.uniform(0, width, n_hashes)
+        H /= width
+        H = np.floor(H).astype(np.int64).reshape(-1, self.n_tables,
+                                                 self.n_projections)
+        # combine the bucket numbers of a table into one key; the products
+        # wrap around, and colliding keys only add candidates
+        multipliers = rng.randint(1, 2 ** 31, self.n_projections,
+                                  dtype=np.int64)
+        return np.einsum('ntp,p->tn', H, multipliers)
+
+    @staticmethod
+    def _iter_bucket_pairs(keys, batch_size):
+        """Yield the pairs (i, j), i < j, of points sharing a key
+
+        The pairs are yielded in batches of about batch_size pairs (at
+        least the pairs of one point), so that only one batch of candidates
+        is in memory at once.
+        """
+        order = np.argsort(keys, kind='mergesort')
+        sorted_keys = keys[order]
+        n = len(keys)
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        ends = np.r_[starts[1:], n]
+        # each point is paired with the points following it in its bucket
+        n_partners = np.repeat(ends, np.diff(np.r_[starts, n])) - np.arange(n) - 1
+        total = np.cumsum(n_partners)
+        lo = 0
+        while lo < n:
+            done = total[lo - 1] if lo > 0 else 0
+            hi = max(lo + 1, np.searchsorted(total, done + batch_size,
+                                             side='right'))
+            counts = n_partners[lo:hi]
+            if total[hi - 1] > done:
+                first = np.cumsum(counts) - counts
+                partner = (np.arange(total[hi - 1] - done)
+                           + np.repeat(np.arange(lo + 1, hi + 1) - first,
+                                       counts))
+                i = np.repeat(order[lo:hi], counts)
+                j = order[partner]
+                yield np.minimum(i, j), np.maximum(i, j)
+            lo = hi
+
+    def _squared_distances(self, X, sqnorms, i, j):
+        if sparse.issparse(X):
+            dots = np.asarray(X[i].multiply(X[j]).sum(1)).ravel()
+            D2 = sqnorms[i] + sqnorms[j] - 2 * dots
+            return np.maximum(D2, 0, out=D2)
+        else:
+            diff = X[i] - X[j]
+            return np.einsum('ij,ij->i', diff, diff)
+
+    def radius_adjacency(self, X):
+        if sparse.issparse(X):
+            X = X.tocsr()
+            sqnorms = np.asarray(X.multiply(X).sum(1)).ravel()
+        else:
+            sqnorms = None
+        n_samples = X.shape[0]
+        radius2 = self.radius ** 2
+
+        # check the candidates of one table a batch at a time, and only
+        # deduplicate the pairs within the radius
+        codes, D2 = np.zeros(0, dtype=np.int64), np.zeros(0)
+        self.n_candidates = 0
+        for keys in self._hash_keys(X):
+            codes, D2 = [codes], [D2]
+            for i, j in self._iter_bucket_pairs(keys, self.batch_size):
+                self.n_candidates += len(i)
+                d2 = self._squared_distances(X, sqnorms, i, j)
+                keep = d2 <= radius2
+                codes.append(i[keep] * n_samples + j[keep])
+                D2.append(d2[keep])
+            codes, first = np.unique(np.concatenate(codes), return_index=True)
+            D2 = np.concatenate(D2)[first]
+
+        G = _symmetric_pairs_graph(codes // n_samples, codes % n_samples, D2,
+                                   n_samples)
+        if self.max_neighbors is not None:
+            G = _cap_row_neighbors(G, self.max_neighbors)
+        G.data = self._output_data(G.data, squared=True)
+        return G
 
 
 class PyFLANNAdjacency(Adjacency):
     name = 'pyflann'
 
+    # number of neighbors of the first kNN search of a radius query
+    initial_radius_neighbors = 32
+
     def __init__(self, radius=None, n_neighbors=None, flann_index=None,
-                 algorithm='kmeans', target_precision=0.9, pyflann_kwds=None):
+                 algorithm='kmeans', target_precision=0.9, pyflann_kwds=None,
+                 max_neighbors=None, mode='distance', affinity_radius=None):
         if not PYFLANN_LOADED:
             raise ValueError("pyflann must be installed "
                              "to use method='pyflann'")
@@ -145,7 +890,9 @@ class PyFLANNAdjacency(Adjacency):
         self.pyflann_kwds = pyflann_kwds
         super(PyFLANNAdjacency, self).__init__(radius=radius,
                                                n_neighbors=n_neighbors,
-                                               mode='distance')
+                                               mode=mode,
+                                               max_neighbors=max_neighbors,
+                                               affinity_radius=affinity_radius)
 
     def _get_built_index(self, X):
         if self.flann_index is None:
@@ -158,24 +905,47 @@ class PyFLANNAdjacency(Adjacency):
         return pyindex
 
     def radius_adjacency(self, X):
+        # Radius search as batched kNN searches with a radius cutoff: all
+        # the queries are searched in one call, and only the rows whose k-th
+        # neighbor is still within the radius are searched again, with twice
+        # as many neighbors (up to max_neighbors).
         flindex = self._get_built_index(X)
 
-        n_samples, n_features = X.shape
+        n_samples = X.shape[0]
         X = np.require(X, requirements = ['A', 'C']) # required for FLANN
+        radius2 = self.radius ** 2
+        max_neighbors = min(self.max_neighbors or n_samples, n_samples)
 
         graph_i = []
         graph_j = []
         graph_data = []
-        for i in range(n_samples):
-            jj, dd = flindex.nn_radius(X[i], self.radius ** 2)
-            graph_data.append(dd)
-            graph_j.append(jj)
-            graph_i.append(i*np.ones(jj.shape, dtype=int))
+        pending = np.arange(n_samples)
+        n_neighbors = min(self.initial_radius_neighbors, max_neighbors)
+        while len(pending):
+            ind, dist = flindex.nn_index(X[pending], n_neighbors)
+            ind = np.reshape(ind, (len(pending), n_neighbors))
+            dist = np.reshape(dist, (len(pending), n_neighbors))
+            within = dist <= radius2
+            if n_neighbors < max_neighbors:
+                # neighbors are sorted: more may lie within the radius
+                saturated = within[:, -1]
+            else:
+                saturated = np.zeros(len(pending), dtype=bool)
+            done = ~saturated
+            graph_i.append(np.repeat(pending[done], within[done].sum(1)))
+            graph_j.append(ind[done][within[done]])
+            graph_data.append(dist[done][within[done]])
+            pending = pending[saturated]
+            n_neighbors = min(2 * n_neighbors, max_neighbors)
 
-        graph_data = np.concatenate(graph_data)
         graph_i = np.concatenate(graph_i)
-        graph_j = np.concatenate(graph_j)
-        return sparse.coo_matrix((np.sqrt(graph_data), (graph_i, graph_j)),
+        order = np.argsort(graph_i, kind='mergesort')
+        indptr = np.zeros(n_samples + 1, dtype=np.intp)
+        np.cumsum(np.bincount(graph_i, minlength=n_samples), out=indptr[1:])
+        graph_data = self._output_data(np.concatenate(graph_data)[order],
+                                       squared=True)
+        graph_j = np.concatenate(graph_j)[order]
+        return sparse.csr_matrix((graph_data, graph_j, indptr),
                                  shape=(n_samples, n_samples))
 
     def knn_adjacency(self, X):
@@ -183,7 +953,8 @@ class PyFLANNAdjacency(Adjacency):
         flindex = self._get_built_index(X)
         A_ind, A_data = flindex.nn_index(X, self.n_neighbors)
         A_ind = np.ravel(A_ind)
-        A_data = np.sqrt(np.ravel(A_data))  # FLANN returns square distances
+        # FLANN returns square distances
+        A_data = self._output_data(np.ravel(A_data), squared=True)
         A_indptr = self.n_neighbors * np.arange(n_samples + 1)
         return sparse.csr_matrix((A_data, A_ind, A_indptr),
                                  shape=(n_samples, n_samples))
@@ -1,10 +1,12 @@
 # LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
 
 import numpy as np
-from scipy.sparse import isspmatrix
+from scipy.sparse import csr_matrix, isspmatrix
 from sklearn.utils.validation import check_array
 
-from .utils import RegisterSubclasses
+from .utils import (RegisterSubclasses, flag_symmetric, is_flagged_symmetric,
+                    symmetrize, symmetrize_sources, SYMMETRIZE_RULES,
+                    reserve_diagonal, scaled_exp, divide_gather)
 
 
 def compute_affinity_matrix(adjacency_matrix, method='auto', **kwargs):
@@ -20,47 +22,235 @@ def affinity_methods():
 
 
 class Affinity(RegisterSubclasses):
-    """Base class for computing affinity matrices"""
-    def __init__(self, radius=None, symmetrize=True):
+    """Base class for computing affinity matrices
+
+    The affinity is computed in ``dtype`` precision: the adjacency matrix is
+    cast to dtype in the copy on which the affinity is computed.
+
+    ``symmetrize`` is True (the 'average' rule), False, or one of the rules
+    of utils.symmetrize: 'average', 'max' or 'min' (mutual neighbors).
+
+    ``affinity_matrix`` takes the ``input_type`` of the entries of the
+    adjacency matrix, which an adjacency method computes with its ``mode``
+    ('distance', 'squared_distance' or the kernel values, e.g. 'gaussian'),
+    and whether to copy it. Without copy, a matrix of the right dtype is
+    transformed in place: the affinity matrix reuses its arrays when it
+    stores its diagonal and, if symmetrized, has a symmetric structure
+    (see utils.reserve_diagonal and utils.symmetrize).
+
+    ``affinity_matrices`` computes the affinity matrices of several radii
+    (a bandwidth sweep) from one adjacency matrix.
+    """
+    def __init__(self, radius=None, symmetrize=True, dtype=np.float64):
         if radius is None:
             raise ValueError("must specify radius for affinity matrix")
+        if symmetrize not in [True, False] + SYMMETRIZE_RULES:
+            raise ValueError("symmetrize must be a boolean or one of "
+                             "{0}".format(SYMMETRIZE_RULES))
         self.radius = radius
         self.symmetrize = symmetrize
+        self.dtype = dtype
+
+    def affinity_matrix(self, adjacency_matrix, input_type='distance',
+                        copy=True):
+        raise NotImplementedError()
 
-    def affinity_matrix(self, adjacency_matrix):
+    def affinity_matrices(self, adjacency_matrix, radii,
+                          input_type='distance'):
         raise NotImplementedError()
 
 
 class GaussianAffinity(Affinity):
     name = "gaussian"
 
-    @staticmethod
-    def _symmetrize(A):
-        # TODO: make this more efficient?
-        # Also, need to maintain explicit zeros!
-        return 0.5 * (A + A.T)
-
-    def affinity_matrix(self, adjacency_matrix):
-        A = check_array(adjacency_matrix, dtype=float, copy=True,
+    def affinity_matrix(self, adjacency_matrix, input_type='distance',
+                        copy=True):
+        if input_type not in ['distance', 'squared_distance', 'gaussian']:
+            raise ValueError("input_type={0} not valid for the gaussian "
+                             "affinity".format(input_type))
+        # adjacency matrices flagged as symmetric need no symmetrization
+        symmetric = is_flagged_symmetric(adjacency_matrix)
+        A = check_array(adjacency_matrix, dtype=self.dtype, copy=copy,
                         accept_sparse=['csr', 'csc', 'coo'])
 
         if isspmatrix(A):
+            # store the diagonal, set below, ahead of the symmetrization
+            A = reserve_diagonal(A)
             data = A.data
         else:
             data = A
 
         # in-place computation of
         # data = np.exp(-(data / radius) ** 2)
-        data **= 2
-        data /= -self.radius ** 2
-        np.exp(data, out=data)
+        if input_type != 'gaussian':
+            scaled_exp(data, -self.radius ** 2,
+                       square=input_type == 'distance')
+
+        if self.symmetrize and not symmetric:
+            rule = 'average' if self.symmetrize is True else self.symmetrize
+            # A is a copy, or may be modified in place
+            A = symmetrize(A, rule, copy=False)
+            symmetric = True
+
+        # for sparse, the zero distances to the points themselves may not
+        # be stored: set the diagonal, in the slots reserved above
+        if isspmatrix(A):
+            A.setdiag(1)
+            if symmetric:
+                flag_symmetric(A)
+
+        return A
+
+    def affinity_matrices(self, adjacency_matrix, radii,
+                          input_type='distance'):
+        """Return the affinity matrices of each radius in radii
+
+        The adjacency matrix is validated, copied and symmetrized once:
+        sparse affinity matrices share one ``indices``/``indptr`` structure
+        (storing the diagonal) and differ only in their ``data``, computed
+        by one exponential per radius. self.radius is not used.
+
+        The matrices are flagged as symmetric when symmetrized, so they can
+        be passed to Laplacian.laplacian_matrix with copy=False, which
+        computes the Laplacian in their data.
+        """
+        if input_type not in ['distance', 'squared_distance']:
+            raise ValueError("input_type={0} not valid for a batch of "
+                             "gaussian affinities".format(input_type))
+        symmetric = is_flagged_symmetric(adjacency_matrix)
+        D2 = check_array(adjacency_matrix, dtype=self.dtype, copy=True,
+                         accept_sparse=['csr', 'csc', 'coo'])
+        rule = 'average' if self.symmetrize is True else self.symmetrize
+
+        if not isspmatrix(D2):
+            if input_type == 'distance':
+                D2 **= 2
+            matrices = []
+            for radius in radii:
+                A = scaled_exp(D2.copy(), -radius ** 2)
+                if self.symmetrize and not symmetric:
+                    A = symmetrize(A, rule)
+                matrices.append(A)
+            return matrices
+
+        # a zero distance on the diagonal gives the affinity 1 which
+        # affinity_matrix sets there
+        D2 = reserve_diagonal(D2)
+        if input_type == 'distance':
+            D2.data **= 2
+
+        if self.symmetrize and not symmetric:
+            indices, indptr, source, source_t = symmetrize_sources(D2, rule)
+            symmetric = True
+        else:
+            indices, indptr = D2.indices, D2.indptr
+            source = None
+
+        matrices = []
+        for radius in radii:
+            data = scaled_exp(D2.data.copy(), -radius ** 2)
+            if source is not None:
+                # the entries not stored (position -1) gather a zero
+                data = np.append(data, 0)
+                if rule == 'average':
+                    data = 0.5 * (data[source] + data[source_t])
+                elif rule == 'max':
+                    data = np.maximum(data[source], data[source_t])
+                else:
+                    data = np.minimum(data[source], data[source_t])
+            A = csr_matrix((data, indices, indptr), shape=D2.shape)
+            if symmetric:
+                flag_symmetric(A)
+            matrices.append(A)
+        return matrices
+
+
+class SelfTuningAffinity(Affinity):
+    """Gaussian affinity with a local bandwidth per point
+
+    The affinity of points i and j is exp(-d_ij^2 / (sigma_i sigma_j)),
+    where sigma_i is the distance from point i to its n_neighbors-th
+    nearest neighbor stored in its row of the adjacency matrix (the
+    self-tuning affinity of Zelnik-Manor & Perona, 2004). Points storing
+    fewer than n_neighbors neighbors, or at zero distance from them, use
+    ``radius`` as bandwidth. The bandwidths adapt to the density of the
+    data, so a small adjacency radius gives a connected, sparse graph.
+    """
+    name = "self_tuning"
+
+    def __init__(self, radius=None, n_neighbors=7, symmetrize=True,
+                 dtype=np.float64):
+        super(SelfTuningAffinity, self).__init__(radius=radius,
+                                                 symmetrize=symmetrize,
+                                                 dtype=dtype)
+        self.n_neighbors = n_neighbors
+
+    def local_bandwidths(self, D2):
+        """Return the squared bandwidths sigma_i^2 of the rows of D2
+
+        D2 is a CSR matrix or an array of squared distances. The diagonal
+        entries are not neighbors.
+        """
+        k = self.n_neighbors
+        if isspmatrix(D2):
+            rows = np.repeat(np.arange(D2.shape[0]), np.diff(D2.indptr))
+            neighbor = rows != D2.indices
+            rows = rows[neighbor]
+            data = D2.data[neighbor]
+            # sort the distances of each row, then index the k-th one
+            order = np.lexsort((data, rows))
+            counts = np.bincount(rows, minlength=D2.shape[0])
+            starts = np.cumsum(counts) - counts
+            has_k = counts >= k
+            sigma2 = np.full(D2.shape[0], np.nan)
+            sigma2[has_k] = data[order[starts[has_k] + k - 1]]
+        else:
+            D2 = D2.copy()
+            np.fill_diagonal(D2, np.inf)
+            if k <= D2.shape[1] - 1:
+                sigma2 = np.partition(D2, k - 1, axis=1)[:, k - 1]
+            else:
+                sigma2 = np.full(D2.shape[0], np.nan)
+        sigma2[~(sigma2 > 0)] = self.radius ** 2
+        return sigma2
+
+    def affinity_matrix(self, adjacency_matrix, input_type='distance',
+                        copy=True):
+        if input_type not in ['distance', 'squared_distance']:
+            raise ValueError("input_type={0} not valid for the self-tuning "
+                             "affinity".format(input_type))
+        symmetric = is_flagged_symmetric(adjacency_matrix)
+        A = check_array(adjacency_matrix, dtype=self.dtype, copy=copy,
+                        accept_sparse=['csr', 'csc', 'coo'])
+        if isspmatrix(A):
+            # store the diagonal, set below, ahead of the symmetrization
+            A = reserve_diagonal(A)
+            data = A.data
+        else:
+            data = A
+
+        # in-place computation of
+        # data = np.exp(-data ** 2 / (sigma[row] * sigma[col]))
+        if input_type == 'distance':
+            data **= 2
+        sigma = np.sqrt(self.local_bandwidths(A))
+        if isspmatrix(A):
+            rows = np.repeat(np.arange(A.shape[0]), np.diff(A.indptr))
+            divide_gather(data, -sigma, rows)
+            divide_gather(data, sigma, A.indices)
+        else:
+            data /= -sigma[:, np.newaxis]
+            data /= sigma
+        scaled_exp(data, 1.0)
 
-        if self.symmetrize:
-            A = self._symmetrize(A)
+        if self.symmetrize and not symmetric:
+            rule = 'average' if self.symmetrize is True else self.symmetrize
+            A = symmetrize(A, rule, copy=False)
+            symmetric = True
 
-        # for sparse, need a true zero on the diagonal
-        # TODO: make this more efficient?
         if isspmatrix(A):
             A.setdiag(1)
+            if symmetric:
+                flag_symmetric(A)
 
         return A
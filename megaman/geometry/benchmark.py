@@ -0,0 +1,267 @@
+# LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
+"""
+Speed / accuracy benchmark of the adjacency methods.
+
+Every registered adjacency method is run over a grid of data sizes,
+dimensions, queries (radius or number of neighbors) and method parameters.
+Each run records the index build time, the query time and throughput, the
+peak traced (Python) and resident memory, and the per-row recall of the
+graph against an exact reference method. Results are plain dicts, written as JSON with
+``write_benchmark_results`` or from the command line::
+
+    python -m megaman.geometry.benchmark --n-samples 1000 10000 \\
+        --n-features 3 50 --n-neighbors 10 --output results.json
+"""
+from __future__ import division, print_function
+
+import argparse
+import ctypes
+import json
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from scipy import sparse
+from sklearn.model_selection import ParameterGrid
+
+from .adjacency import Adjacency
+
+__all__ = ["benchmark_adjacency", "run_adjacency_benchmark", "row_recall",
+           "write_benchmark_results"]
+
+
+def row_recall(G, G_true):
+    """Return the recall of each row of the graph G against G_true
+
+    The recall of a row is the fraction of the stored entries (neighbors) of
+    that row of G_true that are stored in G. Rows without neighbors in
+    G_true have a recall of 1.
+    """
+    G = sparse.csr_matrix(G)
+    G_true = sparse.csr_matrix(G_true)
+    n_rows, n_cols = G_true.shape
+    rows = np.repeat(np.arange(n_rows), np.diff(G.indptr))
+    true_rows = np.repeat(np.arange(n_rows), np.diff(G_true.indptr))
+    codes = rows.astype(np.int64) * n_cols + G.indices
+    true_codes = true_rows.astype(np.int64) * n_cols + G_true.indices
+    found = np.isin(true_codes, codes)
+    n_found = np.bincount(true_rows[found], minlength=n_rows)
+    n_true = np.diff(G_true.indptr)
+    recall = np.ones(n_rows)
+    nonempty = n_true > 0
+    recall[nonempty] = n_found[nonempty] / n_true[nonempty]
+    return recall
+
+
+def _resident_memory(field):
+    """Return a memory field of /proc/self/status (e.g. VmRSS) in megabytes
+
+    Returns None where the field is not available (other than Linux).
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def _reset_peak_resident_memory():
+    """Reset the peak resident memory (VmHWM) of the process to its current
+    resident memory, which is returned in megabytes (None if not supported)
+
+    The memory freed by earlier runs is first returned to the system, so
+    that it is not reused without raising the resident memory.
+    """
+    try:
+        ctypes.CDLL(None).malloc_trim(0)
+    except (AttributeError, OSError, TypeError):
+        # not glibc
+        pass
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        return None
+    return _resident_memory('VmRSS')
+
+
+def run_adjacency_benchmark(method, X, G_true=None, **kwargs):
+    """Benchmark one adjacency method on X
+
+    Parameters
+    ----------
+    method : string
+        Adjacency method.
+    X : array_like (N_obs, N_features)
+        The data.
+    G_true : sparse matrix, optional
+        Exact adjacency matrix of X for the same query, used for the recall.
+    **kwargs :
+        Keyword arguments for the adjacency method, including the radius or
+        n_neighbors.
+
+    Returns
+    -------
+    result : dict
+        ``build_time`` and ``query_time`` in seconds (methods without a
+        separate index report their whole run as query time), ``throughput``
+        in queries per second, ``peak_traced_memory`` and
+        ``peak_resident_memory`` in megabytes, ``nnz``, and ``recall_mean``,
+        ``recall_min`` if G_true is given. The peak traced memory is that of
+        the allocations traced by ``tracemalloc`` (Python and NumPy), which
+        excludes the memory of native indices such as FLANN or HNSW. The
+        peak resident memory is the growth of the peak resident set size of
+        the process during the run, which includes them (None where it
+        cannot be measured: it needs Linux). If the method fails, ``error``
+        holds the error message.
+    """
+    result = {'method': method, 'n_samples': X.shape[0],
+              'n_features': X.shape[1]}
+    start_memory = _reset_peak_resident_memory()
+    tracemalloc.start()
+    try:
+        adjacency = Adjacency.init(method, **kwargs)
+        has_index = (type(adjacency).build_index
+                     is not Adjacency.build_index)
+        t0 = time.time()
+        if has_index:
+            index = adjacency.build_index(X)
+        t1 = time.time()
+        if has_index:
+            G = adjacency.query_adjacency(index, X)
+        else:
+            G = adjacency.adjacency_graph(X)
+        t2 = time.time()
+        peak = tracemalloc.get_traced_memory()[1]
+        peak_resident = _resident_memory('VmHWM')
+    except Exception as err:
+        result['error'] = '{0}: {1}'.format(type(err).__name__, err)
+        return result
+    finally:
+        tracemalloc.stop()
+
+    result['build_time'] = t1 - t0
+    result['query_time'] = t2 - t1
+    result['throughput'] = X.shape[0] / max(t2 - t1, 1E-9)
+    result['peak_traced_memory'] = peak / 2 ** 20
+    if start_memory is None or peak_resident is None:
+        result['peak_resident_memory'] = None
+    else:
+        result['peak_resident_memory'] = peak_resident - start_memory
+    result['nnz'] = int(G.nnz)
+    if G_true is not None:
+        recall = row_recall(G, G_true)
+        result['recall_mean'] = float(recall.mean())
+        result['recall_min'] = float(recall.min())
+    return result
+
+
+def benchmark_adjacency(methods=None, n_samples=(1000,), n_features=(3,),
+                        radii=(), n_neighbors=(10,), param_grid=None,
+                        reference='brute', random_state=0, verbose=False):
+    """Benchmark adjacency methods over a grid of data sets and parameters
+
+    The data sets are uniform samples of the unit hypercube.
+
+    Parameters
+    ----------
+    methods : list of strings, optional
+        Adjacency methods to benchmark. Defaults to all registered methods.
+    n_samples, n_features : lists of ints
+        Sizes and dimensions of the data sets.
+    radii : list of floats
+        Radii of the radius queries.
+    n_neighbors : list of ints
+        Numbers of neighbors of the kNN queries.
+    param_grid : dict, optional
+        Parameter grid of each method, in the format of
+        ``sklearn.model_selection.ParameterGrid`` (a dict of lists or a list
+        of such dicts), e.g.
+        ``{'cyflann': {'target_precision': [0.8, 0.9, 0.99]}}`` (the target
+        precision selects the type and parameters of the FLANN index; the
+        searches check ``num_checks`` leaves, set in ``cyflann_kwds``).
+        Methods not in param_grid run with their default parameters.
+    reference : string
+        Exact method computing the graphs against which recall is measured.
+    random_state : int
+        Seed of the data sets.
+    verbose : bool
+        Print each result as it is computed.
+
+    Returns
+    -------
+    results : list of dicts
+        One result per run (see run_adjacency_benchmark), also holding the
+        query (``radius`` or ``n_neighbors``) and the method ``params``.
+    """
+    if methods is None:
+        methods = list(Adjacency.methods())
+    param_grid = param_grid or {}
+    queries = ([{'radius': radius} for radius in radii] +
+               [{'n_neighbors': k} for k in n_neighbors])
+
+    rng = np.random.RandomState(random_state)
+    results = []
+    for N in n_samples:
+        for D in n_features:
+            X = rng.rand(N, D)
+            for query in queries:
+                G_true = Adjacency.init(reference, **query).adjacency_graph(X)
+                for method in methods:
+                    for params in ParameterGrid(param_grid.get(method, {})):
+                        result = run_adjacency_benchmark(method, X, G_true,
+                                                         **dict(params,
+                                                                **query))
+                        result.update(query)
+                        result['params'] = params
+                        if verbose:
+                            print(json.dumps(result, default=repr))
+                        results.append(result)
+    return results
+
+
+def write_benchmark_results(results, filename):
+    """Write benchmark results to a JSON file
+
+    Parameter values which are not JSON serializable are written as their
+    repr.
+    """
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent=1, default=repr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the megaman adjacency methods")
+    parser.add_argument('--methods', nargs='+', default=None)
+    parser.add_argument('--n-samples', nargs='+', type=int, default=[1000])
+    parser.add_argument('--n-features', nargs='+', type=int, default=[3])
+    parser.add_argument('--radii', nargs='*', type=float, default=[])
+    parser.add_argument('--n-neighbors', nargs='*', type=int, default=[10])
+    parser.add_argument('--param-grid', type=json.loads, default=None,
+                        help="JSON parameter grid of each method")
+    parser.add_argument('--reference', default='brute')
+    parser.add_argument('--output', default=None,
+                        help="JSON output file (default: standard output)")
+    args = parser.parse_args(argv)
+
+    results = benchmark_adjacency(methods=args.methods,
+                                  n_samples=args.n_samples,
+                                  n_features=args.n_features,
+                                  radii=args.radii,
+                                  n_neighbors=args.n_neighbors,
+                                  param_grid=args.param_grid,
+                                  reference=args.reference,
+                                  verbose=args.output is not None)
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=1, default=repr)
+    else:
+        write_benchmark_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
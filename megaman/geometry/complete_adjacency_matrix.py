@@ -2,13 +2,18 @@
 from .adjacency import CyFLANNAdjacency, compute_adjacency_matrix
 from scipy.sparse import vstack, hstack
 
-def complete_adjacency_matrix(Dtrain, Xtrain, Xtest, adjacency_kwds):
+def complete_adjacency_matrix(Dtrain, Xtrain, Xtest, adjacency_kwds,
+                              flann_index=None):
+    """Extend the training adjacency matrix Dtrain with the rows and columns
+    of the test points. If flann_index (a built cyflann Index over Xtrain) is
+    given, it is reused instead of building a new index over Xtrain."""
     if 'cyflann_kwds' in adjacency_kwds.keys():
         cyflann_kwds = adjacency_kwds['cyflann_kwds']
     else:
         cyflann_kwds = {}
     radius = adjacency_kwds['radius']
-    Cyflann = CyFLANNAdjacency(radius=radius, **cyflann_kwds)
+    Cyflann = CyFLANNAdjacency(radius=radius, flann_index=flann_index,
+                               cyflann_kwds=cyflann_kwds)
     train_index = Cyflann.build_index(Xtrain)
     test_train_adjacency = train_index.radius_neighbors_graph(Xtest, radius)
     test_test_adjacency = compute_adjacency_matrix(Xtest, method='cyflann', **adjacency_kwds)    
@@ -0,0 +1,256 @@
+# LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
+"""
+Cost model of the adjacency methods, used to resolve method='auto'.
+
+The running time of each method is modeled as a nonnegative combination of
+a few cost terms of the number of points N, the dimension D (times the
+density of sparse inputs) and the number of neighbors per point k:
+
+- a constant overhead,
+- N log(N) D, for building an index,
+- N k, for writing the graph,
+- N^2 D, for comparing all pairs,
+- N^(2 - 1/D) D, the worst case of a range search in a kd-tree, which
+  grows from N log(N) in low dimension to brute force in high dimension.
+
+Each method only uses the terms matching its algorithm (see METHOD_TERMS):
+brute force methods compare all pairs, tree methods pay for building the
+tree and for range searches, and graph or hashing indices are modeled as
+log-linear. The coefficients of each method are fitted by
+``calibrate_cost_model`` from a micro-benchmark of the methods on uniform
+data. ``COST_COEFFICIENTS`` holds the bundled calibration; it can be
+updated with a calibration made on the target machine.
+"""
+from __future__ import division
+
+import numpy as np
+from scipy import sparse
+from scipy.optimize import nnls
+from sklearn.metrics.pairwise import euclidean_distances
+
+from . import adjacency
+
+__all__ = ["select_adjacency_method", "estimate_n_neighbors",
+           "calibrate_cost_model", "cost_terms", "COST_COEFFICIENTS"]
+
+
+# approximate methods are only selected for data sets larger than this
+APPROXIMATE_MIN_SAMPLES = 10000
+APPROXIMATE_METHODS = ['cyflann', 'pyflann', 'hnsw', 'lsh']
+# methods indexing sparse inputs (the others need or densify dense inputs)
+SPARSE_METHODS = ['brute', 'blocked_brute', 'lsh']
+RADIUS_ONLY_METHODS = ['lsh']
+
+TERMS = ['constant', 'index', 'output', 'pairs', 'range_search']
+METHOD_TERMS = {
+    'brute': ['constant', 'output', 'pairs'],
+    'blocked_brute': ['constant', 'output', 'pairs'],
+    'kd_tree': ['constant', 'index', 'output', 'range_search'],
+    'ball_tree': ['constant', 'index', 'output', 'range_search'],
+    'ckdtree': ['constant', 'index', 'output', 'range_search'],
+    'cyflann': ['constant', 'index', 'output'],
+    'pyflann': ['constant', 'index', 'output'],
+    'hnsw': ['constant', 'index', 'output'],
+    'lsh': ['constant', 'index', 'output'],
+}
+
+# seconds per unit of each term of cost_terms, fitted by calibrate_cost_model
+# with its default settings (single core)
+COST_COEFFICIENTS = {
+    'ball_tree': [0.00116, 0, 5.1e-07, 0, 1.58e-09],
+    'blocked_brute': [0, 0, 1.35e-06, 3.61e-10, 0],
+    'brute': [0, 0, 8.18e-07, 2.92e-10, 0],
+    'ckdtree': [0, 0, 2.89e-07, 0, 7.24e-10],
+    'cyflann': [0, 5.42e-08, 8.07e-07, 0, 0],
+    'hnsw': [0, 3e-07, 8.56e-06, 0, 0],
+    'kd_tree': [0.00415, 0, 2.63e-07, 0, 3.2e-09],
+    'lsh': [0, 6.62e-07, 0, 0, 0],
+}
+
+
+def cost_terms(n_samples, n_features, n_neighbors, density=1.0):
+    """Return the cost terms of a query, in the order of TERMS"""
+    N = float(n_samples)
+    D = max(1.0, n_features * density)
+    return np.array([1.0,
+                     N * np.log2(max(N, 2)) * D,
+                     N * n_neighbors,
+                     N * N * D,
+                     N ** (2 - 1 / D) * D])
+
+
+def estimate_n_neighbors(X, radius=None, n_neighbors=None, n_queries=100,
+                         n_references=1000, random_state=0):
+    """Estimate the mean number of neighbors per point
+
+    For kNN queries this is n_neighbors. For radius queries, the distances
+    from a sample of n_queries points to a sample of n_references points
+    are computed, and the mean count within the radius is scaled to the
+    whole data set.
+    """
+    if n_neighbors is not None:
+        return float(n_neighbors)
+    N = X.shape[0]
+    rng = np.random.RandomState(random_state)
+    queries = rng.choice(N, min(N, n_queries), replace=False)
+    references = rng.choice(N, min(N, n_references), replace=False)
+    if sparse.issparse(X):
+        X = X.tocsr()
+    D2 = euclidean_distances(X[queries], X[references], squared=True)
+    counts = (D2 <= radius ** 2).sum(1)
+    return counts.mean() * N / len(references)
+
+
+def _candidate_methods(X, radius, n_neighbors, coefficients, methods=None,
+                       keywords=None):
+    """Return the calibrated methods able to compute this query on X
+
+    Methods which do not accept every keyword argument named in keywords
+    are left out.
+    """
+    available = {'cyflann': adjacency.CYFLANN_LOADED,
+                 'pyflann': adjacency.PYFLANN_LOADED}
+    if methods is None:
+        methods = adjacency.Adjacency.methods()
+    candidates = []
+    for method in coefficients:
+        if method not in methods:
+            continue
+        if not available.get(method, True):
+            continue
+        if keywords and not set(keywords).issubset(
+                adjacency.method_keywords(method)):
+            continue
+        if sparse.issparse(X) and method not in SPARSE_METHODS:
+            continue
+        if n_neighbors is not None and method in RADIUS_ONLY_METHODS:
+            continue
+        if (method in APPROXIMATE_METHODS
+                and X.shape[0] <= APPROXIMATE_MIN_SAMPLES):
+            continue
+        candidates.append(method)
+    return candidates
+
+
+def select_adjacency_method(X, radius=None, n_neighbors=None,
+                            coefficients=None, max_neighbors=None,
+                            methods=None, keywords=None):
+    """Select the adjacency method with the lowest estimated cost
+
+    Exact methods are preferred for data sets of up to
+    APPROXIMATE_MIN_SAMPLES points; larger data sets also consider the
+    approximate methods. Methods which are not compiled or installed, which
+    cannot handle a sparse X or the query, or which do not accept the given
+    keyword arguments, are not considered.
+
+    Parameters
+    ----------
+    X : array_like or sparse matrix (N_obs, N_features)
+        The data.
+    radius, n_neighbors : float, int
+        The query (one of them).
+    coefficients : dict, optional
+        Cost coefficients of each method (default: COST_COEFFICIENTS).
+    max_neighbors : int, optional
+        Cap on the neighbors per point of a radius query.
+    methods : list of strings, optional
+        The methods to consider (default: all the adjacency methods), e.g.
+        adjacency.index_query_methods() for block queries.
+    keywords : iterable of strings, optional
+        Names of the keyword arguments the method will be constructed with,
+        e.g. the adjacency_kwds; methods not accepting all of them are not
+        considered.
+
+    Returns
+    -------
+    selection : dict
+        ``method``, the selected method; ``reason``, a description of the
+        choice; ``costs``, the estimated cost in seconds of each candidate
+        method; and the statistics of X it is based on (``n_samples``,
+        ``n_features``, ``density`` and ``n_neighbors_estimate``).
+    """
+    if coefficients is None:
+        coefficients = COST_COEFFICIENTS
+    N, D = X.shape
+    if sparse.issparse(X):
+        density = X.nnz / max(1, N * D)
+    else:
+        density = 1.0
+    if radius is None and n_neighbors is None:
+        raise ValueError("Must specify either radius or n_neighbors")
+    k = estimate_n_neighbors(X, radius=radius, n_neighbors=n_neighbors)
+    if max_neighbors is not None:
+        k = min(k, max_neighbors)
+    terms = cost_terms(N, D, k, density)
+
+    costs = dict((method, float(np.dot(coefficients[method], terms)))
+                 for method in _candidate_methods(X, radius, n_neighbors,
+                                                  coefficients, methods,
+                                                  keywords))
+    if not costs:
+        raise ValueError("no calibrated adjacency method can be selected")
+    method = min(sorted(costs), key=costs.get)
+    reason = ("lowest estimated cost ({0:.3g}s) for N={1}, D={2}, "
+              "density={3:.3g} and ~{4:.3g} neighbors per point, among {5}"
+              "".format(costs[method], N, D, density, k,
+                        ", ".join(sorted(costs))))
+    return {'method': method, 'reason': reason, 'costs': costs,
+            'n_samples': N, 'n_features': D, 'density': density,
+            'n_neighbors_estimate': k}
+
+
+def calibrate_cost_model(methods=None, n_samples=(1000, 2000, 4000, 8000),
+                         n_features=(2, 4, 8, 16, 32), n_neighbors=10,
+                         random_state=0):
+    """Fit the cost coefficients of the methods from a micro-benchmark
+
+    Each method computes the kNN graph and a radius graph (at the median
+    distance of the n_neighbors-th neighbor) of uniform data sets of every
+    size and dimension. The coefficients of the terms of each method (see
+    METHOD_TERMS; all terms for other methods) minimize the relative error
+    of the modeled running times.
+
+    Returns
+    -------
+    coefficients : dict
+        The coefficients of each method which ran on every data set, in the
+        format of COST_COEFFICIENTS.
+    """
+    # imported here: the benchmark needs tracemalloc (Python 3.4+)
+    from .benchmark import run_adjacency_benchmark
+    if methods is None:
+        methods = list(adjacency.Adjacency.methods())
+    rng = np.random.RandomState(random_state)
+    timings = dict((method, []) for method in methods)
+    for N in n_samples:
+        for D in n_features:
+            X = rng.rand(N, D)
+            G_knn = adjacency.compute_adjacency_matrix(
+                X, method='brute', n_neighbors=n_neighbors)
+            radius = np.median(G_knn.max(1).toarray())
+            for query in [{'n_neighbors': n_neighbors}, {'radius': radius}]:
+                for method in methods:
+                    result = run_adjacency_benchmark(method, X, **query)
+                    if 'error' in result:
+                        continue
+                    k = result['nnz'] / N
+                    time = result['build_time'] + result['query_time']
+                    timings[method].append((cost_terms(N, D, k), time))
+
+    n_runs = len(n_samples) * len(n_features)
+    coefficients = {}
+    for method, runs in timings.items():
+        if len(runs) < n_runs:
+            continue
+        used = [TERMS.index(term)
+                for term in METHOD_TERMS.get(method, TERMS)]
+        terms = np.array([run[0][used] for run in runs])
+        times = np.array([run[1] for run in runs])
+        # scale the terms to fit the coefficients on comparable columns
+        scale = terms.max(0)
+        coef, _ = nnls(terms / scale / times[:, np.newaxis],
+                       np.ones(len(times)))
+        coefficients[method] = np.zeros(len(TERMS))
+        coefficients[method][used] = coef / scale
+        coefficients[method] = coefficients[method].tolist()
+    return coefficients
@@ -5,22 +5,26 @@ LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
 
 #include "cyflann_index.h"
 
-CyflannIndex::CyflannIndex(const std::vector<float>& dataset, int num_dims) {
-    int num_pts = dataset.size() / num_dims;
-    dataset_ = new float[dataset.size()];
-    std::copy(dataset.begin(), dataset.end(), dataset_);
-    Matrix<float> data(dataset_, num_pts, num_dims);
+#include <algorithm>
+
+#ifdef _OPENMP
+#include <omp.h>
+#else
+#define omp_get_max_threads() 1
+#endif
+
+// The index keeps a pointer to dataset: the caller owns the buffer and must
+// keep it alive for the lifetime of the index.
+CyflannIndex::CyflannIndex(float* dataset, int num_pts, int num_dims) {
+    Matrix<float> data(dataset, num_pts, num_dims);
     // TODO: add support for different distance metric.
     index_ = new Index< L2<float> >(data, KMeansIndexParams());
 }
 
-CyflannIndex::CyflannIndex(const std::vector<float>& dataset, int num_dims,
+CyflannIndex::CyflannIndex(float* dataset, int num_pts, int num_dims,
         std::string index_type, int num_trees, int branching, int iterations,
         float cb_index) {
-    int num_pts = dataset.size() / num_dims;
-    dataset_ = new float[dataset.size()];
-    std::copy(dataset.begin(), dataset.end(), dataset_);
-    Matrix<float> data(dataset_, num_pts, num_dims);
+    Matrix<float> data(dataset, num_pts, num_dims);
     // TODO: wrap all info into a class in the future.
     if (index_type == "kdtrees") {
         index_ = new Index< L2<float> >(data, KDTreeIndexParams(num_trees));
@@ -33,63 +37,124 @@ CyflannIndex::CyflannIndex(const std::vector<float>& dataset, int num_dims,
     }
 }
 
-CyflannIndex::CyflannIndex(const std::vector<float>& dataset, int num_dims,
+CyflannIndex::CyflannIndex(float* dataset, int num_pts, int num_dims,
         float target_precision, float build_weight, float memory_weight,
-        float sample_fraction) {
-    int num_pts = dataset.size() / num_dims;
-    dataset_ = new float[dataset.size()];
-    std::copy(dataset.begin(), dataset.end(), dataset_);
-    Matrix<float> data(dataset_, num_pts, num_dims);
+        float sample_fraction) : dataset_(dataset, num_pts, num_dims) {
     // TODO: add support for different distance metric.
-    index_ = new Index< L2<float> >(data, AutotunedIndexParams(
+    index_ = new Index< L2<float> >(dataset_, AutotunedIndexParams(
             target_precision, build_weight, memory_weight, sample_fraction));
 }
 
-CyflannIndex::CyflannIndex(const std::vector<float>& dataset, int num_dims,
-        std::string filename) {
-    int num_pts = dataset.size() / num_dims;
-    dataset_ = new float[dataset.size()];
-    std::copy(dataset.begin(), dataset.end(), dataset_);
-    Matrix<float> data(dataset_, num_pts, num_dims);
+CyflannIndex::CyflannIndex(float* dataset, int num_pts, int num_dims,
+        std::string filename) : dataset_(dataset, num_pts, num_dims) {
     // TODO: add support for different distance metric.
-    index_ = new Index< L2<float> >(data, SavedIndexParams(filename));
+    index_ = new Index< L2<float> >(dataset_, SavedIndexParams(filename));
+    replaceAutotunedIndex();
 }
 
 CyflannIndex::~CyflannIndex() {
     delete index_;
-    delete[] dataset_;
 }
 
 void CyflannIndex::buildIndex(){
     index_->buildIndex();
+    replaceAutotunedIndex();
+}
+
+// FLANN only forwards the kNN searches of an autotuned index to the index
+// selected by the autotuning: its radius searches find no neighbors. Replace
+// it with an index of the selected type and parameters, built on the same
+// dataset.
+void CyflannIndex::replaceAutotunedIndex() {
+    if (index_->getType() != FLANN_INDEX_AUTOTUNED) {
+        return;
+    }
+    Index< L2<float> >* tuned = new Index< L2<float> >(dataset_,
+        index_->getParameters());
+    tuned->buildIndex();
+    delete index_;
+    index_ = tuned;
+}
+
+// As for the dataset, the index keeps a pointer to points, which the caller
+// must keep alive for the lifetime of the index.
+void CyflannIndex::addPoints(float* points, int num_pts, int num_dims,
+        float rebuild_threshold) {
+    Matrix<float> data(points, num_pts, num_dims);
+    index_->addPoints(data, rebuild_threshold);
 }
 
-int CyflannIndex::knnSearch(const std::vector<float>& queries,
-        std::vector< std::vector<int> >& indices,
-        std::vector< std::vector<float> >& dists,
-        int knn, int num_dims, int num_checks) {
-    int num_pts = queries.size() / num_dims;
-    float* array = new float[queries.size()];
-    std::copy(queries.begin(), queries.end(), array);
-    Matrix<float> qpts(array, num_pts, num_dims);
-    int res = index_->knnSearch(qpts, indices, dists, knn,
-        SearchParams(num_checks));
-    delete[] array;
-    return res;
+void CyflannIndex::removePoint(int point_id) {
+    index_->removePoint(point_id);
 }
 
-int CyflannIndex::radiusSearch(const std::vector<float>& queries,
-        std::vector< std::vector<int> >& indices,
-        std::vector< std::vector<float> >& dists,
-        float radius, int num_dims, int num_checks) {
-    int num_pts = queries.size() / num_dims;
-    float* array = new float[queries.size()];
-    std::copy(queries.begin(), queries.end(), array);
-    Matrix<float> dataset(array, num_pts, num_dims);
-    int res = index_->radiusSearch(dataset, indices, dists, radius,
-        SearchParams(num_checks));
-    delete[] array;
-    return res;
+// cores is the number of OpenMP threads used by the batch search
+// (0 lets FLANN use all available cores).
+SearchParams CyflannIndex::searchParams(int num_checks, int cores) {
+    SearchParams params(num_checks);
+    params.cores = cores;
+    return params;
+}
+
+int CyflannIndex::knnSearch(float* queries, int num_pts, int* indices,
+        float* dists, int knn, int num_dims, int num_checks, int cores) {
+    Matrix<float> qpts(queries, num_pts, num_dims);
+    Matrix<int> indices_mat(indices, num_pts, knn);
+    Matrix<float> dists_mat(dists, num_pts, knn);
+    return index_->knnSearch(qpts, indices_mat, dists_mat, knn,
+        searchParams(num_checks, cores));
+}
+
+// The chunks of queries are searched in parallel, each by a single FLANN
+// call on the thread running it, and their results are flattened into the
+// buffers of the chunk: the per-row vectors returned by FLANN only ever hold
+// one chunk per thread.
+int64_t CyflannIndex::radiusSearch(float* queries, int num_pts,
+        int64_t* counts, RadiusResults& results, float radius, int num_dims,
+        int num_checks, int cores, int max_neighbors) {
+    int num_chunks = (num_pts + RADIUS_CHUNK_SIZE - 1) / RADIUS_CHUNK_SIZE;
+    results.indices.assign(num_chunks, std::vector<int>());
+    results.dists.assign(num_chunks, std::vector<float>());
+    int64_t total = 0;
+#pragma omp parallel num_threads(cores > 0 ? cores : omp_get_max_threads())
+    {
+        SearchParams params = searchParams(num_checks, 1);
+        // FLANN keeps the nearest max_neighbors results (-1: unlimited)
+        params.max_neighbors = max_neighbors > 0 ? max_neighbors : -1;
+        std::vector< std::vector<size_t> > chunk_indices;
+        std::vector< std::vector<float> > chunk_dists;
+#pragma omp for schedule(dynamic) reduction(+:total)
+        for (int chunk = 0; chunk < num_chunks; ++chunk) {
+            int start = chunk * RADIUS_CHUNK_SIZE;
+            int num_chunk = std::min(RADIUS_CHUNK_SIZE, num_pts - start);
+            Matrix<float> qpts(queries + (size_t) start * num_dims, num_chunk,
+                num_dims);
+            index_->radiusSearch(qpts, chunk_indices, chunk_dists, radius,
+                params);
+            std::vector<int>& indices = results.indices[chunk];
+            std::vector<float>& dists = results.dists[chunk];
+            for (int i = 0; i < num_chunk; ++i) {
+                counts[start + i] = chunk_indices[i].size();
+                indices.insert(indices.end(), chunk_indices[i].begin(),
+                    chunk_indices[i].end());
+                dists.insert(dists.end(), chunk_dists[i].begin(),
+                    chunk_dists[i].end());
+            }
+            total += indices.size();
+        }
+    }
+    return total;
+}
+
+void RadiusResults::copyTo(int* indices_out, float* dists_out) {
+    for (size_t chunk = 0; chunk < indices.size(); ++chunk) {
+        std::copy(indices[chunk].begin(), indices[chunk].end(), indices_out);
+        std::copy(dists[chunk].begin(), dists[chunk].end(), dists_out);
+        indices_out += indices[chunk].size();
+        dists_out += dists[chunk].size();
+        std::vector<int>().swap(indices[chunk]);
+        std::vector<float>().swap(dists[chunk]);
+    }
 }
 
 void CyflannIndex::save(std::string filename) {
@@ -6,38 +6,65 @@ LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
 #define CYFLANN_INDEX_H_
 
 #include <flann/flann.hpp>
+#include <stdint.h>
 #include <vector>
 using namespace flann;
 
+// The neighbors found by CyflannIndex::radiusSearch, in one pair of buffers
+// per chunk of consecutive queries.
+class RadiusResults {
+public:
+    // Copies the neighbors of the chunks, in order, to the flat arrays
+    // indices and dists, freeing each chunk once it is copied.
+    void copyTo(int* indices, float* dists);
+
+    std::vector< std::vector<int> > indices;
+    std::vector< std::vector<float> > dists;
+};
+
 class CyflannIndex {
 public:
 
-    CyflannIndex(const std::vector<float>& dataset, int num_dims);
+    // dataset is a C-contiguous (num_pts, num_dims) buffer owned by the
+    // caller. It is not copied.
+    CyflannIndex(float* dataset, int num_pts, int num_dims);
 
-    CyflannIndex(const std::vector<float>& dataset, int num_dims,
+    CyflannIndex(float* dataset, int num_pts, int num_dims,
         std::string index_type, int num_trees, int branching, int iterations,
         float cb_index);
 
-    CyflannIndex(const std::vector<float>& dataset, int num_dims,
+    CyflannIndex(float* dataset, int num_pts, int num_dims,
             float target_precision, float build_weight, float memory_weight,
             float sample_fraction);
 
-    CyflannIndex(const std::vector<float>& dataset, int num_dims,
+    CyflannIndex(float* dataset, int num_pts, int num_dims,
             std::string filename);
 
     ~CyflannIndex();
 
     void buildIndex();
 
-    int knnSearch(const std::vector<float>& queries,
-            std::vector< std::vector<int> >& indices,
-            std::vector< std::vector<float> >& dists,
-            int knn, int num_dims, int num_checks);
+    void addPoints(float* points, int num_pts, int num_dims,
+            float rebuild_threshold);
+
+    void removePoint(int point_id);
 
-    int radiusSearch(const std::vector<float>& queries,
-            std::vector< std::vector<int> >& indices,
-            std::vector< std::vector<float> >& dists,
-            float radius, int num_dims, int num_checks);
+    // Writes the knn of each query into the (num_pts, knn) buffers indices
+    // and dists. Entries are left untouched for queries with fewer than knn
+    // neighbors found.
+    int knnSearch(float* queries, int num_pts, int* indices, float* dists,
+            int knn, int num_dims, int num_checks, int cores);
+
+    // Searches the neighbors within the radius of each query, in chunks of
+    // RADIUS_CHUNK_SIZE queries distributed over cores OpenMP threads. The
+    // number of neighbors of each query is written to the num_pts buffer
+    // counts, and the neighbors of each chunk are appended to their own
+    // buffers of results. If max_neighbors > 0, only the nearest
+    // max_neighbors neighbors within the radius are kept, during the search.
+    // Returns the total number of neighbors.
+    int64_t radiusSearch(float* queries, int num_pts, int64_t* counts,
+            RadiusResults& results, float radius, int num_dims,
+            int num_checks, int cores, int max_neighbors);
 
     void save(std::string filename);
 
@@ -46,7 +73,15 @@ public:
     int size();
 
 private:
-    float* dataset_;
+    static const int RADIUS_CHUNK_SIZE = 1024;
+
+    SearchParams searchParams(int num_checks, int cores);
+
+    void replaceAutotunedIndex();
+
+    // the dataset of the autotuned and loaded indexes, from which an
+    // autotuned index is rebuilt
+    Matrix<float> dataset_;
     Index< L2<float> >* index_;
 };
 
@@ -5,32 +5,40 @@ from __future__ import division
 import cython
 import numpy as np
 cimport numpy as np
-from libcpp.vector cimport vector
+from libc.stdint cimport int64_t
 from libcpp.string cimport string
 
 ctypedef np.float32_t dtype_t
 ctypedef np.int32_t dtypei_t
 
 cdef extern from "cyflann_index.h":
+    cdef cppclass RadiusResults:
+        RadiusResults()
+        void copyTo(dtypei_t* indices, dtype_t* dists) nogil
+
     cdef cppclass CyflannIndex:
-        CyflannIndex(const vector[dtype_t]& dataset, dtypei_t ndim) except +
-        CyflannIndex(const vector[dtype_t]& dataset, dtypei_t num_dims,
+        CyflannIndex(dtype_t* dataset, dtypei_t num_pts,
+                dtypei_t ndim) except +
+        CyflannIndex(dtype_t* dataset, dtypei_t num_pts, dtypei_t num_dims,
                 string index_type, dtypei_t num_trees, dtypei_t branching,
                 dtypei_t iterations, dtype_t cb_index)
-        CyflannIndex(const vector[dtype_t]& dataset, dtypei_t ndim,
+        CyflannIndex(dtype_t* dataset, dtypei_t num_pts, dtypei_t ndim,
                 dtype_t target_precision, dtype_t build_weight,
                 dtype_t memory_weight, dtype_t sample_fraction)
-        CyflannIndex(const vector[dtype_t]& dataset, dtypei_t ndim,
+        CyflannIndex(dtype_t* dataset, dtypei_t num_pts, dtypei_t ndim,
                 string filename)
         void buildIndex()
-        int knnSearch(const vector[dtype_t]& queries,
-            vector[vector[dtypei_t]]& indices,
-            vector[vector[dtype_t]]& dists,
-            dtypei_t knn, dtypei_t num_dims, dtypei_t num_checks)
-        int radiusSearch(const vector[dtype_t]& queries,
-            vector[vector[dtypei_t]]& indices,
-            vector[vector[dtype_t]]& dists,
-            dtype_t radius, dtypei_t num_dims, dtypei_t num_checks)
+        void addPoints(dtype_t* points, dtypei_t num_pts, dtypei_t num_dims,
+                dtype_t rebuild_threshold) except +
+        void removePoint(dtypei_t point_id) except +
+        int knnSearch(dtype_t* queries, dtypei_t num_pts,
+            dtypei_t* indices, dtype_t* dists,
+            dtypei_t knn, dtypei_t num_dims, dtypei_t num_checks,
+            dtypei_t cores) nogil
+        int64_t radiusSearch(dtype_t* queries, dtypei_t num_pts,
+            int64_t* counts, RadiusResults& results, dtype_t radius,
+            dtypei_t num_dims, dtypei_t num_checks, dtypei_t cores,
+            dtypei_t max_neighbors) nogil
         void save(string filename)
         int veclen()
         int size()
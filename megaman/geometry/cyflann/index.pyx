@@ -4,18 +4,62 @@
 # LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
 
 from __future__ import division
+import multiprocessing
 from scipy import sparse
 import numpy as np
 cimport numpy as np
+from libc.stdint cimport int64_t
 from index cimport *
 
+np.import_array()
+
+
+def _get_cores(n_jobs):
+    """
+    Converts the n_jobs convention (-1 means all cores, -2 all but one, ...)
+    to the number of cores passed to FLANN (0 means all cores).
+    """
+    if n_jobs == 0:
+        raise ValueError('n_jobs must not be 0.')
+    if n_jobs == -1:
+        return 0
+    if n_jobs < 0:
+        return max(multiprocessing.cpu_count() + 1 + n_jobs, 1)
+    return n_jobs
+
+
+def _to_bytes(filename):
+    if isinstance(filename, bytes):
+        return filename
+    return filename.encode('utf-8')
+
+
+def _as_float32(X):
+    """
+    Returns X as a C-contiguous float32 array. Arrays which already satisfy
+    this (including np.memmap) are returned as is, without a copy.
+    """
+    X = np.require(X, dtype=np.float32, requirements=['C', 'A'])
+    if X.ndim != 2:
+        raise ValueError('expected a 2 dimensional array.')
+    return X
+
+
 cdef class Index:
     """
     Wrapper for flann c++ index class
     """
     cdef CyflannIndex* _thisptr      # hold a C++ instance which we're wrapping
+    # FLANN indexes the dataset buffers in place, so keep them alive here:
+    # the initial dataset followed by the points added with add_points
+    cdef list _datasets
+    # whether the index is ready for queries (built or loaded from a file)
+    cdef readonly bint built
+    # number of point ids assigned so far, including removed points. This is
+    # the number of columns of the neighbors graphs.
+    cdef readonly int n_ids
 
-    def __cinit__(self, np.ndarray[double, ndim=2] dataset,
+    def __cinit__(self, dataset,
             target_precision=None, saved_index=None, index_type=None,
             num_trees=4, branching=32, iterations=11, cb_index=0.2,
             build_weight=0.01, memory_weight=0, sample_fraction=0.1):
@@ -27,24 +71,32 @@ cdef class Index:
         kdtrees has parameters: num_trees
         kmeans has parameters: branching, iterations, cb_index
         composite combines kdtrees and kmeans
+
+        C-contiguous float32 datasets (e.g. np.memmap) are indexed without
+        being copied; other datasets are converted to float32 once.
         """
+        dataset = _as_float32(dataset)
+        self._datasets = [dataset]
+        cdef dtype_t* data_ptr = <dtype_t*> np.PyArray_DATA(dataset)
+        cdef int npts = dataset.shape[0]
+        cdef int ndim = dataset.shape[1]
+        self.n_ids = npts
         if target_precision is not None:
-            self._thisptr = new CyflannIndex(dataset.flatten(),
-                    dataset.shape[1], target_precision, build_weight,
-                    memory_weight, sample_fraction)
+            self._thisptr = new CyflannIndex(data_ptr, npts, ndim,
+                    target_precision, build_weight, memory_weight,
+                    sample_fraction)
         elif saved_index is not None:
             # setting the target precision is purely a way to get arround
             # function overloading. I cannot get it to work without it.
-            self._thisptr = new CyflannIndex(dataset.flatten(),
-                    dataset.shape[1], saved_index)
+            self._thisptr = new CyflannIndex(data_ptr, npts, ndim,
+                    _to_bytes(saved_index))
+            self.built = True
         elif index_type is not None:
             index_type = index_type.encode('utf-8')
-            self._thisptr = new CyflannIndex(dataset.flatten(),
-                    dataset.shape[1], index_type, num_trees, branching,
-                    iterations, cb_index)
+            self._thisptr = new CyflannIndex(data_ptr, npts, ndim,
+                    index_type, num_trees, branching, iterations, cb_index)
         else:
-            self._thisptr = new CyflannIndex(dataset.flatten(),
-                    dataset.shape[1])
+            self._thisptr = new CyflannIndex(data_ptr, npts, ndim)
 
     def __dealloc__(self):
         del self._thisptr
@@ -54,38 +106,91 @@ cdef class Index:
         Builds a index of the data for future queries.
         """
         self._thisptr.buildIndex()
+        self.built = True
 
-    def knn_neighbors_graph(self, np.ndarray[double, ndim=2] X, int knn,
-            int num_checks=48):
+    @property
+    def dataset(self):
+        """
+        The indexed data, including added (and later removed) points. Row i
+        is the point with id i.
+        """
+        if len(self._datasets) == 1:
+            return self._datasets[0]
+        return np.concatenate(self._datasets)
+
+    def add_points(self, X, float rebuild_threshold=2):
+        """
+        Adds the rows of X to the built index, with ids n_ids, n_ids + 1, ...
+        The whole index is rebuilt once it has grown by more than a factor
+        rebuild_threshold since it was last built; otherwise the points are
+        inserted into the existing index.
+        """
+        if not self.built:
+            raise ValueError('the index must be built before adding points.')
+        X = _as_float32(X)
+        if X.shape[1] != self._thisptr.veclen():
+            raise ValueError('points must have the same number of features '
+                             'as the indexed dataset.')
+        if X.shape[0] == 0:
+            return
+        self._datasets.append(X)
+        self._thisptr.addPoints(<dtype_t*> np.PyArray_DATA(X), X.shape[0],
+                X.shape[1], rebuild_threshold)
+        self.n_ids += X.shape[0]
+
+    def remove_point(self, int point_id):
+        """
+        Removes the point with id point_id from the search results. Ids of
+        the other points are unchanged.
+        """
+        if point_id < 0 or point_id >= self.n_ids:
+            raise ValueError('point_id out of range.')
+        self._thisptr.removePoint(point_id)
+
+    def knn_neighbors_graph(self, X, int knn,
+            int num_checks=48, int n_jobs=1, bint squared=False):
+        """
+        Constructs a sparse k nearest neighbors distance matrix in csr format.
+        n_jobs is the number of threads used by the FLANN batch search (-1
+        means all cores); the GIL is released during the search. With
+        squared=True the matrix holds the squared distances computed by
+        FLANN, without taking their square roots.
+        """
         if knn < 1:
             raise ValueError('neighbors_radius must be >=0.')
-        cdef int nsam, ndim
+        cdef int nsam, ndim, res
+        cdef int cores = _get_cores(n_jobs)
+        X = _as_float32(X) # required for FLANN
         nsam = X.shape[0]
         ndim = X.shape[1]
-        X = np.require(X, requirements = ['A', 'C']) # required for FLANN
-        cdef vector[vector[dtypei_t]] indices;
-        cdef vector[vector[dtype_t]] dists;
-        cdef int res = self._thisptr.knnSearch(X.flatten(), indices, dists,
-                knn, ndim, num_checks)
-        lengths = [len(nghbr_idx) for nghbr_idx in indices]
-        indpts = list(np.cumsum(lengths))
-        indpts.insert(0,0)
-        indpts = np.array(indpts)
-        # aparrently cython does not support iterating over vector withh
-        # size = 1
-        cdef np.ndarray[dtype_t, ndim=1] data = np.zeros(res, dtype=np.float32)
-        cdef np.ndarray[dtypei_t, ndim=1] indices_list = np.zeros(
-                res, dtype=np.int32)
-        self.fillDataAndIndices(data, indices_list, dists, indices)
-        # self.size() is slower than self._thisptr.size(). def methods are
-        # are usually quite a bit slower than cdef methods.
-        graph = sparse.csr_matrix((data, indices_list, indpts), shape = (nsam,
-                                  self._thisptr.size()))
-        graph.data = np.sqrt(graph.data) # FLANN returns squared distance
-        return graph
+        if ndim != self._thisptr.veclen():
+            raise ValueError('queries must have the same number of features '
+                             'as the indexed dataset.')
+        cdef dtype_t* queries = <dtype_t*> np.PyArray_DATA(X)
+        # FLANN writes the results straight into the CSR arrays
+        cdef np.ndarray indices = np.empty((nsam, knn), dtype=np.int32)
+        cdef np.ndarray dists = np.empty((nsam, knn), dtype=np.float32)
+        indices.fill(-1)
+        cdef dtypei_t* indices_ptr = <dtypei_t*> np.PyArray_DATA(indices)
+        cdef dtype_t* dists_ptr = <dtype_t*> np.PyArray_DATA(dists)
+        with nogil:
+            res = self._thisptr.knnSearch(queries, nsam, indices_ptr,
+                    dists_ptr, knn, ndim, num_checks, cores)
+        if res == <int64_t> nsam * knn:
+            indptr = knn * np.arange(nsam + 1, dtype=np.int64)
+            return self._distance_graph(dists.ravel(), indices.ravel(),
+                                        indptr, nsam, squared)
+        # some queries have fewer than knn neighbors: the missing ones are
+        # left as -1 at the end of their rows
+        found = indices >= 0
+        indptr = np.zeros(nsam + 1, dtype=np.int64)
+        np.cumsum(found.sum(1), out=indptr[1:])
+        return self._distance_graph(dists[found], indices[found], indptr,
+                                    nsam, squared)
 
-    def radius_neighbors_graph(self, np.ndarray[double, ndim=2] X,
-            float radius, int num_checks=32):
+    def radius_neighbors_graph(self, X,
+            float radius, int num_checks=32, int n_jobs=1,
+            int max_neighbors=-1, bint squared=False):
         """
         Constructs a sparse distance matrix called graph in csr
         format.
@@ -103,6 +208,13 @@ cdef class Index:
         num_checks: specifying the number of times the tree(s) in the index
             should be recursively traversed. A higher value for this parameter
             would give better search precision, but also take more time.
+        n_jobs: the number of threads used by the FLANN batch search. -1
+            means using all cores. The GIL is released during the search.
+        max_neighbors: if positive, each row holds at most the
+            max_neighbors nearest neighbors within radius. The cap is
+            applied by the FLANN search itself.
+        squared: if True, the matrix holds the squared distances computed
+            by FLANN, without taking their square roots.
 
         Returns
         -------
@@ -118,35 +230,49 @@ cdef class Index:
             raise ValueError('neighbors_radius must be >=0.')
         radius *= radius
         cdef int nsam, ndim
+        cdef int64_t nnz
+        cdef int cores = _get_cores(n_jobs)
+        X = _as_float32(X) # required for FLANN
         nsam = X.shape[0]
         ndim = X.shape[1]
-        X = np.require(X, requirements = ['A', 'C']) # required for FLANN
-        cdef vector[vector[dtypei_t]] indices;
-        cdef vector[vector[dtype_t]] dists;
-        cdef int res = self._thisptr.radiusSearch(X.flatten(), indices, dists,
-                radius, ndim, num_checks)
-        lengths = [len(nghbr_idx) for nghbr_idx in indices]
-        indpts = list(np.cumsum(lengths))
-        indpts.insert(0,0)
-        indpts = np.array(indpts)
-        # aparrently cython does not support iterating over vector withh
-        # size = 1
-        cdef np.ndarray[dtype_t, ndim=1] data = np.zeros(res, dtype=np.float32)
-        cdef np.ndarray[dtypei_t, ndim=1] indices_list = np.zeros(
-                res, dtype=np.int32)
-        self.fillDataAndIndices(data, indices_list, dists, indices)
-        # self.size() is slower than self._thisptr.size(). def methods are
-        # are usually quite a bit slower than cdef methods.
-        graph = sparse.csr_matrix((data, indices_list, indpts), shape = (nsam,
-                                  self._thisptr.size()))
-        graph.data = np.sqrt(graph.data) # FLANN returns squared distance
+        if ndim != self._thisptr.veclen():
+            raise ValueError('queries must have the same number of features '
+                             'as the indexed dataset.')
+        cdef dtype_t* queries = <dtype_t*> np.PyArray_DATA(X)
+        # FLANN searches chunks of queries into buffers of their own, which
+        # are then copied once into the CSR arrays
+        cdef RadiusResults results
+        cdef np.ndarray counts = np.empty(nsam, dtype=np.int64)
+        cdef int64_t* counts_ptr = <int64_t*> np.PyArray_DATA(counts)
+        with nogil:
+            nnz = self._thisptr.radiusSearch(queries, nsam, counts_ptr,
+                    results, radius, ndim, num_checks, cores, max_neighbors)
+        indptr = np.zeros(nsam + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        cdef np.ndarray indices = np.empty(nnz, dtype=np.int32)
+        cdef np.ndarray dists = np.empty(nnz, dtype=np.float32)
+        cdef dtypei_t* indices_ptr = <dtypei_t*> np.PyArray_DATA(indices)
+        cdef dtype_t* dists_ptr = <dtype_t*> np.PyArray_DATA(dists)
+        with nogil:
+            results.copyTo(indices_ptr, dists_ptr)
+        return self._distance_graph(dists, indices, indptr, nsam, squared)
+
+    def _distance_graph(self, data, indices, indptr, int nsam,
+                        bint squared=False):
+        graph = sparse.csr_matrix((data, indices, indptr), shape = (nsam,
+                                  self.n_ids))
+        if not squared:
+            np.sqrt(graph.data, out=graph.data) # FLANN returns squared distance
         return graph
 
-    def save(self, string filename):
+    def save(self, filename):
         """
-        Saves the index to a file.
+        Saves the index to a file. The dataset is not saved: pass the same
+        dataset and saved_index=filename to reload the index.
         """
-        self._thisptr.save(filename)
+        if not self.built:
+            raise ValueError('the index must be built before being saved.')
+        self._thisptr.save(_to_bytes(filename))
 
     def veclen(self):
         """
@@ -160,14 +286,3 @@ cdef class Index:
         """
         return self._thisptr.size()
 
-    cdef void fillDataAndIndices(self, np.ndarray[dtype_t, ndim=1] data,
-                            np.ndarray[dtypei_t, ndim=1] indices_list,
-                            vector[vector[dtype_t]] dists,
-                            vector[vector[dtypei_t]] indices):
-        cdef int i, j, k
-        k = 0
-        for i in xrange(indices.size()):
-            for j in xrange(indices[i].size()):
-                data[k] = dists[i][j]
-                indices_list[k] = indices[i][j]
-                k += 1
@@ -17,6 +17,12 @@ def configuration(parent_package='', top_path=None):
         libraries.append('m')
 
     kwds = {}
+    extra_compile_args = ["-O3"]
+    extra_link_args = []
+    if platform.system() != 'Darwin':
+        # FLANN runs multi-core batch searches through OpenMP
+        extra_compile_args.append('-fopenmp')
+        extra_link_args.append('-fopenmp')
     flann_include = os.path.join(FLANN_ROOT, 'include')
     flann_lib = os.path.join(FLANN_ROOT, 'lib')
 
@@ -29,7 +35,7 @@ def configuration(parent_package='', top_path=None):
 
         # from http://stackoverflow.com/questions/19123623/python-runtime-library-dirs-doesnt-work-on-mac
         if platform.system() == 'Darwin':
-            kwds['extra_link_args'] = ['-Wl,-rpath,'+flann_lib]
+            extra_link_args.append('-Wl,-rpath,'+flann_lib)
         kwds['runtime_library_dirs'] = [flann_lib]
 
     config.add_extension("index",
@@ -37,7 +43,8 @@ def configuration(parent_package='', top_path=None):
            include_dirs=[numpy.get_include(), flann_include],
            libraries=libraries,
            library_dirs=[flann_lib],
-           extra_compile_args=["-O3"],
+           extra_compile_args=extra_compile_args,
+           extra_link_args=extra_link_args,
            **kwds)
 
     return config
@@ -14,12 +14,19 @@ adjacency matrix produced is NOT GUARANTEED to be symmetric and
 adjacency_matrix. adjacency_matrix has 0.0 on the diagonal,
 as it should. Implicitly, the missing entries are infinity not
 0 for this matrix. But (1) and (2) mean that if one tries to
-symmetrize adjacency_matrix, the scipy.sparse code eliminates
-the 0.0 entries from adjacency_matrix hence in the affinity
-matrix we explicitly set the diagonal to 1.0 for sparse matrices.
+symmetrize adjacency_matrix with 0.5 * (A + A.T), the scipy.sparse
+code eliminates the 0.0 entries from adjacency_matrix; utils.symmetrize
+merges A and A.T keeping them. In the affinity matrix we still
+explicitly set the diagonal to 1.0 for sparse matrices.
 
 We adopted the following convention:
-   * adjacency_matrix will NOT BE GUARANTEED symmetric
+   * adjacency_matrix will NOT BE GUARANTEED symmetric, except for the
+     radius graphs of the exact self-join methods ('blocked_brute',
+     'ckdtree'), which are flagged as symmetric (see utils.flag_symmetric);
+     radius graphs capped at max_neighbors are never flagged
+   * affinity and laplacian symmetrize with utils.symmetrize (rules
+     'average', the default, 'max' or 'min'), and skip their
+     symmetrization on flagged or already symmetric inputs
    * affinity_matrix will perform a symmetrization by default
    * laplacian performs symmetrization 
      only if symmetrize_input=True (the default setting), and DOES NOT check symmetry
@@ -33,9 +40,12 @@ from __future__ import division ## removes integer division
 import numpy as np
 from scipy import sparse
 from scipy.special import gammaln
-from .adjacency import compute_adjacency_matrix
-from .affinity import compute_affinity_matrix
-from .laplacian import compute_laplacian_matrix
+from .adjacency import Adjacency, CyFLANNAdjacency, index_query_methods
+from .cost_model import select_adjacency_method
+from .affinity import Affinity, GaussianAffinity
+from .laplacian import Laplacian, compute_laplacian_matrix
+from .out_of_core import write_adjacency_shards, load_adjacency_shards
+from .utils import narrow_dtype
 from ..utils.validation import check_array
 
 sparse_formats = ['csr', 'coo', 'lil', 'bsr', 'dok', 'dia']
@@ -54,14 +64,14 @@ class Geometry(object):
 
     Parameters
     ----------
-    adjacency_method : string {'auto', 'brute', 'pyflann', 'cyflann'}
+    adjacency_method : string {'auto', 'brute', 'blocked_brute', 'ckdtree', 'hnsw', 'lsh', 'pyflann', 'cyflann'}
         method for computing pairwise radius neighbors graph.
     adjacency_kwds : dict
         dictionary containing keyword arguments for adjacency matrix.
         see distance.py docmuentation for arguments for each method.
         If new kwargs are passed to compute_adjacency_matrix then this
         dictionary will be updated.
-    affinity_method : string {'auto', 'gaussian'}
+    affinity_method : string {'auto', 'gaussian', 'self_tuning'}
         method of computing affinity matrix
     affinity_kwds : dict
         dictionary containing keyword arguments for affinity matrix.
@@ -77,16 +87,54 @@ class Geometry(object):
         see laplacian.py docmuentation for arguments for each method.
         If new kwargs are passed to compute_laplacian_matrix then this
         dictionary will be updated.
+    flann_index : cyflann Index (optional)
+        a neighbor index over the data matrix. With adjacency_method='cyflann'
+        the index is built on the first adjacency computation and kept, so
+        that further adjacency computations (e.g. with a different radius)
+        and SpectralEmbedding.predict reuse it. See also `save_index` and
+        `load_index`.
+    dtype : numpy float dtype (default: np.float64)
+        precision of the computations. The data matrix is cast to dtype
+        (once, without copy if it already has that dtype) for the adjacency
+        computation, adjacency matrices are stored with at most this
+        precision (cyflann and hnsw compute float32 distances), and the
+        affinity and Laplacian matrices are computed in dtype. With
+        np.float32 the whole pipeline, including the eigensolver of the
+        spectral embedding, runs in single precision with half the memory.
+    fuse_affinity : bool (default: False)
+        if True, a gaussian affinity matrix computed without an adjacency
+        matrix is computed directly by the adjacency method, which emits the
+        affinities exp(-d^2 / r^2) of the neighbors it finds (see the
+        'gaussian' mode of Adjacency). This skips the square roots of the
+        squared distances of the search, squaring them again, and a copy of
+        the graph. The adjacency matrix is then not stored:
+        compute_adjacency_matrix computes it on request.
+    inplace_affinity : bool (default: False)
+        if True, compute_affinity_matrix transforms the adjacency matrix
+        into the affinity matrix in place, instead of copying it, and
+        deletes the adjacency matrix. The diagonal is reserved in the
+        matrix (see utils.reserve_diagonal) and matrices with a symmetric
+        structure, e.g. radius graphs, are symmetrized in their data, so
+        that only the transpose is allocated besides the adjacency matrix.
     **kwargs :
         additional arguments will be parsed and used to override values in
         the above dictionaries. For example:
         - `affinity_radius` will override `affinity_kwds['radius']`
         - `adjacency_n_neighbors` will override `adjacency_kwds['n_neighbors']`
         etc.
+
+    Attributes
+    ----------
+    adjacency_selection : dict or None
+        with adjacency_method='auto', the method used by the last adjacency
+        computation and the reason it was chosen (see
+        cost_model.select_adjacency_method).
     """
     def __init__(self, adjacency_method='auto', adjacency_kwds=None,
                  affinity_method='auto', affinity_kwds=None,
-                 laplacian_method='auto',laplacian_kwds=None, **kwargs):
+                 laplacian_method='auto',laplacian_kwds=None,
+                 flann_index=None, dtype=np.float64, fuse_affinity=False,
+                 inplace_affinity=False, **kwargs):
         self.adjacency_method = adjacency_method
         self.adjacency_kwds = dict(**(adjacency_kwds or {}))
         self.affinity_method = affinity_method
@@ -110,6 +158,14 @@ class Geometry(object):
         self.laplacian_matrix = None
         self.laplacian_symmetric = None
         self.laplacian_weights = None
+        self.flann_index = flann_index
+        # whether flann_index was built by this geometry over self.X, rather
+        # than supplied (on construction, in adjacency_kwds or by load_index)
+        self._flann_index_built = False
+        self.adjacency_selection = None
+        self.dtype = np.dtype(dtype)
+        self.fuse_affinity = fuse_affinity
+        self.inplace_affinity = inplace_affinity
 
     def set_radius(self, radius, override=True, X=None, n_components=2):
         """Set the radius for the adjacency and affinity computation
@@ -171,16 +227,100 @@ class Geometry(object):
         if self.X is None:
             raise ValueError(distance_error_msg)
 
-        kwds = self.adjacency_kwds.copy()
-        kwds.update(kwargs)
-        self.adjacency_matrix = compute_adjacency_matrix(self.X,
-                                                         self.adjacency_method,
-                                                         **kwds)
+        self.adjacency_matrix = self._adjacency_graph(**kwargs)
         if copy:
             return self.adjacency_matrix.copy()
         else:
             return self.adjacency_matrix
 
+    def _adjacency_graph(self, **kwargs):
+        """Compute the adjacency graph of X, with the adjacency keywords
+        updated by kwargs"""
+        kwds = self.adjacency_kwds.copy()
+        kwds.update(kwargs)
+        adjacency = Adjacency.init(self._resolve_adjacency_method(kwds), **kwds)
+        builds_index = self._share_flann_index(adjacency)
+        graph = narrow_dtype(adjacency.adjacency_graph(
+            self.X.astype(self.dtype, copy=False)), self.dtype)
+        self._keep_flann_index(adjacency, builds_index)
+        return graph
+
+    def _resolve_adjacency_method(self, kwds, methods=None):
+        """Return the adjacency method, selecting it among methods if 'auto'
+
+        The selection is recorded in self.adjacency_selection.
+        """
+        method = self.adjacency_method
+        if method == 'auto':
+            if self.flann_index is not None:
+                self.adjacency_selection = {
+                    'method': 'cyflann',
+                    'reason': "reuse the FLANN index of the Geometry"}
+            else:
+                self.adjacency_selection = select_adjacency_method(
+                    self.X, radius=kwds.get('radius'),
+                    n_neighbors=kwds.get('n_neighbors'),
+                    max_neighbors=kwds.get('max_neighbors'),
+                    methods=methods, keywords=kwds)
+            method = self.adjacency_selection['method']
+        return method
+
+    def _share_flann_index(self, adjacency):
+        """Pass the kept neighbor index to a cyflann adjacency
+
+        Returns True if the adjacency will build a new index.
+        """
+        if not isinstance(adjacency, CyFLANNAdjacency):
+            return False
+        if adjacency.flann_index is None:
+            adjacency.flann_index = self.flann_index
+        return adjacency.flann_index is None
+
+    def _keep_flann_index(self, adjacency, built):
+        """Keep the neighbor index used by a cyflann adjacency"""
+        if (isinstance(adjacency, CyFLANNAdjacency) and
+                adjacency.flann_index is not self.flann_index):
+            self.flann_index = adjacency.flann_index
+            self._flann_index_built = built
+
+    def compute_adjacency_shards(self, directory, block_size=4096, **kwargs):
+        """
+        Compute the adjacency matrix out of core, into CSR shards on disk.
+
+        The data matrix is not copied: it may be an np.memmap (ideally
+        float32 and C-contiguous, which the cyflann index uses directly). The
+        neighbor index is built once and queried one block of rows at a
+        time; each block of rows is written to its own shard. The result is
+        not stored in self.adjacency_matrix.
+
+        Parameters
+        ----------
+        directory : string
+            directory in which the shards are written.
+        block_size : int
+            number of rows per shard.
+        **kwargs : see distance.py docmuentation for arguments for each method.
+
+        Returns
+        -------
+        shards : list of sparse matrices
+            the memory-mapped row blocks of the adjacency matrix, see
+            out_of_core.load_adjacency_shards.
+        """
+        if self.X is None:
+            raise ValueError(distance_error_msg)
+
+        kwds = self.adjacency_kwds.copy()
+        kwds.update(kwargs)
+        method = self._resolve_adjacency_method(kwds,
+                                                methods=index_query_methods())
+        adjacency = Adjacency.init(method, **kwds)
+        builds_index = self._share_flann_index(adjacency)
+        write_adjacency_shards(adjacency, self.X, directory,
+                               block_size=block_size)
+        self._keep_flann_index(adjacency, builds_index)
+        return load_adjacency_shards(directory)
+
     def compute_affinity_matrix(self, copy=False, **kwargs):
         """
         This function will compute the affinity matrix. In order to
@@ -200,19 +340,96 @@ class Geometry(object):
             contains the pairwise affinity values using the Guassian kernel
             and bandwidth equal to the affinity_radius
         """
-        if self.adjacency_matrix is None:
-            self.compute_adjacency_matrix()
-
-        kwds = self.affinity_kwds.copy()
+        kwds = {'dtype': self.dtype}
+        kwds.update(self.affinity_kwds)
         kwds.update(kwargs)
-        self.affinity_matrix = compute_affinity_matrix(self.adjacency_matrix,
-                                                       self.affinity_method,
-                                                       **kwds)
+        method = self.affinity_method
+        if method == 'auto':
+            method = 'gaussian'
+        affinity = Affinity.init(method, **kwds)
+
+        if (self.fuse_affinity and self.adjacency_matrix is None and
+                isinstance(affinity, GaussianAffinity)):
+            if self.X is None:
+                raise ValueError(distance_error_msg)
+            # the graph computed by the adjacency method is not shared
+            graph = self._adjacency_graph(mode='gaussian',
+                                          affinity_radius=affinity.radius)
+            self.affinity_matrix = affinity.affinity_matrix(
+                graph, input_type='gaussian', copy=False)
+        else:
+            if self.adjacency_matrix is None:
+                self.compute_adjacency_matrix()
+            self.affinity_matrix = affinity.affinity_matrix(
+                self.adjacency_matrix, copy=not self.inplace_affinity)
+            if self.inplace_affinity:
+                # the adjacency matrix now holds the affinities
+                self.adjacency_matrix = None
         if copy:
             return self.affinity_matrix.copy()
         else:
             return self.affinity_matrix
 
+    def compute_affinity_matrices(self, radii, **kwargs):
+        """
+        Compute the affinity matrices of several radii (a bandwidth sweep)
+        from the adjacency matrix, which is validated and symmetrized once.
+        self.affinity_matrix is not changed.
+
+        Parameters
+        ----------
+        radii : list of floats
+            the affinity radii.
+        **kwargs :
+            see affinity.py documentation for arguments for each method.
+
+        Returns
+        -------
+        affinity_matrices : list of sparse matrices (N_obs, N_obs)
+            the affinity matrix of each radius, sharing one sparsity
+            structure (see Affinity.affinity_matrices).
+        """
+        kwds = {'dtype': self.dtype}
+        kwds.update(self.affinity_kwds)
+        kwds.update(kwargs)
+        kwds['radius'] = radii[0]
+        method = self.affinity_method
+        if method == 'auto':
+            method = 'gaussian'
+        if self.adjacency_matrix is None:
+            self.compute_adjacency_matrix()
+        affinity = Affinity.init(method, **kwds)
+        return affinity.affinity_matrices(self.adjacency_matrix, radii)
+
+    def compute_laplacian_matrices(self, radii, **kwargs):
+        """
+        Compute the laplacian matrices of the affinity matrices of several
+        radii (see compute_affinity_matrices). Each laplacian is computed
+        in the data of its affinity matrix, without copy.
+        self.laplacian_matrix is not changed.
+
+        Parameters
+        ----------
+        radii : list of floats
+            the affinity radii.
+        **kwargs :
+            see laplacian.py documentation for arguments for each method.
+
+        Returns
+        -------
+        laplacian_matrices : list of sparse matrices (N_obs, N_obs)
+            the laplacian matrix of each radius.
+        """
+        kwds = {'dtype': self.dtype}
+        kwds.update(self.laplacian_kwds)
+        kwds.update(kwargs)
+        method = self.laplacian_method
+        if method == 'auto':
+            method = 'geometric'
+        laplacian = Laplacian.init(method, **kwds)
+        return [laplacian.laplacian_matrix(affinity_matrix, copy=False)
+                for affinity_matrix in self.compute_affinity_matrices(radii)]
+
     def compute_laplacian_matrix(self, copy=True, return_lapsym=False, **kwargs):
         """
         Note: this function will compute the laplacian matrix. In order to acquire
@@ -239,7 +456,8 @@ class Geometry(object):
         if self.affinity_matrix is None:
             self.compute_affinity_matrix()
 
-        kwds = self.laplacian_kwds.copy()
+        kwds = {'dtype': self.dtype}
+        kwds.update(self.laplacian_kwds)
         kwds.update(kwargs)
         kwds['full_output'] = return_lapsym
         result = compute_laplacian_matrix(self.affinity_matrix,
@@ -257,16 +475,125 @@ class Geometry(object):
         else:
             return self.laplacian_matrix
 
+    def compute_laplacian_operator(self, symmetrized=False, shift=None,
+                                   **kwargs):
+        """
+        Return the laplacian of the affinity matrix as a matrix-free
+        LinearOperator, which only stores the affinity matrix and O(N)
+        vectors. self.laplacian_matrix is not changed.
+
+        Parameters
+        ----------
+        symmetrized, shift :
+            see Laplacian.laplacian_operator.
+        **kwargs :
+            see laplacian.py documentation for arguments for each method.
+
+        Returns
+        -------
+        laplacian_operator : LaplacianOperator (N_obs, N_obs)
+            The requested laplacian, or its symmetrized or shifted variant;
+            its ``weights`` are the renormalization weights.
+        """
+        if self.affinity_matrix is None:
+            self.compute_affinity_matrix()
+
+        kwds = {'dtype': self.dtype}
+        kwds.update(self.laplacian_kwds)
+        kwds.update(kwargs)
+        method = self.laplacian_method
+        if method == 'auto':
+            method = 'geometric'
+        laplacian = Laplacian.init(method, **kwds)
+        return laplacian.laplacian_operator(self.affinity_matrix,
+                                            symmetrized=symmetrized,
+                                            shift=shift)
+
     def set_data_matrix(self, X):
         """
+        Set the data matrix. A neighbor index built by the geometry over
+        different data is deleted; a supplied index (flann_index, or
+        load_index) is kept, and must index as many points as X.
+
         Parameters
         ----------
         X : ndarray (N_obs, N_features)
             The original data set to input.
         """
         X = check_array(X, accept_sparse=sparse_formats)
+        if X is not self.X and self.flann_index is not None:
+            if self._flann_index_built:
+                # the index built over the previous data is no longer valid
+                self.delete_flann_index()
+            elif self.flann_index.n_ids != X.shape[0]:
+                raise ValueError("the neighbor index does not match the data "
+                                 "matrix; delete it with delete_flann_index "
+                                 "before setting new data")
         self.X = X
 
+    def append_data_matrix(self, X_new, rebuild_threshold=2):
+        """
+        Append rows to the data matrix and extend the radius adjacency
+        matrix with the rows and columns of the new points only.
+
+        The new points are inserted into the neighbor index and only the new
+        points are queried: the (old, new) block of the adjacency matrix is
+        the transpose of the (new, old) block. This requires an adjacency
+        matrix computed with adjacency_method='cyflann' and a radius. The
+        affinity and Laplacian matrices are deleted, as they no longer match.
+
+        Parameters
+        ----------
+        X_new : ndarray (N_new, N_features)
+            The data points to append.
+        rebuild_threshold : float
+            the neighbor index is fully rebuilt once it has grown by this
+            factor since it was last built.
+
+        Returns
+        -------
+        self.adjacency_matrix : sparse matrix (N_obs + N_new, N_obs + N_new)
+        """
+        if self.X is None:
+            raise ValueError(distance_error_msg)
+        if self.flann_index is None or self.adjacency_matrix is None:
+            raise ValueError("No neighbor index exists. Compute the adjacency "
+                             "matrix with adjacency_method='cyflann' first.")
+        if ('radius' not in self.adjacency_kwds or
+                self.adjacency_kwds.get('max_neighbors') is not None):
+            raise ValueError("appending data requires a radius adjacency "
+                             "matrix: the neighbors of existing points "
+                             "are not updated for n_neighbors or "
+                             "max_neighbors graphs.")
+        X_new = check_array(X_new)
+        if X_new.shape[1] != self.X.shape[1]:
+            raise ValueError("X_new must have the same number of features "
+                             "as the data matrix")
+        n_old = self.X.shape[0]
+        if self.flann_index.n_ids != n_old:
+            raise ValueError("the neighbor index does not match the data matrix")
+
+        adjacency = Adjacency.init('cyflann', **self.adjacency_kwds)
+        adjacency.flann_index = self.flann_index
+        self.flann_index.add_points(X_new, rebuild_threshold=rebuild_threshold)
+        new_rows = adjacency.radius_adjacency(
+            X_new.astype(self.dtype, copy=False)).tocsr()
+        new_rows = narrow_dtype(new_rows, self.dtype)
+
+        old_rows = sparse.hstack([self.adjacency_matrix,
+                                  new_rows[:, :n_old].T])
+        self.adjacency_matrix = sparse.vstack([old_rows, new_rows],
+                                              format='csr')
+        if sparse.issparse(self.X):
+            self.X = sparse.vstack([self.X, X_new], format='csr')
+        else:
+            self.X = np.vstack([self.X, X_new])
+        self.affinity_matrix = None
+        self.laplacian_matrix = None
+        self.laplacian_symmetric = None
+        self.laplacian_weights = None
+        return self.adjacency_matrix
+
     def set_adjacency_matrix(self, adjacency_mat):
         """
         Parameters
@@ -303,6 +630,46 @@ class Geometry(object):
             raise ValueError("Laplacian matrix is not square")
         self.laplacian_matrix = laplacian_mat
 
+    def save_index(self, index_filename, data_filename):
+        """
+        Save the neighbor index and the data it indexes.
+
+        Parameters
+        ----------
+        index_filename : string
+            file to which the FLANN index is saved.
+        data_filename : string
+            file to which the indexed (float32) data is saved with np.save.
+        """
+        if self.flann_index is None:
+            raise ValueError("No neighbor index exists. Compute the adjacency "
+                             "matrix with adjacency_method='cyflann' first.")
+        np.save(data_filename, self.flann_index.dataset)
+        self.flann_index.save(index_filename)
+
+    def load_index(self, index_filename, data_filename, mmap_mode='r'):
+        """
+        Load a neighbor index saved with `save_index`. The data is memory
+        mapped by default, and is used as the data matrix if none is set.
+
+        Parameters
+        ----------
+        index_filename : string
+            file containing the FLANN index.
+        data_filename : string
+            file containing the indexed data.
+        mmap_mode : string or None
+            passed to np.load.
+        """
+        from .cyflann.index import Index as CyIndex
+        X = np.load(data_filename, mmap_mode=mmap_mode)
+        if self.X is None:
+            self.set_data_matrix(X)
+        elif self.X.shape != X.shape:
+            raise ValueError("the indexed data does not match the data matrix")
+        self.flann_index = CyIndex(X, saved_index=index_filename)
+        self._flann_index_built = False
+
     def delete_data_matrix(self):
         self.X = None
 
@@ -314,3 +681,7 @@ class Geometry(object):
 
     def delete_laplacian_matrix(self):
         self.laplacian_matrix = None
+
+    def delete_flann_index(self):
+        self.flann_index = None
+        self._flann_index_built = False
@@ -0,0 +1,459 @@
+/* LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
+================================================= */
+
+#include "hnsw_index.h"
+
+#include <algorithm>
+#include <cmath>
+#include <cstring>
+#include <fstream>
+#include <functional>
+#include <queue>
+#include <random>
+#include <stdexcept>
+
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+static const int FILE_VERSION = 1;
+static const char FILE_MAGIC[4] = {'H', 'N', 'S', 'W'};
+
+void HnswIndex::VisitedList::reset() {
+    if (++tag == 0) {
+        // the tag wrapped around: clear the marks for real
+        std::fill(marks.begin(), marks.end(), 0);
+        tag = 1;
+    }
+}
+
+bool HnswIndex::VisitedList::visit(int id) {
+    if (marks[id] == tag) {
+        return false;
+    }
+    marks[id] = tag;
+    return true;
+}
+
+HnswIndex::HnswIndex(int num_dims, int M, int ef_construction,
+        unsigned int seed)
+    : num_dims_(num_dims), M_(M), max_links0_(2 * M),
+      ef_construction_(ef_construction), seed_(seed),
+      level_mult_(1.0 / std::log((double) std::max(M, 2))),
+      entry_point_(-1), max_level_(-1) {
+    if (num_dims < 1 || M < 2 || ef_construction < 1) {
+        throw std::invalid_argument("invalid HNSW index parameters");
+    }
+}
+
+template <typename T>
+static void writeValue(std::ofstream& out, const T& value) {
+    out.write(reinterpret_cast<const char*>(&value), sizeof(T));
+}
+
+template <typename T>
+static void readValue(std::ifstream& in, T& value) {
+    in.read(reinterpret_cast<char*>(&value), sizeof(T));
+}
+
+HnswIndex::HnswIndex(std::string filename) {
+    std::ifstream in(filename.c_str(), std::ios::binary);
+    char magic[4];
+    int version;
+    in.read(magic, 4);
+    readValue(in, version);
+    if (!in || std::memcmp(magic, FILE_MAGIC, 4) != 0
+            || version != FILE_VERSION) {
+        throw std::runtime_error("not an HNSW index file: " + filename);
+    }
+    int num_pts;
+    readValue(in, num_dims_);
+    readValue(in, M_);
+    readValue(in, ef_construction_);
+    readValue(in, seed_);
+    readValue(in, entry_point_);
+    readValue(in, max_level_);
+    readValue(in, num_pts);
+    max_links0_ = 2 * M_;
+    level_mult_ = 1.0 / std::log((double) std::max(M_, 2));
+
+    data_.resize((size_t) num_pts * num_dims_);
+    levels_.resize(num_pts);
+    links_.resize(num_pts);
+    in.read(reinterpret_cast<char*>(data_.data()),
+            data_.size() * sizeof(float));
+    in.read(reinterpret_cast<char*>(levels_.data()), num_pts * sizeof(int));
+    for (int id = 0; id < num_pts; ++id) {
+        links_[id].resize(levels_[id] + 1);
+        for (int level = 0; level <= levels_[id]; ++level) {
+            int num_links;
+            readValue(in, num_links);
+            links_[id][level].resize(num_links);
+            in.read(reinterpret_cast<char*>(links_[id][level].data()),
+                    num_links * sizeof(int));
+        }
+        node_locks_.emplace_back(new std::mutex());
+    }
+    if (!in) {
+        throw std::runtime_error("truncated HNSW index file: " + filename);
+    }
+}
+
+void HnswIndex::save(std::string filename) {
+    std::ofstream out(filename.c_str(), std::ios::binary);
+    int num_pts = size();
+    out.write(FILE_MAGIC, 4);
+    writeValue(out, FILE_VERSION);
+    writeValue(out, num_dims_);
+    writeValue(out, M_);
+    writeValue(out, ef_construction_);
+    writeValue(out, seed_);
+    writeValue(out, entry_point_);
+    writeValue(out, max_level_);
+    writeValue(out, num_pts);
+    out.write(reinterpret_cast<const char*>(data_.data()),
+              data_.size() * sizeof(float));
+    out.write(reinterpret_cast<const char*>(levels_.data()),
+              num_pts * sizeof(int));
+    for (int id = 0; id < num_pts; ++id) {
+        for (size_t level = 0; level < links_[id].size(); ++level) {
+            int num_links = links_[id][level].size();
+            writeValue(out, num_links);
+            out.write(reinterpret_cast<const char*>(links_[id][level].data()),
+                      num_links * sizeof(int));
+        }
+    }
+    if (!out) {
+        throw std::runtime_error("could not write HNSW index file: "
+                                 + filename);
+    }
+}
+
+int HnswIndex::veclen() { return num_dims_; }
+
+int HnswIndex::size() { return levels_.size(); }
+
+const float* HnswIndex::point(int id) const {
+    return &data_[(size_t) id * num_dims_];
+}
+
+float HnswIndex::distance(const float* a, const float* b) const {
+    float result = 0;
+    for (int k = 0; k < num_dims_; ++k) {
+        float diff = a[k] - b[k];
+        result += diff * diff;
+    }
+    return result;
+}
+
+// The level of a node only depends on the seed and on its id, so that the
+// graph layers do not depend on the insertion order of the threads.
+int HnswIndex::randomLevel(int id) const {
+    std::mt19937 rng(seed_ + 0x9e3779b9u * (unsigned int) id);
+    std::uniform_real_distribution<double> uniform(0.0, 1.0);
+    return (int) (-std::log(1.0 - uniform(rng)) * level_mult_);
+}
+
+int HnswIndex::numThreads(int cores) {
+#ifdef _OPENMP
+    return cores > 0 ? cores : omp_get_max_threads();
+#else
+    return 1;
+#endif
+}
+
+std::vector<int> HnswIndex::getLinks(int id, int level, bool lock) {
+    if (lock) {
+        std::lock_guard<std::mutex> guard(*node_locks_[id]);
+        return links_[id][level];
+    }
+    return links_[id][level];
+}
+
+// Greedy walk from entry down to the layer bottom: on each layer, move to
+// the closest neighbor until no neighbor is closer to the query.
+int HnswIndex::greedySearch(const float* query, int entry, int top,
+        int bottom, bool lock) {
+    float best = distance(query, point(entry));
+    for (int level = top; level > bottom; --level) {
+        bool changed = true;
+        while (changed) {
+            changed = false;
+            std::vector<int> links = getLinks(entry, level, lock);
+            for (size_t k = 0; k < links.size(); ++k) {
+                float dist = distance(query, point(links[k]));
+                if (dist < best) {
+                    best = dist;
+                    entry = links[k];
+                    changed = true;
+                }
+            }
+        }
+    }
+    return entry;
+}
+
+// Best-first search of one layer keeping the ef closest nodes found.
+// result is sorted by increasing distance.
+void HnswIndex::searchLayer(const float* query, int entry, int ef, int level,
+        VisitedList& visited, bool lock, std::vector<DistId>& result) {
+    std::priority_queue<DistId, std::vector<DistId>,
+                        std::greater<DistId> > candidates;
+    std::priority_queue<DistId> nearest;
+    visited.reset();
+    visited.visit(entry);
+    DistId start(distance(query, point(entry)), entry);
+    candidates.push(start);
+    nearest.push(start);
+
+    while (!candidates.empty()) {
+        DistId current = candidates.top();
+        if (current.first > nearest.top().first
+                && (int) nearest.size() >= ef) {
+            break;
+        }
+        candidates.pop();
+        std::vector<int> links = getLinks(current.second, level, lock);
+        for (size_t k = 0; k < links.size(); ++k) {
+            int neighbor = links[k];
+            if (!visited.visit(neighbor)) {
+                continue;
+            }
+            float dist = distance(query, point(neighbor));
+            if ((int) nearest.size() < ef || dist < nearest.top().first) {
+                candidates.push(DistId(dist, neighbor));
+                nearest.push(DistId(dist, neighbor));
+                if ((int) nearest.size() > ef) {
+                    nearest.pop();
+                }
+            }
+        }
+    }
+
+    result.resize(nearest.size());
+    for (int k = nearest.size() - 1; k >= 0; --k) {
+        result[k] = nearest.top();
+        nearest.pop();
+    }
+}
+
+// Neighbor selection heuristic: a candidate is kept if it is closer to the
+// base node than to all the candidates kept so far, which keeps links
+// pointing in diverse directions. candidates must be sorted by increasing
+// distance to the base node.
+void HnswIndex::selectNeighbors(std::vector<DistId>& candidates,
+        int max_links) {
+    if ((int) candidates.size() <= max_links) {
+        return;
+    }
+    std::vector<DistId> selected;
+    for (size_t k = 0; k < candidates.size()
+            && (int) selected.size() < max_links; ++k) {
+        bool keep = true;
+        const float* candidate = point(candidates[k].second);
+        for (size_t s = 0; s < selected.size(); ++s) {
+            if (distance(candidate, point(selected[s].second))
+                    < candidates[k].first) {
+                keep = false;
+                break;
+            }
+        }
+        if (keep) {
+            selected.push_back(candidates[k]);
+        }
+    }
+    candidates.swap(selected);
+}
+
+// Adds the link neighbor -> id, pruning the links of neighbor if needed.
+void HnswIndex::connect(int id, int neighbor, int level) {
+    int max_links = level == 0 ? max_links0_ : M_;
+    std::lock_guard<std::mutex> guard(*node_locks_[neighbor]);
+    std::vector<int>& links = links_[neighbor][level];
+    if ((int) links.size() < max_links) {
+        links.push_back(id);
+        return;
+    }
+    const float* base = point(neighbor);
+    std::vector<DistId> candidates;
+    candidates.push_back(DistId(distance(base, point(id)), id));
+    for (size_t k = 0; k < links.size(); ++k) {
+        candidates.push_back(DistId(distance(base, point(links[k])),
+                                    links[k]));
+    }
+    std::sort(candidates.begin(), candidates.end());
+    selectNeighbors(candidates, max_links);
+    links.resize(candidates.size());
+    for (size_t k = 0; k < candidates.size(); ++k) {
+        links[k] = candidates[k].second;
+    }
+}
+
+void HnswIndex::insert(int id, VisitedList& visited) {
+    const float* query = point(id);
+    int level = levels_[id];
+
+    // the global lock is held for the whole insertion of a point which
+    // becomes the new top of the hierarchy
+    std::unique_lock<std::mutex> global(global_lock_);
+    int entry = entry_point_;
+    int max_level = max_level_;
+    if (entry < 0) {
+        entry_point_ = id;
+        max_level_ = level;
+        return;
+    }
+    if (level <= max_level) {
+        global.unlock();
+    }
+
+    entry = greedySearch(query, entry, max_level, level, true);
+    std::vector<DistId> nearest;
+    for (int l = std::min(level, max_level); l >= 0; --l) {
+        searchLayer(query, entry, ef_construction_, l, visited, true,
+                    nearest);
+        // the point itself may be reached through links added by other
+        // threads to the layers it already joined
+        nearest.erase(std::remove_if(nearest.begin(), nearest.end(),
+                                     [id](const DistId& d) {
+                                         return d.second == id;
+                                     }),
+                      nearest.end());
+        if (nearest.empty()) {
+            continue;
+        }
+        entry = nearest[0].second;
+        selectNeighbors(nearest, M_);
+        {
+            std::lock_guard<std::mutex> guard(*node_locks_[id]);
+            links_[id][l].resize(nearest.size());
+            for (size_t k = 0; k < nearest.size(); ++k) {
+                links_[id][l][k] = nearest[k].second;
+            }
+        }
+        for (size_t k = 0; k < nearest.size(); ++k) {
+            connect(id, nearest[k].second, l);
+        }
+    }
+
+    if (level > max_level) {
+        entry_point_ = id;
+        max_level_ = level;
+    }
+}
+
+void HnswIndex::addPoints(const float* points, int num_pts, int cores) {
+    int first = size();
+    int total = first + num_pts;
+    data_.insert(data_.end(), points, points + (size_t) num_pts * num_dims_);
+    levels_.resize(total);
+    links_.resize(total);
+    for (int id = first; id < total; ++id) {
+        levels_[id] = randomLevel(id);
+        links_[id].resize(levels_[id] + 1);
+        node_locks_.emplace_back(new std::mutex());
+    }
+
+    int start = first;
+    if (entry_point_ < 0 && num_pts > 0) {
+        VisitedList visited(total);
+        insert(start++, visited);
+    }
+#pragma omp parallel num_threads(numThreads(cores))
+    {
+        VisitedList visited(total);
+#pragma omp for schedule(dynamic, 64)
+        for (int id = start; id < total; ++id) {
+            insert(id, visited);
+        }
+    }
+}
+
+long HnswIndex::knnSearch(const float* queries, int num_pts, int* indices,
+        float* dists, int knn, int ef, int cores) {
+    long found = 0;
+    if (entry_point_ < 0) {
+        return 0;
+    }
+#pragma omp parallel num_threads(numThreads(cores)) reduction(+:found)
+    {
+        VisitedList visited(size());
+        std::vector<DistId> nearest;
+#pragma omp for schedule(dynamic, 64)
+        for (int i = 0; i < num_pts; ++i) {
+            const float* query = queries + (size_t) i * num_dims_;
+            int entry = greedySearch(query, entry_point_, max_level_, 0,
+                                     false);
+            searchLayer(query, entry, std::max(ef, knn), 0, visited, false,
+                        nearest);
+            int num_found = std::min((int) nearest.size(), knn);
+            for (int k = 0; k < num_found; ++k) {
+                indices[(size_t) i * knn + k] = nearest[k].second;
+                dists[(size_t) i * knn + k] = nearest[k].first;
+            }
+            found += num_found;
+        }
+    }
+    return found;
+}
+
+long HnswIndex::radiusSearch(const float* queries, int num_pts,
+        std::vector<long>& indptr, std::vector<int>& indices,
+        std::vector<float>& dists, float radius, int ef, int cores,
+        int max_neighbors) {
+    indptr.assign(num_pts + 1, 0);
+    indices.clear();
+    dists.clear();
+    if (entry_point_ < 0) {
+        return 0;
+    }
+    std::vector< std::vector<DistId> > chunk(
+        std::min(RADIUS_CHUNK_SIZE, num_pts));
+    // Search a chunk of queries at a time, so that the per-row vectors only
+    // ever hold one chunk, and append the results to the flat CSR arrays.
+    for (int start = 0; start < num_pts; start += RADIUS_CHUNK_SIZE) {
+        int num_chunk = std::min(RADIUS_CHUNK_SIZE, num_pts - start);
+#pragma omp parallel num_threads(numThreads(cores))
+        {
+            VisitedList visited(size());
+#pragma omp for schedule(dynamic, 64)
+            for (int i = 0; i < num_chunk; ++i) {
+                const float* query = queries + (size_t) (start + i) * num_dims_;
+                int entry = greedySearch(query, entry_point_, max_level_, 0,
+                                         false);
+                // grow the candidate list while its farthest element is
+                // still within the radius, and fewer than max_neighbors
+                // neighbors are found
+                int ef_search = std::max(ef, 1);
+                std::vector<DistId>& nearest = chunk[i];
+                while (true) {
+                    searchLayer(query, entry, ef_search, 0, visited, false,
+                                nearest);
+                    if ((int) nearest.size() < ef_search
+                            || nearest.back().first > radius
+                            || ef_search >= size()
+                            || (max_neighbors > 0
+                                && (int) nearest.size() >= max_neighbors)) {
+                        break;
+                    }
+                    ef_search *= 2;
+                }
+                while (!nearest.empty() && nearest.back().first > radius) {
+                    nearest.pop_back();
+                }
+                if (max_neighbors > 0
+                        && (int) nearest.size() > max_neighbors) {
+                    nearest.resize(max_neighbors);
+                }
+            }
+        }
+        for (int i = 0; i < num_chunk; ++i) {
+            indptr[start + i + 1] = indptr[start + i] + chunk[i].size();
+            for (size_t k = 0; k < chunk[i].size(); ++k) {
+                indices.push_back(chunk[i][k].second);
+                dists.push_back(chunk[i][k].first);
+            }
+        }
+    }
+    return indices.size();
+}
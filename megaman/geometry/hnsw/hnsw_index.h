@@ -0,0 +1,97 @@
+/* LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
+
+Hierarchical navigable small world graph index for approximate nearest
+neighbor search with the squared euclidean distance, following
+Malkov & Yashunin, "Efficient and robust approximate nearest neighbor search
+using Hierarchical Navigable Small World graphs" (arXiv:1603.09320).
+================================================= */
+#ifndef HNSW_INDEX_H_
+#define HNSW_INDEX_H_
+
+#include <memory>
+#include <mutex>
+#include <string>
+#include <utility>
+#include <vector>
+
+class HnswIndex {
+public:
+
+    // M is the number of links per node on the upper layers (2 * M on the
+    // bottom layer), ef_construction the size of the candidate lists used
+    // while inserting points.
+    HnswIndex(int num_dims, int M, int ef_construction, unsigned int seed);
+
+    // Loads an index written by save.
+    HnswIndex(std::string filename);
+
+    // Copies the (num_pts, num_dims) points into the index and inserts them
+    // using cores threads (0 means all cores).
+    void addPoints(const float* points, int num_pts, int cores);
+
+    // Writes the knn of each query into the (num_pts, knn) buffers indices
+    // and dists. Entries are left untouched for queries with fewer than knn
+    // neighbors found. Returns the number of neighbors found.
+    long knnSearch(const float* queries, int num_pts, int* indices,
+            float* dists, int knn, int ef, int cores);
+
+    // Writes the neighbors within the (squared) radius of each query
+    // directly in CSR format: the neighbors of query i are
+    // indices[indptr[i]:indptr[i+1]]. If max_neighbors > 0, only the
+    // nearest max_neighbors neighbors within the radius are kept.
+    long radiusSearch(const float* queries, int num_pts,
+            std::vector<long>& indptr, std::vector<int>& indices,
+            std::vector<float>& dists, float radius, int ef, int cores,
+            int max_neighbors);
+
+    void save(std::string filename);
+
+    int veclen();
+
+    int size();
+
+private:
+    typedef std::pair<float, int> DistId;
+
+    // Marks the nodes visited by one search. Bumping the tag clears the
+    // marks without touching the array.
+    struct VisitedList {
+        std::vector<unsigned int> marks;
+        unsigned int tag;
+        explicit VisitedList(int size) : marks(size, 0), tag(0) {}
+        void reset();
+        bool visit(int id);
+    };
+
+    static const int RADIUS_CHUNK_SIZE = 8192;
+
+    const float* point(int id) const;
+    float distance(const float* a, const float* b) const;
+    int randomLevel(int id) const;
+    std::vector<int> getLinks(int id, int level, bool lock);
+    int greedySearch(const float* query, int entry, int top, int bottom,
+            bool lock);
+    void searchLayer(const float* query, int entry, int ef, int level,
+            VisitedList& visited, bool lock, std::vector<DistId>& result);
+    void selectNeighbors(std::vector<DistId>& candidates, int max_links);
+    void connect(int id, int neighbor, int level);
+    void insert(int id, VisitedList& visited);
+    int numThreads(int cores);
+
+    int num_dims_;
+    int M_;
+    int max_links0_;
+    int ef_construction_;
+    unsigned int seed_;
+    double level_mult_;
+    int entry_point_;
+    int max_level_;
+    std::vector<float> data_;
+    std::vector<int> levels_;
+    // links_[id][level] are the neighbors of node id on a layer
+    std::vector< std::vector< std::vector<int> > > links_;
+    std::vector< std::unique_ptr<std::mutex> > node_locks_;
+    std::mutex global_lock_;
+};
+
+#endif // HNSW_INDEX_H_
@@ -0,0 +1,29 @@
+# LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
+
+from __future__ import division
+import cython
+import numpy as np
+cimport numpy as np
+from libcpp.vector cimport vector
+from libcpp.string cimport string
+
+ctypedef np.float32_t dtype_t
+ctypedef np.int32_t dtypei_t
+
+cdef extern from "hnsw_index.h":
+    cdef cppclass HnswIndex:
+        HnswIndex(dtypei_t num_dims, dtypei_t M, dtypei_t ef_construction,
+                unsigned int seed) except +
+        HnswIndex(string filename) except +
+        void addPoints(dtype_t* points, dtypei_t num_pts,
+                dtypei_t cores) nogil
+        long knnSearch(dtype_t* queries, dtypei_t num_pts,
+                dtypei_t* indices, dtype_t* dists, dtypei_t knn,
+                dtypei_t ef, dtypei_t cores) nogil
+        long radiusSearch(dtype_t* queries, dtypei_t num_pts,
+                vector[long]& indptr, vector[dtypei_t]& indices,
+                vector[dtype_t]& dists, dtype_t radius, dtypei_t ef,
+                dtypei_t cores, dtypei_t max_neighbors) nogil
+        void save(string filename) except +
+        int veclen()
+        int size()
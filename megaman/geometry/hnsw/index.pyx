@@ -0,0 +1,219 @@
+# distutils: language=c++
+
+# LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
+
+from __future__ import division
+import multiprocessing
+from scipy import sparse
+import numpy as np
+cimport numpy as np
+from libc.string cimport memcpy
+from index cimport *
+
+np.import_array()
+
+
+def _get_cores(n_jobs):
+    """
+    Converts the n_jobs convention (-1 means all cores, -2 all but one, ...)
+    to the number of threads passed to the index (0 means all cores).
+    """
+    if n_jobs == 0:
+        raise ValueError('n_jobs must not be 0.')
+    if n_jobs == -1:
+        return 0
+    if n_jobs < 0:
+        return max(multiprocessing.cpu_count() + 1 + n_jobs, 1)
+    return n_jobs
+
+
+def _to_bytes(filename):
+    if isinstance(filename, bytes):
+        return filename
+    return filename.encode('utf-8')
+
+
+def _as_float32(X):
+    """
+    Returns X as a C-contiguous float32 array, without a copy if it already
+    is one.
+    """
+    X = np.require(X, dtype=np.float32, requirements=['C', 'A'])
+    if X.ndim != 2:
+        raise ValueError('expected a 2 dimensional array.')
+    return X
+
+
+cdef class Index:
+    """
+    Hierarchical navigable small world (HNSW) graph index
+
+    The points are copied into the index, which can be saved to and loaded
+    from a single file. Construction and queries run on n_jobs threads (-1
+    means all cores), with the GIL released.
+
+    Parameters
+    ----------
+    n_features : int
+        dimension of the indexed points.
+    M : int
+        number of links per node on the upper layers of the graph (2 * M on
+        the bottom layer). Larger values improve the recall in high
+        dimension, at the cost of memory and construction time.
+    ef_construction : int
+        size of the candidate lists used to insert points. Larger values
+        build a better graph, more slowly.
+    random_seed : int
+        seed used to draw the layer of each point.
+    saved_index : string, optional
+        file written by Index.save to load the index from. The other
+        parameters are then read from the file.
+    """
+    cdef HnswIndex* _thisptr
+
+    def __cinit__(self, int n_features=0, int M=16, int ef_construction=200,
+                  unsigned int random_seed=0, saved_index=None):
+        if saved_index is not None:
+            self._thisptr = new HnswIndex(<string> _to_bytes(saved_index))
+        else:
+            if n_features < 1:
+                raise ValueError('n_features must be positive.')
+            self._thisptr = new HnswIndex(n_features, M, ef_construction,
+                                          random_seed)
+
+    def __dealloc__(self):
+        del self._thisptr
+
+    def add_points(self, X, int n_jobs=1):
+        """
+        Inserts the rows of X into the index. Their ids follow the ids of
+        the points already in the index.
+        """
+        X = self._check_queries(X)
+        cdef int cores = _get_cores(n_jobs)
+        cdef int npts = X.shape[0]
+        cdef dtype_t* points = <dtype_t*> np.PyArray_DATA(X)
+        with nogil:
+            self._thisptr.addPoints(points, npts, cores)
+
+    def knn_neighbors_graph(self, X, int knn, int ef=50, int n_jobs=1,
+                            bint squared=False):
+        """
+        Constructs a sparse k nearest neighbors distance matrix in csr
+        format. ef (at least knn) is the size of the candidate list of the
+        search: larger values give better recall, more slowly. With
+        squared=True the matrix holds squared distances.
+        """
+        if knn < 1:
+            raise ValueError('knn must be >= 1.')
+        X = self._check_queries(X)
+        cdef int cores = _get_cores(n_jobs)
+        cdef int nsam = X.shape[0]
+        cdef long res
+        cdef dtype_t* queries = <dtype_t*> np.PyArray_DATA(X)
+        cdef np.ndarray indices = np.empty((nsam, knn), dtype=np.int32)
+        cdef np.ndarray dists = np.empty((nsam, knn), dtype=np.float32)
+        indices.fill(-1)
+        cdef dtypei_t* indices_ptr = <dtypei_t*> np.PyArray_DATA(indices)
+        cdef dtype_t* dists_ptr = <dtype_t*> np.PyArray_DATA(dists)
+        with nogil:
+            res = self._thisptr.knnSearch(queries, nsam, indices_ptr,
+                                          dists_ptr, knn, ef, cores)
+        if res == nsam * knn:
+            indptr = knn * np.arange(nsam + 1)
+            return self._distance_graph(dists.ravel(), indices.ravel(),
+                                        indptr, nsam, squared)
+        # fewer points than knn in the index: the missing neighbors are left
+        # as -1 at the end of their rows
+        found = indices >= 0
+        indptr = np.zeros(nsam + 1, dtype=np.int64)
+        np.cumsum(found.sum(1), out=indptr[1:])
+        return self._distance_graph(dists[found], indices[found], indptr,
+                                    nsam, squared)
+
+    def radius_neighbors_graph(self, X, float radius, int ef=50,
+                               int n_jobs=1, int max_neighbors=-1,
+                               bint squared=False):
+        """
+        Constructs a sparse distance matrix of the neighbors within radius
+        in csr format, with explicit zeros for zero distances. The candidate
+        list of each search starts with ef elements and is doubled until its
+        farthest element lies outside the radius. If max_neighbors is
+        positive, each row holds at most the max_neighbors nearest
+        neighbors within radius, and the candidate list stops growing once
+        it holds max_neighbors neighbors. With squared=True the matrix holds
+        squared distances.
+        """
+        if radius < 0.:
+            raise ValueError('radius must be >= 0.')
+        radius *= radius
+        X = self._check_queries(X)
+        cdef int cores = _get_cores(n_jobs)
+        cdef int nsam = X.shape[0]
+        cdef dtype_t* queries = <dtype_t*> np.PyArray_DATA(X)
+        cdef vector[long] indptr
+        cdef vector[dtypei_t] indices
+        cdef vector[dtype_t] dists
+        with nogil:
+            self._thisptr.radiusSearch(queries, nsam, indptr, indices, dists,
+                                       radius, ef, cores, max_neighbors)
+        return self._distance_graph(_dtype_array(dists),
+                                    _dtypei_array(indices),
+                                    _long_array(indptr), nsam, squared)
+
+    def _check_queries(self, X):
+        X = _as_float32(X)
+        if X.shape[1] != self._thisptr.veclen():
+            raise ValueError('points must have the same number of features '
+                             'as the index.')
+        return X
+
+    def _distance_graph(self, data, indices, indptr, int nsam,
+                        bint squared=False):
+        graph = sparse.csr_matrix((data, indices, indptr),
+                                  shape=(nsam, self._thisptr.size()))
+        if not squared:
+            # the index uses squared distances
+            np.sqrt(graph.data, out=graph.data)
+        return graph
+
+    def save(self, filename):
+        """
+        Saves the index, including the indexed points, to a file. Load it
+        with Index(saved_index=filename).
+        """
+        self._thisptr.save(_to_bytes(filename))
+
+    def veclen(self):
+        """
+        Length of a single data point
+        """
+        return self._thisptr.veclen()
+
+    def size(self):
+        """
+        Returns the number of points in the index.
+        """
+        return self._thisptr.size()
+
+
+# Copies of the flat search results into numpy arrays.
+cdef np.ndarray _dtype_array(vector[dtype_t]& vec):
+    cdef np.ndarray arr = np.empty(vec.size(), dtype=np.float32)
+    if vec.size() > 0:
+        memcpy(np.PyArray_DATA(arr), &vec[0], vec.size() * sizeof(dtype_t))
+    return arr
+
+
+cdef np.ndarray _dtypei_array(vector[dtypei_t]& vec):
+    cdef np.ndarray arr = np.empty(vec.size(), dtype=np.int32)
+    if vec.size() > 0:
+        memcpy(np.PyArray_DATA(arr), &vec[0], vec.size() * sizeof(dtypei_t))
+    return arr
+
+
+cdef np.ndarray _long_array(vector[long]& vec):
+    cdef np.ndarray arr = np.empty(vec.size(), dtype=np.int_)
+    if vec.size() > 0:
+        memcpy(np.PyArray_DATA(arr), &vec[0], vec.size() * sizeof(long))
+    return arr
@@ -0,0 +1,26 @@
+# LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
+
+import platform
+
+
+def configuration(parent_package='', top_path=None):
+    import numpy
+    from numpy.distutils.misc_util import Configuration
+
+    config = Configuration('geometry/hnsw', parent_package, top_path)
+
+    # the index is self-contained: it only needs a C++11 compiler, and
+    # OpenMP for multi-threaded construction and queries
+    extra_compile_args = ["-O3", "-std=c++11"]
+    extra_link_args = []
+    if platform.system() != 'Darwin':
+        extra_compile_args.append('-fopenmp')
+        extra_link_args.append('-fopenmp')
+
+    config.add_extension("index",
+           sources=["index.cxx", "hnsw_index.cc"],
+           include_dirs=[numpy.get_include()],
+           extra_compile_args=extra_compile_args,
+           extra_link_args=extra_link_args)
+
+    return config
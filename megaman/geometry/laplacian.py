@@ -1,10 +1,13 @@
 # LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
 
 import numpy as np
+from scipy import sparse
 from scipy.sparse import isspmatrix
+from scipy.sparse.linalg import LinearOperator
 from sklearn.utils.validation import check_array
 
-from .utils import RegisterSubclasses
+from .utils import (RegisterSubclasses, is_flagged_symmetric, symmetrize,
+                    SYMMETRIZE_RULES, divide_gather)
 
 
 def compute_laplacian_matrix(affinity_matrix, method='auto', **kwargs):
@@ -26,19 +29,32 @@ class Laplacian(RegisterSubclasses):
     -----
     The methods here all return the negative of the standard
     Laplacian definition.
+
+    The Laplacian is computed in ``dtype`` precision: the affinity matrix is
+    cast to dtype once, in the copy on which the Laplacian is computed.
+
+    ``symmetrize_input`` is True (the 'average' rule), False, or one of the
+    rules of utils.symmetrize: 'average', 'max' or 'min'.
+
+    ``laplacian_matrix`` with copy=False computes the Laplacian in the data
+    of an affinity matrix of the right dtype which needs no symmetrization
+    (e.g. flagged as symmetric, as the matrices of
+    Affinity.affinity_matrices).
+
+    ``laplacian_operator`` returns the Laplacian as a matrix-free
+    LaplacianOperator, which stores the affinity matrix and O(N) vectors.
     """
     symmetric = False
 
     def __init__(self, symmetrize_input=True,
-                 scaling_epps=None, full_output=False):
+                 scaling_epps=None, full_output=False, dtype=np.float64):
+        if symmetrize_input not in [True, False] + SYMMETRIZE_RULES:
+            raise ValueError("symmetrize_input must be a boolean or one of "
+                             "{0}".format(SYMMETRIZE_RULES))
         self.symmetrize_input = symmetrize_input
         self.scaling_epps = scaling_epps
         self.full_output = full_output
-
-    @staticmethod
-    def _symmetrize(A):
-        # TODO: make this more efficient?
-        return 0.5 * (A + A.T)
+        self.dtype = dtype
 
     @classmethod
     def symmetric_methods(cls):
@@ -52,15 +68,29 @@ class Laplacian(RegisterSubclasses):
             if not cls.get_method(method).symmetric:
                 yield method
 
-    def laplacian_matrix(self, affinity_matrix):
-        affinity_matrix = check_array(affinity_matrix, copy=False, dtype=float,
+    def laplacian_matrix(self, affinity_matrix, copy=True):
+        symmetric = is_flagged_symmetric(affinity_matrix)
+        # converting to an array of dtype makes a new matrix
+        cast = (not hasattr(affinity_matrix, 'dtype')
+                or affinity_matrix.dtype != self.dtype)
+        affinity_matrix = check_array(affinity_matrix, copy=False,
+                                      dtype=self.dtype,
                                       accept_sparse=['csr', 'csc', 'coo'])
-        if self.symmetrize_input:
-            affinity_matrix = self._symmetrize(affinity_matrix)
-
+        symmetrized = False
+        if self.symmetrize_input and not symmetric:
+            rule = ('average' if self.symmetrize_input is True
+                    else self.symmetrize_input)
+            symmetrized_matrix = symmetrize(affinity_matrix, rule)
+            # already symmetric matrices are returned without copy
+            symmetrized = symmetrized_matrix is not affinity_matrix
+            affinity_matrix = symmetrized_matrix
+
+        # the laplacian is computed in place: copy unless the cast or the
+        # symmetrization already made a new matrix
+        copy = copy and not (cast or symmetrized)
         if isspmatrix(affinity_matrix):
-            affinity_matrix = affinity_matrix.tocoo()
-        else:
+            affinity_matrix = affinity_matrix.tocoo(copy=copy)
+        elif copy:
             affinity_matrix = affinity_matrix.copy()
 
         lap, lapsym, w = self._compute_laplacian(affinity_matrix)
@@ -76,9 +106,78 @@ class Laplacian(RegisterSubclasses):
         else:
             return lap
 
+    def laplacian_operator(self, affinity_matrix, symmetrized=False,
+                           shift=None):
+        """Return the Laplacian of the affinity matrix as a LinearOperator
+
+        The operator computes the products of the Laplacian returned by
+        laplacian_matrix, without forming it: it stores the (symmetrized)
+        affinity matrix and the degree vectors only.
+
+        Parameters
+        ----------
+        affinity_matrix : array_like or sparse matrix (N_obs, N_obs)
+            The affinity matrix.
+        symmetrized : bool
+            if True, return instead the symmetric matrix with the spectrum
+            of the Laplacian used by the symmetric eigensolvers: the
+            Laplacian itself for the symmetric methods, else
+            W^{-1/2} S W^{-1/2}, where S is the symmetric Laplacian and W
+            the diagonal matrix of the renormalization weights (see
+            full_output).
+        shift : float, optional
+            if given, return the operator shift * I - L, with L the
+            operator above.
+
+        Returns
+        -------
+        operator : LaplacianOperator (N_obs, N_obs)
+        """
+        symmetric = is_flagged_symmetric(affinity_matrix)
+        affinity_matrix = check_array(affinity_matrix, copy=False,
+                                      dtype=self.dtype,
+                                      accept_sparse=['csr', 'csc', 'coo'])
+        if self.symmetrize_input and not symmetric:
+            rule = ('average' if self.symmetrize_input is True
+                    else self.symmetrize_input)
+            affinity_matrix = symmetrize(affinity_matrix, rule)
+        symmetric = symmetric or bool(self.symmetrize_input)
+        if isspmatrix(affinity_matrix):
+            affinity_matrix = affinity_matrix.tocsr()
+
+        (row_scale, col_scale, diagonal,
+         w, symmetric_scale) = self._operator_vectors(affinity_matrix)
+        if symmetrized and symmetric_scale is not None:
+            operator = LaplacianOperator(affinity_matrix, symmetric_scale,
+                                         symmetric_scale, weights=w,
+                                         symmetric=symmetric)
+        else:
+            scale = 1.0
+            if self.scaling_epps is not None and self.scaling_epps > 0.:
+                scale = 4 / (self.scaling_epps ** 2)
+            operator = LaplacianOperator(affinity_matrix, row_scale,
+                                         col_scale, -scale * diagonal,
+                                         scale=scale, weights=w,
+                                         symmetric=self.symmetric and
+                                         symmetric)
+        if shift is not None:
+            operator = operator.shifted(shift)
+        return operator
+
     def _compute_laplacian(self, lap):
         raise NotImplementedError()
 
+    def _operator_vectors(self, affinity_matrix):
+        """Return the vectors of the LaplacianOperator of this Laplacian
+
+        Returns (row_scale, col_scale, diagonal, w, symmetric_scale): the
+        Laplacian is row_scale * A * col_scale - diag(diagonal), w are its
+        renormalization weights, and symmetric_scale * A * symmetric_scale
+        is the symmetric matrix with its spectrum, or None for symmetric
+        Laplacians.
+        """
+        raise NotImplementedError()
+
 
 class UnNormalizedLaplacian(Laplacian):
     name = 'unnormalized'
@@ -89,6 +188,11 @@ class UnNormalizedLaplacian(Laplacian):
         _subtract_from_diagonal(lap, w)
         return lap, lap, w
 
+    def _operator_vectors(self, affinity_matrix):
+        w = _degree(affinity_matrix)
+        ones = np.ones_like(w)
+        return ones, ones, w, w, None
+
 
 class GeometricLaplacian(Laplacian):
     name = 'geometric'
@@ -103,6 +207,9 @@ class GeometricLaplacian(Laplacian):
 
         return lap, lapsym, w
 
+    def _operator_vectors(self, affinity_matrix):
+        return _renormalized_vectors(affinity_matrix)
+
 
 class RandomWalkLaplacian(Laplacian):
     name = 'randomwalk'
@@ -114,6 +221,10 @@ class RandomWalkLaplacian(Laplacian):
         _subtract_from_diagonal(lap, nonzero)
         return lap, lapsym, w
 
+    def _operator_vectors(self, affinity_matrix):
+        w, nonzero = _normalized_degree(affinity_matrix)
+        return 1 / w, np.ones_like(w), nonzero, w, 1 / np.sqrt(w)
+
 
 class SymmetricNormalizedLaplacian(Laplacian):
     name = 'symmetricnormalized'
@@ -124,6 +235,10 @@ class SymmetricNormalizedLaplacian(Laplacian):
         _subtract_from_diagonal(lap, nonzero)
         return lap, lap, w
 
+    def _operator_vectors(self, affinity_matrix):
+        w, nonzero = _normalized_degree(affinity_matrix, degree_exp=0.5)
+        return 1 / w, 1 / w, nonzero, w, None
+
 
 class RenormalizedLaplacian(Laplacian):
     name = 'renormalized'
@@ -132,10 +247,10 @@ class RenormalizedLaplacian(Laplacian):
     def __init__(self, symmetrize_input=True,
                  scaling_epps=None,
                  full_output=False,
-                 renormalization_exponent=1):
-        self.symmetrize_input = symmetrize_input
-        self.scaling_epps = scaling_epps
-        self.full_output = full_output
+                 renormalization_exponent=1, dtype=np.float64):
+        super(RenormalizedLaplacian, self).__init__(
+            symmetrize_input=symmetrize_input, scaling_epps=scaling_epps,
+            full_output=full_output, dtype=dtype)
         self.renormalization_exponent = renormalization_exponent
 
     def _compute_laplacian(self, lap):
@@ -147,6 +262,10 @@ class RenormalizedLaplacian(Laplacian):
 
         return lap, lapsym, w
 
+    def _operator_vectors(self, affinity_matrix):
+        return _renormalized_vectors(affinity_matrix,
+                                     self.renormalization_exponent)
+
 
 # Utility routines: these operate in-place and assume either coo matrix or
 # dense array
@@ -157,25 +276,40 @@ def _degree(lap):
 
 def _divide_along_rows(lap, vals):
     if isspmatrix(lap):
-        lap.data /= vals[lap.row]
+        divide_gather(lap.data, vals, lap.row)
     else:
         lap /= vals[:, np.newaxis]
 
 
 def _divide_along_cols(lap, vals):
     if isspmatrix(lap):
-        lap.data /= vals[lap.col]
+        divide_gather(lap.data, vals, lap.col)
     else:
         lap /= vals
 
 
-def _normalize_laplacian(lap, symmetric=False, degree_exp=None):
+def _normalized_degree(lap, degree_exp=None):
     w = _degree(lap)
     w_nonzero = (w != 0)
     w[~w_nonzero] = 1
 
     if degree_exp is not None:
         w **= degree_exp
+    return w, w_nonzero
+
+
+def _renormalized_vectors(affinity_matrix, degree_exp=None):
+    # operator vectors of W^{-1} D^{-a} A D^{-a}, where W holds the degrees
+    # of D^{-a} A D^{-a}
+    d, _ = _normalized_degree(affinity_matrix, degree_exp)
+    w = np.asarray(affinity_matrix.dot(1 / d)).ravel() / d
+    w_nonzero = (w != 0)
+    w[~w_nonzero] = 1
+    return 1 / (w * d), 1 / d, w_nonzero, w, 1 / (np.sqrt(w) * d)
+
+
+def _normalize_laplacian(lap, symmetric=False, degree_exp=None):
+    w, w_nonzero = _normalized_degree(lap, degree_exp)
 
     if symmetric:
         _divide_along_rows(lap, w)
@@ -191,3 +325,70 @@ def _subtract_from_diagonal(lap, vals):
         lap.data[lap.row == lap.col] -= vals
     else:
         lap.flat[::lap.shape[0] + 1] -= vals
+
+
+class LaplacianOperator(LinearOperator):
+    """Matrix-free Laplacian operator
+
+    The operator computes x -> scale * row_scale * (A (col_scale * x)) +
+    diagonal * x. All the Laplacians of this module have this form (see
+    Laplacian.laplacian_operator): the operator stores the affinity matrix A
+    and O(N) vectors only, and its products cost one sparse product with A.
+
+    Attributes
+    ----------
+    weights : ndarray (N_obs,)
+        the renormalization weights of the Laplacian (see full_output).
+    symmetric : bool
+        whether the operator is symmetric.
+    """
+    def __init__(self, affinity_matrix, row_scale, col_scale, diagonal=None,
+                 scale=1.0, weights=None, symmetric=False):
+        dtype = affinity_matrix.dtype
+        self.affinity_matrix = affinity_matrix
+        self.row_scale = np.asarray(row_scale, dtype=dtype)
+        self.col_scale = np.asarray(col_scale, dtype=dtype)
+        if diagonal is None:
+            diagonal = np.zeros(affinity_matrix.shape[0])
+        self.diagonal = np.asarray(diagonal, dtype=dtype)
+        self.scale = scale
+        self.weights = weights
+        self.symmetric = symmetric
+        self._row_factor = (scale * self.row_scale).astype(dtype)
+        super(LaplacianOperator, self).__init__(dtype=dtype,
+                                                shape=affinity_matrix.shape)
+
+    def _matvec(self, x):
+        x = np.ravel(x)
+        y = np.asarray(self.affinity_matrix.dot(self.col_scale * x)).ravel()
+        y *= self._row_factor
+        y += self.diagonal * x
+        return y
+
+    def _matmat(self, X):
+        Y = np.asarray(self.affinity_matrix.dot(
+            self.col_scale[:, np.newaxis] * X))
+        Y *= self._row_factor[:, np.newaxis]
+        Y += self.diagonal[:, np.newaxis] * X
+        return Y
+
+    def _adjoint(self):
+        if self.symmetric:
+            return self
+        return LaplacianOperator(self.affinity_matrix.T, self.col_scale,
+                                 self.row_scale, self.diagonal, self.scale,
+                                 self.weights)
+
+    def shifted(self, shift):
+        """Return the operator shift * I - self"""
+        return LaplacianOperator(self.affinity_matrix, self.row_scale,
+                                 self.col_scale, shift - self.diagonal,
+                                 -self.scale, self.weights, self.symmetric)
+
+    def tocsr(self):
+        """Return the operator as a CSR matrix"""
+        return sparse.csr_matrix(
+            sparse.diags(self._row_factor).dot(
+                sparse.csr_matrix(self.affinity_matrix)).dot(
+                    sparse.diags(self.col_scale)) +
+            sparse.diags(self.diagonal))
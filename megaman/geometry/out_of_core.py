@@ -0,0 +1,142 @@
+# LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
+"""
+Out-of-core construction of adjacency matrices.
+
+The rows of the adjacency matrix are computed one block of queries at a time
+and each block is written to disk as a CSR shard: three ``.npy`` files holding
+the ``data``, ``indices`` and ``indptr`` arrays of the rows of the block. A
+``shards.json`` file records the shape of the full matrix and the first row of
+each shard. The shards are loaded back as memory-mapped CSR matrices, so
+neither the data nor the graph needs to fit in memory at once.
+"""
+import json
+import os
+
+import numpy as np
+from scipy import sparse
+
+from .adjacency import (Adjacency, index_query_methods,
+                        resolve_adjacency_method)
+
+__all__ = ["compute_adjacency_shards", "write_adjacency_shards",
+           "load_adjacency_shards"]
+
+SHARDS_FILENAME = 'shards.json'
+
+
+def compute_adjacency_shards(X, directory, method='auto', block_size=4096,
+                             **kwargs):
+    """Compute the adjacency matrix of X into on-disk CSR shards
+
+    Parameters
+    ----------
+    X : array_like (N_obs, N_features)
+        The data. It may be an ``np.memmap`` or any array supporting row
+        slicing: only one block of rows is read at a time. With
+        method='cyflann', a float32 C-contiguous array is indexed without
+        being copied.
+    directory : string
+        Directory in which the shards are written. It is created if needed.
+    method : string
+        Adjacency method. It must support block queries (see
+        adjacency.index_query_methods). 'auto' selects 'cyflann' if a
+        flann_index is given, else the method with the lowest estimated
+        cost.
+    block_size : int
+        Number of query points per shard.
+    **kwargs :
+        Keyword arguments for the adjacency method (radius or n_neighbors,
+        flann_index, cyflann_kwds...).
+
+    Returns
+    -------
+    shards : list of sparse matrices
+        The memory-mapped shards, see load_adjacency_shards.
+    """
+    if method == 'auto' and kwargs.get('flann_index') is not None:
+        # search the given FLANN index
+        method = 'cyflann'
+    method = resolve_adjacency_method(X, method,
+                                      radius=kwargs.get('radius'),
+                                      n_neighbors=kwargs.get('n_neighbors'),
+                                      max_neighbors=kwargs.get('max_neighbors'),
+                                      methods=index_query_methods(),
+                                      keywords=kwargs)
+    adjacency = Adjacency.init(method, **kwargs)
+    write_adjacency_shards(adjacency, X, directory, block_size=block_size)
+    return load_adjacency_shards(directory)
+
+
+def write_adjacency_shards(adjacency, X, directory, block_size=4096):
+    """Write the adjacency matrix of X, computed by adjacency, to shards
+
+    Parameters
+    ----------
+    adjacency : Adjacency
+        An adjacency instance of a method supporting block queries (see
+        adjacency.index_query_methods).
+    X : array_like (N_obs, N_features)
+        The data.
+    directory : string
+        Directory in which the shards are written.
+    block_size : int
+        Number of query points per shard.
+    """
+    if adjacency.name not in index_query_methods():
+        raise ValueError("adjacency method '{0}' does not support out-of-core "
+                         "computation".format(adjacency.name))
+    if block_size <= 0:
+        raise ValueError("block_size must be positive")
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    row_starts = []
+    shape = None
+    for start, stop, G in adjacency.iter_adjacency_blocks(X, block_size):
+        G = G.tocsr()
+        shard = len(row_starts)
+        for attr in ['data', 'indices', 'indptr']:
+            np.save(_shard_filename(directory, shard, attr), getattr(G, attr))
+        row_starts.append(start)
+        shape = (stop, G.shape[1])
+
+    with open(os.path.join(directory, SHARDS_FILENAME), 'w') as f:
+        json.dump({'shape': shape, 'row_starts': row_starts}, f)
+
+
+def load_adjacency_shards(directory, mmap_mode='r'):
+    """Load the CSR shards written by write_adjacency_shards
+
+    Parameters
+    ----------
+    directory : string
+        Directory containing the shards.
+    mmap_mode : {None, 'r+', 'r', 'w+', 'c'}
+        Memory-map mode passed to np.load. With the default 'r' the shards are
+        read-only; use 'c' to modify them in memory or None to read them into
+        memory.
+
+    Returns
+    -------
+    shards : list of sparse matrices
+        The shards, in row order. ``scipy.sparse.vstack(shards)`` gives the
+        full adjacency matrix, if it fits in memory.
+    """
+    with open(os.path.join(directory, SHARDS_FILENAME)) as f:
+        meta = json.load(f)
+    n_cols = meta['shape'][1]
+
+    shards = []
+    for shard in range(len(meta['row_starts'])):
+        data, indices, indptr = [
+            np.load(_shard_filename(directory, shard, attr),
+                    mmap_mode=mmap_mode)
+            for attr in ['data', 'indices', 'indptr']]
+        shards.append(sparse.csr_matrix((data, indices, indptr),
+                                        shape=(len(indptr) - 1, n_cols),
+                                        copy=False))
+    return shards
+
+
+def _shard_filename(directory, shard, attr):
+    return os.path.join(directory, 'shard_{0:05d}_{1}.npy'.format(shard, attr))
@@ -0,0 +1,112 @@
+# LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
+
+import numpy as np
+from scipy import sparse
+
+from .adjacency import compute_adjacency_matrix, _csr_index_dtype
+
+__all__ = ["RadiusFamily"]
+
+
+class RadiusFamily(object):
+    """Radius adjacency graphs for every radius up to rmax
+
+    The neighbors of each row of a distance matrix computed at radius rmax
+    are stored sorted by distance, so that the graph at any radius <= rmax
+    is made of a prefix of every row. The prefix lengths are found from a
+    global ordering of the distances in O(nnz(radius) + n_samples), without
+    scanning or copying the rmax matrix, so sweeping many radii costs one
+    neighbor search plus one gather per radius.
+
+    Parameters
+    ----------
+    adjacency_matrix : sparse matrix (N_obs, N_obs)
+        Distance matrix, e.g. a radius adjacency matrix at radius rmax.
+        Stored entries (including explicit zeros) are neighbors.
+    rmax : float, optional
+        Largest radius of the family. Entries farther than rmax are dropped.
+        Defaults to the largest stored distance.
+
+    Attributes
+    ----------
+    data, indices, indptr : ndarrays
+        CSR representation of the rmax graph, with each row sorted by
+        increasing distance.
+    """
+    def __init__(self, adjacency_matrix, rmax=None):
+        A = sparse.csr_matrix(adjacency_matrix)
+        n_rows = A.shape[0]
+        rows = np.repeat(np.arange(n_rows), np.diff(A.indptr))
+        data, indices = A.data, A.indices
+        if rmax is not None:
+            keep = data <= rmax
+            rows, data, indices = rows[keep], data[keep], indices[keep]
+        elif len(data):
+            rmax = data.max()
+        else:
+            rmax = 0
+
+        order = np.lexsort((data, rows))
+        idx_dtype = _csr_index_dtype(max(len(data), max(A.shape)))
+        self.data = data[order]
+        self.indices = indices[order].astype(idx_dtype)
+        self.indptr = np.zeros(n_rows + 1, dtype=idx_dtype)
+        np.cumsum(np.bincount(rows, minlength=n_rows), out=self.indptr[1:])
+        self.shape = A.shape
+        self.rmax = rmax
+
+        # all distances in increasing order, with the row they belong to:
+        # the entries within a radius are a prefix of this ordering
+        by_distance = np.argsort(self.data, kind='mergesort')
+        self._sorted_data = self.data[by_distance]
+        self._sorted_rows = rows[order][by_distance]
+
+    @classmethod
+    def from_data(cls, X, rmax, method='auto', **kwargs):
+        """Compute the family from the data with a single radius search
+
+        Parameters
+        ----------
+        X : array_like (N_obs, N_features)
+            The data.
+        rmax : float
+            Largest radius of the family.
+        method : string
+            Adjacency method, see compute_adjacency_matrix.
+        **kwargs :
+            Keyword arguments for the adjacency method.
+        """
+        return cls(compute_adjacency_matrix(X, method=method, radius=rmax,
+                                            **kwargs), rmax=rmax)
+
+    def _check_radius(self, radius):
+        if radius > self.rmax:
+            raise ValueError("radius={0} is larger than the family rmax={1}"
+                             "".format(radius, self.rmax))
+
+    def n_neighbors(self, radius):
+        """Return the number of neighbors of each row within radius"""
+        self._check_radius(radius)
+        n_entries = np.searchsorted(self._sorted_data, radius, side='right')
+        return np.bincount(self._sorted_rows[:n_entries],
+                           minlength=self.shape[0])
+
+    def adjacency_matrix(self, radius):
+        """Return the CSR distance matrix at the given radius
+
+        Each row holds its neighbors within radius, in order of increasing
+        distance (so the column indices are not sorted). The matrix shares
+        its arrays with the family when radius covers every entry; it must
+        not be modified in place.
+        """
+        counts = self.n_neighbors(radius)
+        indptr = np.zeros(self.shape[0] + 1, dtype=self.indptr.dtype)
+        np.cumsum(counts, out=indptr[1:])
+        if indptr[-1] == len(self.data):
+            return sparse.csr_matrix((self.data, self.indices, self.indptr),
+                                     shape=self.shape, copy=False)
+        # position of every kept entry in the rmax arrays: each row's prefix
+        take = np.arange(indptr[-1])
+        take += np.repeat(self.indptr[:-1] - indptr[:-1], counts)
+        return sparse.csr_matrix((self.data[take], self.indices[take], indptr),
+                                 shape=self.shape)
@@ -0,0 +1 @@
+# LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
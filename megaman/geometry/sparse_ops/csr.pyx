@@ -0,0 +1,184 @@
+# LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
+"""
+Single pass kernels on the (data, indices, indptr) arrays of CSR matrices.
+"""
+cimport cython
+import numpy as np
+cimport numpy as np
+
+ctypedef fused index_t:
+    np.int32_t
+    np.int64_t
+
+ctypedef fused value_t:
+    np.float32_t
+    np.float64_t
+
+cdef enum:
+    AVERAGE = 0
+    MAXIMUM = 1
+    MINIMUM = 2
+
+RULES = {'average': AVERAGE, 'max': MAXIMUM, 'min': MINIMUM}
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _merge_transpose(index_t[::1] indptr, index_t[::1] indices,
+                     value_t[::1] data, index_t[::1] t_indptr,
+                     index_t[::1] t_indices, value_t[::1] t_data,
+                     int rule, index_t[::1] out_indptr,
+                     index_t[::1] out_indices, value_t[::1] out_data):
+    cdef Py_ssize_t n_rows = indptr.shape[0] - 1
+    cdef Py_ssize_t i, p, p_end, q, q_end
+    cdef Py_ssize_t k = 0
+    with nogil:
+        out_indptr[0] = 0
+        for i in range(n_rows):
+            p = indptr[i]
+            p_end = indptr[i + 1]
+            q = t_indptr[i]
+            q_end = t_indptr[i + 1]
+            # merge the sorted row i of A and of A.T
+            while p < p_end or q < q_end:
+                if q == q_end or (p < p_end and indices[p] < t_indices[q]):
+                    # A[i, j] only
+                    if rule != MINIMUM:
+                        out_indices[k] = indices[p]
+                        if rule == AVERAGE:
+                            out_data[k] = 0.5 * data[p]
+                        else:
+                            out_data[k] = data[p]
+                        k += 1
+                    p += 1
+                elif p == p_end or t_indices[q] < indices[p]:
+                    # A[j, i] only
+                    if rule != MINIMUM:
+                        out_indices[k] = t_indices[q]
+                        if rule == AVERAGE:
+                            out_data[k] = 0.5 * t_data[q]
+                        else:
+                            out_data[k] = t_data[q]
+                        k += 1
+                    q += 1
+                else:
+                    out_indices[k] = indices[p]
+                    if rule == AVERAGE:
+                        out_data[k] = 0.5 * (data[p] + t_data[q])
+                    elif rule == MAXIMUM:
+                        out_data[k] = max(data[p], t_data[q])
+                    else:
+                        out_data[k] = min(data[p], t_data[q])
+                    k += 1
+                    p += 1
+                    q += 1
+            out_indptr[i + 1] = k
+
+
+def symmetrize_csr(indptr, indices, data, t_indptr, t_indices, t_data,
+                   rule='average'):
+    """Merge the CSR arrays of a square matrix A and of its transpose
+
+    The arrays must be in canonical format (sorted indices, no duplicates),
+    with the same index dtype and a float32 or float64 data dtype. The
+    entries A[i, j] and A[j, i] are combined with the rule 'average', 'max'
+    or 'min' (see megaman.geometry.utils.symmetrize), in a single pass over
+    the rows, and explicit zeros are kept.
+
+    Returns
+    -------
+    data, indices, indptr : the CSR arrays of the symmetrized matrix.
+    """
+    code = RULES[rule]
+    if code == MINIMUM:
+        size = min(len(indices), len(t_indices))
+    else:
+        size = len(indices) + len(t_indices)
+    out_indptr = np.empty(len(indptr), dtype=indptr.dtype)
+    out_indices = np.empty(size, dtype=indices.dtype)
+    out_data = np.empty(size, dtype=data.dtype)
+    _merge_transpose(indptr, indices, data, t_indptr, t_indices, t_data,
+                     code, out_indptr, out_indices, out_data)
+    # shrink the buffers to the entries written (without copy)
+    nnz = out_indptr[-1]
+    out_indices.resize(nnz, refcheck=False)
+    out_data.resize(nnz, refcheck=False)
+    return out_data, out_indices, out_indptr
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _merge_transpose_sources(index_t[::1] indptr, index_t[::1] indices,
+                             index_t[::1] t_indptr, index_t[::1] t_indices,
+                             index_t[::1] t_positions, int rule,
+                             index_t[::1] out_indptr,
+                             index_t[::1] out_indices,
+                             index_t[::1] out_source,
+                             index_t[::1] out_source_t):
+    cdef Py_ssize_t n_rows = indptr.shape[0] - 1
+    cdef Py_ssize_t i, p, p_end, q, q_end
+    cdef Py_ssize_t k = 0
+    with nogil:
+        out_indptr[0] = 0
+        for i in range(n_rows):
+            p = indptr[i]
+            p_end = indptr[i + 1]
+            q = t_indptr[i]
+            q_end = t_indptr[i + 1]
+            while p < p_end or q < q_end:
+                if q == q_end or (p < p_end and indices[p] < t_indices[q]):
+                    if rule != MINIMUM:
+                        out_indices[k] = indices[p]
+                        out_source[k] = p
+                        out_source_t[k] = -1
+                        k += 1
+                    p += 1
+                elif p == p_end or t_indices[q] < indices[p]:
+                    if rule != MINIMUM:
+                        out_indices[k] = t_indices[q]
+                        out_source[k] = -1
+                        out_source_t[k] = t_positions[q]
+                        k += 1
+                    q += 1
+                else:
+                    out_indices[k] = indices[p]
+                    out_source[k] = p
+                    out_source_t[k] = t_positions[q]
+                    k += 1
+                    p += 1
+                    q += 1
+            out_indptr[i + 1] = k
+
+
+def symmetrize_csr_sources(indptr, indices, t_indptr, t_indices, t_positions,
+                           rule='average'):
+    """Merge the CSR structures of a square matrix A and of its transpose
+
+    Same merge as symmetrize_csr, on the structure only: ``t_positions``
+    holds, for each entry A.T[i, j], the position of A[j, i] in the arrays
+    of A. Each entry of the symmetrized matrix gets the positions in the
+    data of A of its entries A[i, j] and A[j, i] (-1 if not stored), from
+    which the data of any matrix with the structure of A is symmetrized
+    with a gather.
+
+    Returns
+    -------
+    indices, indptr : the CSR structure of the symmetrized matrix.
+    source, source_t : the positions of A[i, j] and A[j, i] of each entry.
+    """
+    code = RULES[rule]
+    if code == MINIMUM:
+        size = min(len(indices), len(t_indices))
+    else:
+        size = len(indices) + len(t_indices)
+    out_indptr = np.empty(len(indptr), dtype=indptr.dtype)
+    out_indices = np.empty(size, dtype=indices.dtype)
+    out_source = np.empty(size, dtype=indices.dtype)
+    out_source_t = np.empty(size, dtype=indices.dtype)
+    _merge_transpose_sources(indptr, indices, t_indptr, t_indices,
+                             t_positions, code, out_indptr, out_indices,
+                             out_source, out_source_t)
+    nnz = out_indptr[-1]
+    for out in [out_indices, out_source, out_source_t]:
+        out.resize(nnz, refcheck=False)
+    return out_indices, out_indptr, out_source, out_source_t
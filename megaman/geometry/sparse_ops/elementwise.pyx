@@ -0,0 +1,49 @@
+# LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
+"""
+Multi-threaded in-place elementwise kernels on the data arrays of sparse
+matrices. The arrays are split in static chunks over n_threads OpenMP
+threads (the loops run serially if the extension is built without OpenMP).
+"""
+cimport cython
+from cython.parallel cimport prange
+from libc.math cimport exp
+cimport numpy as np
+
+ctypedef fused index_t:
+    np.int32_t
+    np.int64_t
+
+ctypedef fused value_t:
+    np.float32_t
+    np.float64_t
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def scaled_exp(value_t[::1] data, double divisor, bint square=False,
+               int n_threads=1):
+    """In place data = exp(data / divisor), or exp(data ** 2 / divisor)"""
+    cdef Py_ssize_t i
+    cdef Py_ssize_t n = data.shape[0]
+    if square:
+        for i in prange(n, nogil=True, num_threads=n_threads,
+                        schedule='static'):
+            data[i] = exp(data[i] * data[i] / divisor)
+    else:
+        for i in prange(n, nogil=True, num_threads=n_threads,
+                        schedule='static'):
+            data[i] = exp(data[i] / divisor)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def divide_gather(value_t[::1] data, double[::1] values,
+                  index_t[::1] index, int n_threads=1):
+    """In place data /= values[index]"""
+    cdef Py_ssize_t i
+    cdef Py_ssize_t n = data.shape[0]
+    for i in prange(n, nogil=True, num_threads=n_threads,
+                    schedule='static'):
+        data[i] = data[i] / values[index[i]]
@@ -0,0 +1,30 @@
+# LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
+
+import platform
+
+
+def configuration(parent_package='', top_path=None):
+    import numpy
+    from numpy.distutils.misc_util import Configuration
+
+    config = Configuration('geometry/sparse_ops', parent_package, top_path)
+
+    # self-contained kernels on the arrays of scipy.sparse matrices
+    config.add_extension("csr",
+           sources=["csr.c"],
+           include_dirs=[numpy.get_include()],
+           extra_compile_args=["-O3"])
+
+    # multi-threaded elementwise kernels, run serially without OpenMP
+    extra_compile_args = ["-O3"]
+    extra_link_args = []
+    if platform.system() != 'Darwin':
+        extra_compile_args.append('-fopenmp')
+        extra_link_args.append('-fopenmp')
+    config.add_extension("elementwise",
+           sources=["elementwise.c"],
+           include_dirs=[numpy.get_include()],
+           extra_compile_args=extra_compile_args,
+           extra_link_args=extra_link_args)
+
+    return config
@@ -4,6 +4,7 @@ from nose import SkipTest
 
 import numpy as np
 from numpy.testing import assert_allclose, assert_raises, assert_equal
+from scipy import sparse
 from scipy.sparse import isspmatrix
 from scipy.spatial.distance import cdist, pdist, squareform
 
@@ -21,7 +22,8 @@ except ImportError:
 def test_adjacency_methods():
     assert_equal(set(adjacency_methods()),
                  {'auto', 'pyflann', 'ball_tree',
-                  'cyflann', 'brute', 'kd_tree'})
+                  'cyflann', 'brute', 'kd_tree', 'blocked_brute',
+                  'ckdtree', 'hnsw', 'lsh'})
 
 
 def test_adjacency_input_validation():
@@ -39,7 +41,7 @@ def test_adjacency():
     Gtrue = {}
 
     exact_methods = [m for m in Adjacency.methods()
-                     if not m.endswith('flann')]
+                     if not m.endswith('flann') and m not in ['hnsw', 'lsh']]
 
     def check_kneighbors(n_neighbors, method):
         if method == 'pyflann' and NO_PYFLANN:
@@ -67,7 +69,8 @@ def test_adjacency():
         Gtrue[n_neighbors] = compute_adjacency_matrix(X, method='brute',
                                              n_neighbors=n_neighbors)
         for method in Adjacency.methods():
-            yield check_kneighbors, n_neighbors, method
+            if method != 'lsh':
+                yield check_kneighbors, n_neighbors, method
 
     for radius in [0.1, 0.5, 1.0]:
         Gtrue[radius] = compute_adjacency_matrix(X, method='brute',
@@ -106,6 +109,142 @@ def test_all_methods_close():
         yield check_method, method
 
 
+def test_blocked_brute_memory_budget():
+    rand = np.random.RandomState(42)
+    X = rand.rand(50, 3)
+
+    def check_budget(kwds):
+        G_true = compute_adjacency_matrix(X, method='blocked_brute', **kwds)
+        # a tiny budget forces several row and column tiles
+        G = compute_adjacency_matrix(X, method='blocked_brute',
+                                     memory_budget=1E-4, **kwds)
+        assert_allclose(G.toarray(), G_true.toarray())
+        assert_allclose(G.diagonal(), 0)
+
+    for kwds in [{'radius': 0.5}, {'n_neighbors': 5}]:
+        yield check_budget, kwds
+
+
+def test_ckdtree_adjacency():
+    rand = np.random.RandomState(36)
+    X = rand.rand(100, 3)
+
+    # the self-join gives a symmetric graph with an explicit zero diagonal
+    G = compute_adjacency_matrix(X, method='ckdtree', radius=0.3)
+    assert_equal((G != G.T).nnz, 0)
+    assert_equal(G.nnz, len((G != 0).nonzero()[0]) + X.shape[0])
+    G_true = compute_adjacency_matrix(X, method='brute', radius=0.3)
+    assert_allclose(G.toarray(), G_true.toarray(), atol=1E-7)
+
+    # distances computed in small batches of pairs
+    G_batched = compute_adjacency_matrix(X, method='ckdtree', radius=0.3,
+                                         batch_size=7)
+    assert_allclose(G_batched.toarray(), G.toarray())
+
+    G_true = compute_adjacency_matrix(X, method='ckdtree', n_neighbors=5)
+    for n_jobs in [1, 2]:
+        G = compute_adjacency_matrix(X, method='ckdtree', n_neighbors=5,
+                                     n_jobs=n_jobs)
+        assert_allclose(G.toarray(), G_true.toarray())
+
+    assert_raises(ValueError, compute_adjacency_matrix,
+                  sparse.csr_matrix(X), method='ckdtree', radius=0.3)
+
+
+def test_ckdtree_threads_keyword():
+    # the number of threads is passed as workers (scipy >= 1.6) or n_jobs
+    from megaman.geometry import adjacency
+    from megaman.geometry.adjacency import CKDTreeAdjacency
+
+    class RecordingTree(object):
+        def query(self, X, **kwargs):
+            self.kwargs = kwargs
+
+    detected = adjacency._CKDTREE_THREADS
+    assert detected in ['workers', 'n_jobs']
+    tree = RecordingTree()
+    try:
+        for keyword in ['workers', 'n_jobs']:
+            adjacency._CKDTREE_THREADS = keyword
+            CKDTreeAdjacency(n_neighbors=3, n_jobs=2)._query_tree(tree, None,
+                                                                  k=3)
+            assert_equal(tree.kwargs, {'k': 3, keyword: 2})
+    finally:
+        adjacency._CKDTREE_THREADS = detected
+
+
+def test_symmetric_self_join():
+    from megaman.geometry.utils import is_flagged_symmetric
+    rand = np.random.RandomState(36)
+    X = rand.rand(60, 3)
+    D_true = squareform(pdist(X))
+    D_true[D_true > 0.4] = 0
+
+    def check_self_join(method, kwds):
+        G = compute_adjacency_matrix(X, method=method, radius=0.4, **kwds)
+        assert is_flagged_symmetric(G)
+        assert G.has_sorted_indices
+        assert_equal((G != G.T).nnz, 0)
+        # explicit zeros on the diagonal
+        assert_equal(G.nnz, np.count_nonzero(D_true) + X.shape[0])
+        assert_allclose(G.toarray(), D_true, atol=1E-12)
+
+    for method, kwds in [('ckdtree', {}),
+                         ('blocked_brute', {}),
+                         ('blocked_brute', {'memory_budget': 1E-4})]:
+        yield check_self_join, method, kwds
+
+
+def test_cyflann_n_jobs():
+    from megaman.geometry.cyflann.index import Index
+    rand = np.random.RandomState(36)
+    X = rand.randn(200, 3)
+    index = Index(X)
+    index.buildIndex()
+    G_knn = index.knn_neighbors_graph(X, 5)
+    G_radius = index.radius_neighbors_graph(X, 0.5)
+
+    def check_n_jobs(n_jobs):
+        # multithreaded queries on the same index give the same graph
+        G = index.knn_neighbors_graph(X, 5, n_jobs=n_jobs)
+        assert_allclose(G.toarray(), G_knn.toarray())
+        G = index.radius_neighbors_graph(X, 0.5, n_jobs=n_jobs)
+        assert_allclose(G.toarray(), G_radius.toarray())
+
+    for n_jobs in [2, -1]:
+        yield check_n_jobs, n_jobs
+    assert_raises(ValueError, index.knn_neighbors_graph, X, 5, n_jobs=0)
+
+
+def test_cyflann_float32_no_copy():
+    import os
+    import tempfile
+    from megaman.geometry.cyflann.index import Index
+    rand = np.random.RandomState(36)
+    X = rand.randn(100, 3).astype(np.float32)
+    D_true = squareform(pdist(X))
+    D_true[D_true > 1.0] = 0
+
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        X_mmap = np.memmap(filename, dtype=np.float32, mode='w+',
+                           shape=X.shape)
+        X_mmap[:] = X
+        X_mmap.flush()
+        for data in [X, np.memmap(filename, dtype=np.float32, mode='r',
+                                  shape=X.shape)]:
+            index = Index(data, index_type='kdtrees', num_trees=8)
+            assert index.dataset is data
+            index.buildIndex()
+            G = index.radius_neighbors_graph(data, 1.0, num_checks=256)
+            assert_allclose(G.toarray(), D_true, rtol=1E-5, atol=1E-5)
+            del index
+    finally:
+        del X_mmap
+        os.remove(filename)
+
+
 def test_custom_adjacency():
     class CustomAdjacency(Adjacency):
         name = "custom"
@@ -134,4 +273,321 @@ def test_cyflann_index_type():
         assert_allclose(this_D.toarray(), D_true, rtol=1E-5, atol=1E-5)
     
     for index_type in ['kmeans', 'kdtrees']:
-        yield check_index_type, index_type
\ No newline at end of file
+        yield check_index_type, index_type
+
+
+def test_cyflann_target_precision():
+    import os
+    import tempfile
+    from megaman.geometry.cyflann.index import Index
+    rand = np.random.RandomState(36)
+    X = rand.rand(2000, 3)
+    G_true = compute_adjacency_matrix(X, method='brute', radius=0.1)
+    # radius searches of autotuned indexes used to find no neighbors
+    for target_precision in [0.8, 0.99]:
+        G = compute_adjacency_matrix(X, method='cyflann', radius=0.1,
+                                     target_precision=target_precision)
+        assert G.nnz >= 0.5 * G_true.nnz
+        assert G.nnz <= G_true.nnz
+
+    index = Index(X, target_precision=0.9)
+    index.buildIndex()
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        index.save(filename)
+        loaded = Index(X, saved_index=filename)
+        assert_equal(loaded.radius_neighbors_graph(X, 0.1).nnz,
+                     index.radius_neighbors_graph(X, 0.1).nnz)
+    finally:
+        os.remove(filename)
+
+
+def test_cyflann_add_remove_points():
+    from megaman.geometry.cyflann.index import Index
+    rand = np.random.RandomState(36)
+    X = rand.randn(30, 2)
+    index = Index(X[:20], index_type='kdtrees', num_trees=8)
+    index.buildIndex()
+    index.add_points(X[20:])
+    assert_equal(index.n_ids, 30)
+    assert_allclose(index.dataset, X, rtol=1E-6)
+
+    # every point, including the added ones, is its own nearest neighbor
+    G = index.knn_neighbors_graph(X, 1, num_checks=256)
+    assert_equal(G.indices, np.arange(30))
+
+    index.remove_point(3)
+    G = index.radius_neighbors_graph(X, 1.0, num_checks=256)
+    assert_equal(G.shape, (30, 30))
+    assert_equal(G[:, 3].nnz, 0)
+
+
+def test_parallel_adjacency():
+    from megaman.geometry.cyflann.index import Index
+    rand = np.random.RandomState(36)
+    X = rand.randn(150, 3)
+    index = Index(X, index_type='kdtrees', num_trees=8)
+    index.buildIndex()
+
+    def check_n_processes(method, kwds, n_processes):
+        if method == 'cyflann':
+            kwds = dict(kwds, flann_index=index)
+        G_true = compute_adjacency_matrix(X, method=method, **kwds)
+        G = compute_adjacency_matrix(X, method=method,
+                                     n_processes=n_processes, **kwds)
+        assert_equal(G.shape, G_true.shape)
+        assert_allclose(G.toarray(), G_true.toarray())
+
+    for method in ['kd_tree', 'ball_tree', 'brute', 'cyflann']:
+        for kwds in [{'radius': 1.0}, {'n_neighbors': 5}]:
+            for n_processes in [2, -1]:
+                yield check_n_processes, method, kwds, n_processes
+    assert_raises(ValueError, compute_adjacency_matrix, X, method='kd_tree',
+                  radius=1.0, n_processes=0)
+
+
+def test_parallel_threaded_adjacency():
+    # the workers are forked after the parent started its OpenMP threads
+    # (threaded index builds and searches, elementwise kernels): they must
+    # not deadlock
+    from megaman.geometry.utils import set_n_threads
+    from megaman.geometry.cyflann.index import Index as CyIndex
+    from megaman.geometry.hnsw.index import Index as HnswIndex
+    rand = np.random.RandomState(36)
+    X = rand.randn(500, 5)
+    hnsw_index = HnswIndex(5)
+    hnsw_index.add_points(X, n_jobs=2)
+    flann_index = CyIndex(X, index_type='kdtrees', num_trees=8)
+    flann_index.buildIndex()
+
+    def check_threaded(method, kwds):
+        kwds = dict(kwds, n_jobs=2, mode='gaussian', affinity_radius=1.0)
+        if method == 'cyflann':
+            kwds['flann_index'] = flann_index
+        else:
+            kwds['hnsw_index'] = hnsw_index
+        set_n_threads(2)
+        try:
+            G_true = compute_adjacency_matrix(X, method=method, **kwds)
+            G = compute_adjacency_matrix(X, method=method, n_processes=2,
+                                         **kwds)
+        finally:
+            set_n_threads(1)
+        # the threaded exp kernel and numpy's exp may differ in the last ulp
+        assert_allclose(G.toarray(), G_true.toarray(), rtol=1E-6)
+
+    for method in ['cyflann', 'hnsw']:
+        for kwds in [{'radius': 1.0}, {'n_neighbors': 5}]:
+            yield check_threaded, method, kwds
+
+
+def test_hnsw_adjacency():
+    import os
+    import tempfile
+    from megaman.geometry.hnsw.index import Index
+    rand = np.random.RandomState(36)
+    X = rand.randn(500, 10)
+    G_knn = compute_adjacency_matrix(X, method='brute', n_neighbors=10)
+    G_radius = compute_adjacency_matrix(X, method='brute', radius=3.0)
+    D = cdist(X, X)
+
+    def recall(G, G_true):
+        found = set(zip(*G.nonzero()))
+        true = set(zip(*G_true.nonzero()))
+        return len(found & true) / float(len(true))
+
+    def check_graph(G, G_true):
+        assert_equal(G.shape, G_true.shape)
+        assert recall(G, G_true) > 0.95
+        # the neighbors found have their exact distances
+        rows, cols = G.nonzero()
+        assert_allclose(np.asarray(G[rows, cols]).ravel(), D[rows, cols],
+                        rtol=1E-5)
+
+    for n_jobs in [1, 2]:
+        adj = Adjacency.init('hnsw', n_neighbors=10, n_jobs=n_jobs)
+        yield check_graph, adj.adjacency_graph(X), G_knn
+        adj = Adjacency.init('hnsw', radius=3.0, n_jobs=n_jobs)
+        yield check_graph, adj.adjacency_graph(X), G_radius
+
+    index = Index(X.shape[1], M=8, ef_construction=100)
+    index.add_points(X[:300])
+    index.add_points(X[300:])
+    assert_equal(index.size(), 500)
+    G = compute_adjacency_matrix(X, method='hnsw', hnsw_index=index,
+                                 radius=3.0, ef=100)
+    yield check_graph, G, G_radius
+
+    # a saved index gives the same graph
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        index.save(filename)
+        loaded = Index(saved_index=filename)
+        assert_equal(loaded.veclen(), 10)
+        G_loaded = compute_adjacency_matrix(X, method='hnsw',
+                                            hnsw_index=loaded,
+                                            radius=3.0, ef=100)
+        assert_allclose(G_loaded.toarray(), G.toarray())
+    finally:
+        os.remove(filename)
+
+
+def test_lsh_adjacency():
+    rand = np.random.RandomState(36)
+    X = rand.rand(300, 5)
+    X_sparse = sparse.random(300, 2000, density=0.005, random_state=rand,
+                             format='csr')
+
+    def check_lsh(X, radius, kwds):
+        G_true = compute_adjacency_matrix(X, method='brute', radius=radius)
+        G = compute_adjacency_matrix(X, method='lsh', radius=radius,
+                                     random_state=0, **kwds)
+        assert_equal(G.shape, G_true.shape)
+        assert_equal(G.format, 'csr')
+        assert_allclose(G.toarray(), G.T.toarray())
+        # the pairs found have their exact distances
+        rows, cols = G.nonzero()
+        assert_allclose(G.toarray()[rows, cols],
+                        G_true.toarray()[rows, cols], atol=1E-7)
+        assert G.nnz >= 0.9 * G_true.nnz
+
+    for kwds in [{}, {'batch_size': 100}, {'n_tables': 20,
+                                           'n_projections': 8}]:
+        yield check_lsh, X, 0.3, kwds
+        yield check_lsh, X_sparse, 0.5, kwds
+
+    assert_raises(ValueError, compute_adjacency_matrix, X, method='lsh',
+                  n_neighbors=5)
+
+
+def test_lsh_candidates():
+    from megaman.geometry.adjacency import LSHAdjacency
+    rand = np.random.RandomState(36)
+    keys = rand.randint(0, 20, 300)
+    same = keys[:, None] == keys
+    true_pairs = set(zip(*np.nonzero(np.triu(same, 1))))
+    for batch_size in [1, 100, 10 ** 6]:
+        batches = list(LSHAdjacency._iter_bucket_pairs(keys, batch_size))
+        pairs = [pair for i, j in batches for pair in zip(i, j)]
+        assert_equal(len(pairs), len(true_pairs))
+        assert_equal(set(pairs), true_pairs)
+        # a batch only exceeds batch_size with the pairs of a single point
+        for i, j in batches:
+            assert len(i) <= max(batch_size, same.sum(1).max())
+
+    # unit norm sparse data whose only neighbors within the radius are the
+    # points themselves: the candidates are a small fraction of the pairs
+    X = sparse.random(1000, 2000, density=0.01, random_state=rand,
+                      format='csr')
+    X = sparse.diags(1 / np.sqrt(X.multiply(X).sum(1).A.ravel())).dot(X)
+    adjacency = LSHAdjacency(radius=1.0, random_state=0)
+    G = adjacency.adjacency_graph(X)
+    assert_equal(G.nnz, 1000)
+    n_pairs = adjacency.n_tables * 1000 * 999 // 2
+    assert 0 < adjacency.n_candidates < 0.1 * n_pairs
+    wide = LSHAdjacency(radius=1.0, bucket_width=4.0, random_state=0)
+    assert_equal(wide.adjacency_graph(X).nnz, 1000)
+    assert wide.n_candidates > 2 * adjacency.n_candidates
+
+
+def test_max_neighbors_adjacency():
+    rand = np.random.RandomState(36)
+    # uneven density: a dense cluster and sparse background points
+    X = np.vstack([0.05 * rand.rand(100, 3), rand.rand(100, 3)])
+    D = squareform(pdist(X))
+    exact_methods = ['brute', 'kd_tree', 'ball_tree', 'blocked_brute',
+                     'ckdtree']
+
+    def expected_mask(radius, max_neighbors):
+        mask = np.zeros(D.shape, dtype=bool)
+        for i, row in enumerate(D):
+            within = np.flatnonzero(row <= radius)
+            nearest = within[np.argsort(row[within])][:max_neighbors]
+            mask[i, nearest] = True
+        return mask
+
+    def stored_mask(G):
+        G = G.tocoo()
+        mask = np.zeros(G.shape, dtype=bool)
+        mask[G.row, G.col] = True
+        return mask
+
+    def check_max_neighbors(method, radius, max_neighbors, kwds):
+        if method == 'pyflann' and NO_PYFLANN:
+            raise SkipTest("pyflann not installed")
+        G = compute_adjacency_matrix(X, method=method, radius=radius,
+                                     max_neighbors=max_neighbors, **kwds)
+        assert_equal(G.shape, D.shape)
+        mask = stored_mask(G)
+        mask_true = expected_mask(radius, max_neighbors)
+        assert mask.sum(1).max() <= max_neighbors
+        assert not np.any(mask & (D > radius * (1 + 1E-6)))
+        assert_allclose(G.toarray()[mask], D[mask], rtol=1E-5, atol=1E-6)
+        if method in exact_methods:
+            assert_equal(mask, mask_true)
+        else:
+            assert (mask & mask_true).sum() >= 0.9 * mask_true.sum()
+
+    method_kwds = {'cyflann': {'cyflann_kwds': {'num_checks': 256}}}
+    for method in Adjacency.methods():
+        for max_neighbors in [1, 5, 50]:
+            yield (check_max_neighbors, method, 0.3, max_neighbors,
+                   method_kwds.get(method, {}))
+    yield check_max_neighbors, 'brute', 0.3, 5, {'n_processes': 2}
+    yield (check_max_neighbors, 'blocked_brute', 0.3, 5,
+           {'memory_budget': 0.01})
+
+    G = compute_adjacency_matrix(X, method='kd_tree', radius=0.3,
+                                 max_neighbors=5, mode='connectivity')
+    assert_equal(stored_mask(G), expected_mask(0.3, 5))
+    assert_allclose(G.data, 1)
+
+    # max_neighbors caps radius graphs only
+    assert_raises(ValueError, compute_adjacency_matrix, X, method='brute',
+                  n_neighbors=5, max_neighbors=5)
+    assert_raises(ValueError, compute_adjacency_matrix, X, method='brute',
+                  radius=0.3, max_neighbors=0)
+
+
+def test_adjacency_modes():
+    from megaman.geometry.cyflann.index import Index
+    rand = np.random.RandomState(36)
+    X = rand.rand(100, 3)
+    index = Index(X, index_type='kdtrees', num_trees=8)
+    index.buildIndex()
+    affinity_radius = 0.4
+    method_kwds = {'cyflann': {'flann_index': index},
+                   'hnsw': {'random_seed': 0},
+                   'lsh': {'random_state': 0}}
+
+    def check_mode(method, query, mode):
+        if method == 'pyflann' and NO_PYFLANN:
+            raise SkipTest("pyflann not installed")
+        kwds = dict(query, **method_kwds.get(method, {}))
+        G_dist = compute_adjacency_matrix(X, method=method, **kwds)
+        G = compute_adjacency_matrix(X, method=method, mode=mode,
+                                     affinity_radius=affinity_radius,
+                                     **kwds)
+        assert_equal(G.shape, G_dist.shape)
+        G_dist, G = G_dist.tocsr(), G.tocsr()
+        assert_equal(G.indptr, G_dist.indptr)
+        assert_equal(G.indices, G_dist.indices)
+        d = G_dist.data.astype(float)
+        expected = {'distance': d, 'connectivity': np.ones_like(d),
+                    'squared_distance': d ** 2,
+                    'gaussian': np.exp(-d ** 2 / affinity_radius ** 2)}[mode]
+        assert_allclose(G.data, expected, rtol=1E-5, atol=1E-6)
+
+    for method in Adjacency.methods():
+        for mode in ['connectivity', 'squared_distance', 'gaussian']:
+            yield check_mode, method, {'radius': 0.3}, mode
+            if method != 'lsh':
+                yield check_mode, method, {'n_neighbors': 5}, mode
+        yield check_mode, method, {'radius': 0.3, 'max_neighbors': 5}, 'gaussian'
+
+    assert_raises(ValueError, compute_adjacency_matrix, X, method='brute',
+                  radius=0.3, mode='gaussian')
+    assert_raises(ValueError, compute_adjacency_matrix, X, method='brute',
+                  radius=0.3, mode='affinity')
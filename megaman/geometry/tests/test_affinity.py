@@ -29,7 +29,7 @@ TEST_DATA = os.path.join(os.path.dirname(__file__),
 
 
 def test_affinity_methods():
-    assert_equal(set(affinity_methods()), {'auto', 'gaussian'})
+    assert_equal(set(affinity_methods()), {'auto', 'gaussian', 'self_tuning'})
 
 
 def test_affinity_input_validation():
@@ -96,6 +96,45 @@ def test_affinity():
                        affinity_radius, symmetrize)
 
 
+def test_affinity_flagged_symmetric():
+    from megaman.geometry.utils import flag_symmetric, is_flagged_symmetric
+    rand = np.random.RandomState(42)
+    X = rand.rand(20, 3)
+    adj = compute_adjacency_matrix(X, method='ckdtree', radius=0.5)
+    aff = compute_affinity_matrix(adj, radius=0.5)
+    assert is_flagged_symmetric(aff)
+    aff_true = compute_affinity_matrix(csr_matrix(adj), radius=0.5)
+    assert_allclose(aff.toarray(), aff_true.toarray())
+
+    # the symmetrization is skipped for flagged inputs
+    D = csr_matrix(np.triu(cdist(X, X)))
+    A = compute_affinity_matrix(flag_symmetric(D), radius=0.5)
+    assert_equal(A.nnz, D.nnz + X.shape[0])
+
+
+def test_affinity_input_types():
+    rand = np.random.RandomState(42)
+    X = rand.rand(30, 3)
+    radius = 0.5
+    adj = compute_adjacency_matrix(X, method='brute', radius=radius)
+    aff_true = compute_affinity_matrix(adj, radius=radius)
+    affinity = Affinity.init('gaussian', radius=radius)
+
+    for mode in ['squared_distance', 'gaussian']:
+        G = compute_adjacency_matrix(X, method='brute', radius=radius,
+                                     mode=mode, affinity_radius=radius)
+        data = G.data
+        aff = affinity.affinity_matrix(G, input_type=mode)
+        assert_allclose(aff.toarray(), aff_true.toarray())
+        assert G.data is data
+        # without copy, the graph is transformed in place
+        aff = affinity.affinity_matrix(G, input_type=mode, copy=False)
+        assert_allclose(aff.toarray(), aff_true.toarray())
+
+    assert_raises(ValueError, affinity.affinity_matrix, adj,
+                  input_type='connectivity')
+
+
 def test_custom_affinity():
     class CustomAffinity(Affinity):
         name = "custom"
@@ -109,3 +148,110 @@ def test_custom_affinity():
     assert_allclose(A, np.exp(-abs(D.toarray())))
 
     Affinity._remove_from_registry("custom")
+
+
+def test_affinity_symmetrize_rules():
+    rand = np.random.RandomState(42)
+    X = rand.rand(30, 3)
+    adj = compute_adjacency_matrix(X, method='brute', n_neighbors=5)
+    aff = compute_affinity_matrix(adj, radius=0.5, symmetrize=False)
+    D = aff.toarray()
+    for rule, true in [('average', 0.5 * (D + D.T)),
+                       ('max', np.maximum(D, D.T)),
+                       ('min', np.minimum(D, D.T))]:
+        A = compute_affinity_matrix(adj, radius=0.5, symmetrize=rule)
+        assert_allclose(A.toarray(), true)
+    assert_allclose(compute_affinity_matrix(adj, radius=0.5).toarray(),
+                    0.5 * (D + D.T))
+    assert_raises(ValueError, Affinity.init, 'gaussian', radius=0.5,
+                  symmetrize='sum')
+
+
+def test_affinity_matrices():
+    rand = np.random.RandomState(42)
+    X = rand.rand(40, 3)
+    radii = [0.2, 0.5, 1.0]
+
+    def check_affinity_matrices(adjacency_kwds, symmetrize, input_type,
+                                dense):
+        adj = compute_adjacency_matrix(X, method='brute', **adjacency_kwds)
+        G = compute_adjacency_matrix(X, method='brute', mode=input_type,
+                                     **adjacency_kwds)
+        if dense:
+            adj, G = adj.toarray(), G.toarray()
+        affinity = Affinity.init('gaussian', radius=radii[0],
+                                 symmetrize=symmetrize)
+        matrices = affinity.affinity_matrices(G, radii,
+                                              input_type=input_type)
+        assert_equal(len(matrices), len(radii))
+        for radius, A in zip(radii, matrices):
+            A_true = compute_affinity_matrix(adj, radius=radius,
+                                             symmetrize=symmetrize)
+            if dense:
+                assert_allclose(A, A_true)
+            else:
+                assert_allclose(A.toarray(), A_true.toarray())
+                # one structure is shared by all matrices
+                assert np.shares_memory(matrices[0].indices, A.indices)
+                assert np.shares_memory(matrices[0].indptr, A.indptr)
+
+    for adjacency_kwds in [{'radius': 0.5}, {'n_neighbors': 5}]:
+        for symmetrize in [True, False, 'max', 'min']:
+            for input_type in ['distance', 'squared_distance']:
+                for dense in [False, True]:
+                    yield (check_affinity_matrices, adjacency_kwds,
+                           symmetrize, input_type, dense)
+
+
+def test_affinity_matrices_input_type():
+    adj = compute_adjacency_matrix(np.random.rand(10, 2), method='brute',
+                                   radius=0.5)
+    affinity = Affinity.init('gaussian', radius=0.5)
+    assert_raises(ValueError, affinity.affinity_matrices, adj, [0.5],
+                  input_type='gaussian')
+
+
+def test_self_tuning_affinity():
+    rand = np.random.RandomState(42)
+    # clusters of different densities
+    X = np.vstack([0.1 * rand.randn(30, 2), 2 + rand.randn(30, 2)])
+    D = squareform(pdist(X))
+    k = 5
+    sigma = np.sort(D, 1)[:, k]
+    A_true = np.exp(-D ** 2 / np.outer(sigma, sigma))
+
+    def check_self_tuning(adjacency_kwds, input_type, dense):
+        G = compute_adjacency_matrix(X, method='brute', mode=input_type,
+                                     **adjacency_kwds)
+        if dense:
+            G = G.toarray()
+        A = Affinity.init('self_tuning', radius=1.0, n_neighbors=k)
+        A = A.affinity_matrix(G, input_type=input_type)
+        if dense:
+            assert_allclose(A, A_true)
+        else:
+            assert_allclose(A.toarray()[A.toarray() > 0],
+                            A_true[A.toarray() > 0])
+            assert_allclose(A.toarray(), A.toarray().T)
+
+    # all the distances, or the k nearest neighbors (plus the reverse
+    # neighbors of the symmetrization, halved)
+    yield check_self_tuning, {'radius': 100}, 'distance', True
+    yield check_self_tuning, {'radius': 100}, 'distance', False
+    yield check_self_tuning, {'radius': 100}, 'squared_distance', False
+
+    G = compute_adjacency_matrix(X, method='brute', n_neighbors=k + 1)
+    A = compute_affinity_matrix(G, method='self_tuning', radius=1.0,
+                                n_neighbors=k)
+    mask = G.toarray() > 0
+    both = mask & mask.T
+    assert_allclose(A.toarray()[both], A_true[both])
+    assert_allclose(A.toarray()[mask & ~mask.T], 0.5 * A_true[mask & ~mask.T])
+
+    # rows with less than n_neighbors neighbors use the radius
+    G = compute_adjacency_matrix(X, method='brute', radius=0.05)
+    affinity = Affinity.init('self_tuning', radius=0.05, n_neighbors=50)
+    assert_allclose(affinity.local_bandwidths(G.multiply(G).tocsr()),
+                    0.05 ** 2)
+    assert_raises(ValueError, affinity.affinity_matrix, G,
+                  input_type='gaussian')
@@ -0,0 +1,79 @@
+# LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
+
+import json
+import os
+import sys
+import tempfile
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal
+from scipy import sparse
+
+from megaman.geometry.benchmark import (benchmark_adjacency, main, row_recall,
+                                        write_benchmark_results)
+
+
+def test_row_recall():
+    G_true = sparse.csr_matrix(np.array([[0, 1, 1, 0],
+                                         [1, 0, 0, 0],
+                                         [1, 0, 0, 0],
+                                         [0, 0, 0, 0]]))
+    G = sparse.csr_matrix(np.array([[0, 1, 0, 1],
+                                    [1, 0, 0, 0],
+                                    [0, 0, 0, 0],
+                                    [0, 0, 1, 0]]))
+    assert_allclose(row_recall(G, G_true), [0.5, 1, 0, 1])
+    assert_allclose(row_recall(G_true, G_true), 1)
+
+
+def test_benchmark_adjacency():
+    results = benchmark_adjacency(methods=['brute', 'kd_tree', 'hnsw', 'lsh'],
+                                  n_samples=[200], n_features=[2, 5],
+                                  radii=[0.3], n_neighbors=[5],
+                                  param_grid={'hnsw': {'ef': [10, 50]}})
+    # 2 data sets x 2 queries x 5 method settings
+    assert_equal(len(results), 20)
+    for result in results:
+        assert_equal(result['n_samples'], 200)
+        if result['method'] == 'lsh' and 'n_neighbors' in result:
+            assert 'error' in result
+            continue
+        assert 'error' not in result
+        for key in ['build_time', 'query_time', 'throughput',
+                    'peak_traced_memory']:
+            assert result[key] >= 0
+        if sys.platform.startswith('linux'):
+            assert result['peak_resident_memory'] >= 0
+        assert 0 <= result['recall_min'] <= result['recall_mean'] <= 1
+        if result['method'] in ['brute', 'kd_tree']:
+            assert_equal(result['recall_min'], 1)
+    assert_equal(sorted(r['params']['ef'] for r in results
+                        if r['method'] == 'hnsw'), [10] * 4 + [50] * 4)
+
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        write_benchmark_results(results, filename)
+        with open(filename) as f:
+            assert_equal(json.load(f), results)
+        main(['--methods', 'ckdtree', '--n-samples', '100', '--radii', '0.5',
+              '--n-neighbors', '--output', filename])
+        with open(filename) as f:
+            results = json.load(f)
+        assert_equal(len(results), 1)
+        assert_equal(results[0]['radius'], 0.5)
+        assert_equal(results[0]['recall_mean'], 1)
+    finally:
+        os.remove(filename)
+
+
+def test_benchmark_target_precision():
+    results = benchmark_adjacency(methods=['cyflann'], n_samples=[1000],
+                                  radii=[0.2], n_neighbors=[],
+                                  param_grid={'cyflann': {
+                                      'target_precision': [0.8, 0.99]}})
+    assert_equal(len(results), 2)
+    for result in results:
+        assert 'error' not in result
+        assert result['nnz'] > 0
+        assert result['recall_mean'] > 0.5
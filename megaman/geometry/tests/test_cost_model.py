@@ -0,0 +1,125 @@
+# LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal, assert_raises
+from scipy import sparse
+
+from megaman.geometry import Geometry, adjacency, compute_adjacency_matrix
+from megaman.geometry.cost_model import (APPROXIMATE_METHODS, METHOD_TERMS,
+                                         SPARSE_METHODS, TERMS,
+                                         calibrate_cost_model,
+                                         estimate_n_neighbors,
+                                         select_adjacency_method)
+
+
+def test_estimate_n_neighbors():
+    rand = np.random.RandomState(36)
+    X = rand.rand(2000, 2)
+    G = compute_adjacency_matrix(X, method='brute', radius=0.1)
+    assert_allclose(estimate_n_neighbors(X, radius=0.1), G.nnz / 2000.,
+                    rtol=0.2)
+    assert_equal(estimate_n_neighbors(X, n_neighbors=7), 7)
+
+
+def test_select_adjacency_method():
+    rand = np.random.RandomState(36)
+
+    def check_selection(X, query, allowed):
+        selection = select_adjacency_method(X, **query)
+        assert selection['method'] in allowed
+        assert_equal(selection['method'],
+                     min(selection['costs'], key=selection['costs'].get))
+        assert set(selection['costs']) <= set(allowed)
+        assert selection['method'] in selection['reason']
+
+    exact = [m for m in METHOD_TERMS if m not in APPROXIMATE_METHODS]
+    dense = [m for m in METHOD_TERMS if m != 'lsh']
+    X_small = rand.rand(500, 3)
+    X_large = rand.rand(12000, 50)
+    X_sparse = sparse.random(12000, 1000, density=0.01, random_state=rand,
+                             format='csr')
+    yield check_selection, X_small, {'radius': 0.1}, exact
+    yield check_selection, X_small, {'n_neighbors': 10}, exact
+    yield check_selection, X_large, {'radius': 1.0}, list(METHOD_TERMS)
+    yield check_selection, X_large, {'n_neighbors': 10}, dense
+    yield check_selection, X_sparse, {'radius': 0.5}, SPARSE_METHODS
+
+    # low dimensional data uses a tree, high dimensional data does not
+    assert_equal(select_adjacency_method(X_small, radius=0.1)['method'],
+                 'ckdtree')
+    assert (select_adjacency_method(X_large, n_neighbors=10)['method']
+            in APPROXIMATE_METHODS)
+
+    # methods which are not compiled are not selected
+    loaded = adjacency.CYFLANN_LOADED
+    adjacency.CYFLANN_LOADED = False
+    try:
+        selection = select_adjacency_method(X_large, n_neighbors=10)
+        assert 'cyflann' not in selection['costs']
+        # out-of-core computations select among the block query methods
+        selection = select_adjacency_method(
+            X_large, radius=1.0, methods=adjacency.index_query_methods())
+        assert set(selection['costs']) <= set(adjacency.index_query_methods())
+        assert selection['method'] != 'cyflann'
+    finally:
+        adjacency.CYFLANN_LOADED = loaded
+    yield (check_selection, X_small, {'radius': 0.1, 'methods': ['kd_tree']},
+           ['kd_tree'])
+
+    assert_raises(ValueError, select_adjacency_method, X_small)
+
+
+def test_geometry_adjacency_selection():
+    rand = np.random.RandomState(36)
+    X = rand.rand(100, 3)
+    geom = Geometry(adjacency_kwds={'radius': 0.5})
+    geom.set_data_matrix(X)
+    assert geom.adjacency_selection is None
+    G = geom.compute_adjacency_matrix()
+    assert_equal(geom.adjacency_selection['method'], 'ckdtree')
+    assert_equal(geom.adjacency_selection['n_samples'], 100)
+    G_true = compute_adjacency_matrix(X, method='brute', radius=0.5)
+    assert_allclose(G.toarray(), G_true.toarray(), atol=1E-7)
+
+
+def test_auto_method_keywords():
+    rand = np.random.RandomState(36)
+    X = rand.rand(2000, 3)
+    G_true = compute_adjacency_matrix(X, method='brute', radius=0.1)
+
+    def check_keywords(kwds):
+        selection = select_adjacency_method(X, radius=0.1, keywords=kwds)
+        for method in selection['costs']:
+            assert set(kwds) <= set(adjacency.method_keywords(method))
+        # ckdtree, the cheapest method, accepts neither keyword
+        assert selection['method'] != 'ckdtree'
+        G = compute_adjacency_matrix(X, 'auto', radius=0.1, **kwds)
+        assert_allclose(G.toarray(), G_true.toarray(), atol=1E-7)
+        geom = Geometry(adjacency_kwds=dict(kwds, radius=0.1))
+        geom.set_data_matrix(X)
+        G = geom.compute_adjacency_matrix()
+        assert geom.adjacency_selection['method'] in selection['costs']
+        assert_allclose(G.toarray(), G_true.toarray(), atol=1E-7)
+
+    yield check_keywords, {'n_processes': 2}
+    yield check_keywords, {'memory_budget': 64}
+    assert_raises(ValueError, select_adjacency_method, X, radius=0.1,
+                  keywords=['n_processes', 'memory_budget'])
+
+
+def test_calibrate_cost_model():
+    coefficients = calibrate_cost_model(methods=['brute', 'ckdtree', 'lsh'],
+                                        n_samples=[200, 400],
+                                        n_features=[2, 8])
+    # lsh is calibrated on the radius graphs only
+    assert_equal(sorted(coefficients), ['brute', 'ckdtree', 'lsh'])
+    for method, coef in coefficients.items():
+        assert_equal(len(coef), len(TERMS))
+        assert min(coef) >= 0
+        for term, c in zip(TERMS, coef):
+            if term not in METHOD_TERMS[method]:
+                assert_equal(c, 0)
+    X = np.random.rand(300, 2)
+    selection = select_adjacency_method(X, n_neighbors=5,
+                                        coefficients=coefficients)
+    assert selection['method'] in ['brute', 'ckdtree']
@@ -4,7 +4,7 @@ from __future__ import division ## removes integer division
 
 import numpy as np
 from nose import SkipTest
-from numpy.testing import assert_array_almost_equal, assert_allclose
+from numpy.testing import assert_array_almost_equal, assert_allclose, assert_equal
 from scipy.spatial.distance import pdist, squareform
 from megaman.utils.testing import assert_raise_message
 from megaman.geometry import (compute_adjacency_matrix, adjacency_methods,
@@ -18,6 +18,9 @@ def test_compute_adjacency_matrix_args(almost_equal_decimals=5):
     input_types = ['data', 'adjacency', 'affinity']
     params = [{'radius':1}, {'radius':2}]
     for adjacency_method in adjacency_methods():
+        if adjacency_method == 'lsh':
+            # approximate: may miss pairs found by the exact methods
+            continue
         if adjacency_method == 'pyflann':
             try:
                 import pyflann as pyf
@@ -61,7 +64,7 @@ def test_compute_affinity_matrix_args(almost_equal_decimals=5):
             for kwarg_params in params:
                 true_params = init_params.copy()
                 true_params.update(kwarg_params)
-                affinity_true = compute_affinity_matrix(D, adjacency_method,
+                affinity_true = compute_affinity_matrix(D, affinity_method,
                                                         **true_params)
                 for input in input_types:
                     G = Geometry(adjacency_method = adjacency_method,
@@ -112,3 +115,172 @@ def test_compute_laplacian_matrix_args(almost_equal_decimals=5):
                     G.set_affinity_matrix(A)
                 laplacian_queried = G.compute_laplacian_matrix(**kwarg_params)
                 assert_array_almost_equal(laplacian_true.todense(), laplacian_queried.todense(), almost_equal_decimals)
+
+
+def test_flann_index_reuse_and_save_load():
+    import os
+    import tempfile
+    rand = np.random.RandomState(42)
+    X = rand.rand(50, 3)
+    G = Geometry(adjacency_method='cyflann', adjacency_kwds={'radius': 0.5})
+    G.set_data_matrix(X)
+    adjacency = G.compute_adjacency_matrix()
+    index = G.flann_index
+    assert index is not None and index.built
+
+    # a radius sweep reuses the stored index
+    G.compute_adjacency_matrix(radius=0.3)
+    assert G.flann_index is index
+
+    tmpdir = tempfile.mkdtemp()
+    index_file = os.path.join(tmpdir, 'index.flann')
+    data_file = os.path.join(tmpdir, 'data.npy')
+    G.save_index(index_file, data_file)
+
+    G2 = Geometry(adjacency_method='cyflann', adjacency_kwds={'radius': 0.5})
+    G2.load_index(index_file, data_file)
+    assert G2.X.shape == X.shape
+    assert_allclose(G2.compute_adjacency_matrix().toarray(),
+                    adjacency.toarray(), rtol=1E-5)
+
+    # a loaded or supplied index is kept when the data is set
+    G2.set_data_matrix(X.copy())
+    assert G2.flann_index is not None
+    G3 = Geometry(adjacency_method='cyflann', adjacency_kwds={'radius': 0.5},
+                  flann_index=index)
+    G3.set_data_matrix(X)
+    assert G3.flann_index is index
+    assert_raise_message(ValueError, "does not match", G3.set_data_matrix,
+                         X[:10])
+
+    # setting the same data keeps the built index, new data discards it
+    G.set_data_matrix(X)
+    assert G.flann_index is index
+    G.set_data_matrix(X.copy())
+    assert G.flann_index is None
+    del G2
+    os.remove(index_file)
+    os.remove(data_file)
+    os.rmdir(tmpdir)
+
+
+def test_append_data_matrix():
+    rand = np.random.RandomState(42)
+    X = rand.rand(60, 3)
+    radius = 0.4
+    kwds = {'radius': radius,
+            'cyflann_kwds': {'index_type': 'kdtrees', 'num_trees': 8,
+                             'num_checks': 1024}}
+    G = Geometry(adjacency_method='cyflann', adjacency_kwds=kwds)
+    G.set_data_matrix(X[:40])
+    G.compute_adjacency_matrix()
+    G.append_data_matrix(X[40:50])
+    adjacency = G.append_data_matrix(X[50:])
+    assert_allclose(G.X, X)
+
+    D_true = squareform(pdist(X))
+    D_true[D_true > radius] = 0
+    # FLANN searches are approximate (and randomized): all the distances
+    # found are exact, and almost all the neighbors are found
+    D = adjacency.toarray()
+    found = D != 0
+    assert_allclose(D[found], D_true[found], rtol=1E-5)
+    assert np.sum(found) >= 0.95 * np.sum(D_true != 0)
+    # the (old, new) block is the transpose of the (new, old) block
+    assert_allclose(D[:40, 40:], D[40:, :40].T)
+
+    # appending requires a neighbor index
+    G = Geometry(adjacency_method='kd_tree', adjacency_kwds={'radius': radius})
+    G.set_data_matrix(X[:40])
+    G.compute_adjacency_matrix()
+    assert_raise_message(ValueError, "No neighbor index exists",
+                         G.append_data_matrix, X[40:])
+
+
+def test_geometry_dtype():
+    rand = np.random.RandomState(42)
+    X = rand.rand(50, 3)
+    kwds = dict(adjacency_method='brute', adjacency_kwds={'radius': 0.5},
+                affinity_kwds={'radius': 0.5}, laplacian_method='geometric',
+                laplacian_kwds={'scaling_epps': 0.5})
+    results = {}
+    for dtype in [np.float64, np.float32]:
+        G = Geometry(dtype=dtype, **kwds)
+        G.set_data_matrix(X)
+        results[dtype] = [G.compute_adjacency_matrix(),
+                          G.compute_affinity_matrix(),
+                          G.compute_laplacian_matrix()]
+        for M in results[dtype]:
+            assert M.dtype == dtype
+    for M64, M32 in zip(results[np.float64], results[np.float32]):
+        assert_allclose(M32.toarray(), M64.toarray(), rtol=1E-4, atol=1E-5)
+
+
+def test_fuse_affinity():
+    from megaman.geometry.utils import is_flagged_symmetric
+    rand = np.random.RandomState(42)
+    X = rand.rand(60, 3)
+    radius = 0.5
+
+    def check_fuse_affinity(method, kwds):
+        if method == 'cyflann':
+            # FLANN kd-trees are randomized: both geometries search the
+            # same index, so that they find the same approximate neighbors
+            from megaman.geometry.cyflann.index import Index
+            index = Index(X, index_type='kdtrees', num_trees=8)
+            index.buildIndex()
+            kwds = dict(kwds, flann_index=index)
+        geom_kwds = dict(adjacency_method=method,
+                         adjacency_kwds=dict(kwds, radius=radius),
+                         affinity_kwds={'radius': radius})
+        G_true = Geometry(**geom_kwds)
+        G_true.set_data_matrix(X)
+        aff_true = G_true.compute_affinity_matrix()
+
+        G = Geometry(fuse_affinity=True, **geom_kwds)
+        G.set_data_matrix(X)
+        aff = G.compute_affinity_matrix()
+        assert G.adjacency_matrix is None
+        assert_equal(aff.dtype, aff_true.dtype)
+        assert_equal(is_flagged_symmetric(aff), is_flagged_symmetric(aff_true))
+        assert_allclose(aff.toarray(), aff_true.toarray(), rtol=1E-5,
+                        atol=1E-7)
+        lap = G.compute_laplacian_matrix()
+        assert_allclose(lap.toarray(),
+                        G_true.compute_laplacian_matrix().toarray(),
+                        rtol=1E-4, atol=1E-6)
+        # the adjacency matrix is computed on request
+        adj = G.compute_adjacency_matrix()
+        assert_allclose(adj.toarray(), G_true.adjacency_matrix.toarray())
+
+    yield check_fuse_affinity, 'brute', {}
+    yield check_fuse_affinity, 'ckdtree', {}
+    yield check_fuse_affinity, 'hnsw', {}
+    yield check_fuse_affinity, 'cyflann', {'cyflann_kwds': {
+        'num_checks': 1024}}
+
+
+def test_inplace_affinity():
+    rand = np.random.RandomState(42)
+    X = rand.rand(60, 3)
+    radius = 0.5
+
+    def check_inplace_affinity(adjacency_kwds, shares_data):
+        geom_kwds = dict(adjacency_method='brute',
+                         adjacency_kwds=adjacency_kwds,
+                         affinity_kwds={'radius': radius})
+        G_true = Geometry(**geom_kwds)
+        G_true.set_data_matrix(X)
+        aff_true = G_true.compute_affinity_matrix()
+
+        G = Geometry(inplace_affinity=True, **geom_kwds)
+        G.set_data_matrix(X)
+        adj = G.compute_adjacency_matrix()
+        aff = G.compute_affinity_matrix()
+        assert G.adjacency_matrix is None
+        assert_allclose(aff.toarray(), aff_true.toarray())
+        # radius graphs are symmetrized in the data of the adjacency matrix
+        assert_equal(np.shares_memory(aff.data, adj.data), shares_data)
+
+    yield check_inplace_affinity, {'radius': radius}, True
+    yield check_inplace_affinity, {'n_neighbors': 5}, False
@@ -95,3 +95,109 @@ def test_laplacian_full_output():
         for adjacency_radius in [0.5, 1.0]:
             for affinity_radius in [0.1, 0.3]:
                 yield check_symmetric, method, adjacency_radius, affinity_radius
+
+
+def test_laplacian_flagged_symmetric():
+    # a symmetric affinity matrix is used without symmetrization, and
+    # must not be modified by the in-place laplacian computation
+    rand = np.random.RandomState(42)
+    X = rand.rand(20, 2)
+    adj = compute_adjacency_matrix(X, method='ckdtree', radius=0.5)
+    aff = compute_affinity_matrix(adj, radius=0.3)
+    aff_copy = aff.copy()
+
+    def check_flagged(method):
+        lap = compute_laplacian_matrix(aff, method=method)
+        lap_true = compute_laplacian_matrix(aff_copy, method=method)
+        assert_allclose(lap.toarray(), lap_true.toarray())
+        assert_allclose(aff.toarray(), aff_copy.toarray())
+
+    for method in Laplacian.methods():
+        yield check_flagged, method
+
+
+def test_laplacian_symmetrize_rules():
+    rand = np.random.RandomState(42)
+    X = rand.rand(30, 3)
+    adj = compute_adjacency_matrix(X, method='brute', n_neighbors=5)
+    aff = compute_affinity_matrix(adj, radius=0.5, symmetrize=False)
+    D = aff.toarray()
+    for rule, true in [('average', 0.5 * (D + D.T)),
+                       ('max', np.maximum(D, D.T)),
+                       ('min', np.minimum(D, D.T))]:
+        lap = compute_laplacian_matrix(aff, method='geometric',
+                                       symmetrize_input=rule)
+        lap_true = compute_laplacian_matrix(csr_matrix(true),
+                                            method='geometric',
+                                            symmetrize_input=False)
+        assert_allclose(lap.toarray(), lap_true.toarray())
+    assert_raises(ValueError, Laplacian.init, 'geometric',
+                  symmetrize_input='sum')
+
+
+def test_laplacian_matrices():
+    from megaman.geometry import Geometry
+    rand = np.random.RandomState(42)
+    X = rand.rand(40, 2)
+    radii = [0.2, 0.5]
+
+    def check_laplacian_matrices(method):
+        geom = Geometry(adjacency_kwds={'n_neighbors': 6},
+                        laplacian_method=method)
+        geom.set_data_matrix(X)
+        laplacians = geom.compute_laplacian_matrices(radii)
+        for radius, lap in zip(radii, laplacians):
+            aff = compute_affinity_matrix(geom.adjacency_matrix,
+                                          radius=radius)
+            lap_true = compute_laplacian_matrix(aff, method=method)
+            assert_allclose(lap.toarray(), lap_true.toarray(), atol=1E-12)
+        assert geom.affinity_matrix is None
+
+    for method in Laplacian.methods():
+        yield check_laplacian_matrices, method
+
+    # without copy, the laplacian is computed in the affinity matrix
+    affinity_matrix = compute_affinity_matrix(
+        compute_adjacency_matrix(X, method='brute', radius=0.3), radius=0.3)
+    data = affinity_matrix.data.copy()
+    Laplacian.init('geometric').laplacian_matrix(affinity_matrix)
+    assert_allclose(affinity_matrix.data, data)
+    Laplacian.init('geometric').laplacian_matrix(affinity_matrix, copy=False)
+    assert np.any(affinity_matrix.data != data)
+
+
+def test_laplacian_operator():
+    rand = np.random.RandomState(42)
+    X = rand.rand(50, 2)
+    adj = compute_adjacency_matrix(X, method='brute', n_neighbors=6)
+    aff = compute_affinity_matrix(adj, radius=0.3, symmetrize=False)
+    x = rand.rand(50, 3)
+
+    def check_operator(method, kwds):
+        laplacian = Laplacian.init(method, full_output=True, **kwds)
+        lap, lapsym, w = laplacian.laplacian_matrix(aff)
+        lap = lap.toarray()
+        operator = laplacian.laplacian_operator(aff)
+        assert_allclose(operator.matmat(x), lap.dot(x), atol=1E-10)
+        assert_allclose(operator.matvec(x[:, 0]), lap.dot(x[:, 0]),
+                        atol=1E-10)
+        assert_allclose(operator.rmatvec(x[:, 0]), lap.T.dot(x[:, 0]),
+                        atol=1E-10)
+        assert_allclose(operator.tocsr().toarray(), lap, atol=1E-10)
+        assert_allclose(operator.weights, w)
+        assert_equal(operator.symmetric, laplacian.symmetric)
+
+        # the symmetric matrix with the spectrum of the laplacian, shifted
+        if laplacian.symmetric:
+            sym = lap
+        else:
+            sym = lapsym.toarray() / np.sqrt(np.outer(w, w))
+        shifted = laplacian.laplacian_operator(aff, symmetrized=True,
+                                               shift=3)
+        assert shifted.symmetric
+        assert_allclose(shifted.tocsr().toarray(), 3 * np.eye(50) - sym,
+                        atol=1E-10)
+
+    for method in Laplacian.methods():
+        for kwds in [{}, {'scaling_epps': 0.5}]:
+            yield check_operator, method, kwds
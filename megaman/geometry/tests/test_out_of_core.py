@@ -0,0 +1,91 @@
+# LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal, assert_raises
+from scipy import sparse
+
+from megaman.geometry import (Geometry, compute_adjacency_matrix,
+                              compute_adjacency_shards, load_adjacency_shards)
+from megaman.geometry.adjacency import index_query_methods
+from megaman.geometry.cyflann.index import Index
+
+
+def test_adjacency_shards():
+    rand = np.random.RandomState(36)
+    X = rand.randn(250, 3).astype(np.float32)
+    tempdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tempdir, 'X.dat')
+        X_mmap = np.memmap(filename, dtype=np.float32, mode='w+',
+                           shape=X.shape)
+        X_mmap[:] = X
+        X_mmap.flush()
+        X_mmap = np.memmap(filename, dtype=np.float32, mode='r',
+                           shape=X.shape)
+        index = Index(X_mmap, index_type='kdtrees', num_trees=8)
+        index.buildIndex()
+
+        def check_shards(kwds):
+            if 'radius' in kwds:
+                G_true = index.radius_neighbors_graph(X, kwds['radius'])
+            else:
+                G_true = index.knn_neighbors_graph(X, kwds['n_neighbors'])
+            directory = os.path.join(tempdir, 'shards')
+            shards = compute_adjacency_shards(X_mmap, directory,
+                                              block_size=100,
+                                              flann_index=index, **kwds)
+            assert_equal([G.shape for G in shards],
+                         [(100, 250), (100, 250), (50, 250)])
+            # shards are read-only memory maps of the files
+            for G in shards:
+                for arr in [G.data, G.indices, G.indptr]:
+                    assert not arr.flags.owndata
+                    assert not arr.flags.writeable
+            assert_allclose(sparse.vstack(shards).toarray(),
+                            G_true.toarray())
+            # loading again gives the same shards
+            reloaded = load_adjacency_shards(directory, mmap_mode=None)
+            assert_allclose(sparse.vstack(reloaded).toarray(),
+                            G_true.toarray())
+            shutil.rmtree(directory)
+
+        for kwds in [{'radius': 1.0}, {'n_neighbors': 5}]:
+            yield check_shards, kwds
+
+        # index data is not copied by Geometry
+        geom = Geometry(adjacency_method='cyflann',
+                        adjacency_kwds={'radius': 1.0,
+                                        'cyflann_kwds': {'index_type':
+                                                         'kdtrees'}})
+        geom.set_data_matrix(X_mmap)
+        shards = geom.compute_adjacency_shards(os.path.join(tempdir, 'geom'),
+                                               block_size=64)
+        assert_equal(len(shards), 4)
+        assert np.may_share_memory(geom.flann_index.dataset, X_mmap)
+        assert geom.adjacency_matrix is None
+
+        # 'auto' selects a method supporting block queries
+        geom = Geometry(adjacency_kwds={'radius': 1.0})
+        geom.set_data_matrix(X_mmap)
+        shards = geom.compute_adjacency_shards(os.path.join(tempdir, 'auto'),
+                                               block_size=64)
+        assert geom.adjacency_selection['method'] in index_query_methods()
+        G_true = compute_adjacency_matrix(X, method='brute', radius=1.0)
+        assert_allclose(sparse.vstack(shards).toarray(), G_true.toarray(),
+                        rtol=1E-5, atol=1E-6)
+        shards = compute_adjacency_shards(X_mmap, os.path.join(tempdir, 'kd'),
+                                          method='kd_tree', radius=1.0,
+                                          block_size=64)
+        assert_allclose(sparse.vstack(shards).toarray(), G_true.toarray(),
+                        rtol=1E-5, atol=1E-6)
+
+        assert_raises(ValueError, compute_adjacency_shards, X_mmap,
+                      os.path.join(tempdir, 'lsh'), method='lsh',
+                      radius=1.0)
+        del index, geom, X_mmap
+    finally:
+        shutil.rmtree(tempdir)
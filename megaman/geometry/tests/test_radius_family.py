@@ -0,0 +1,31 @@
+# LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal, assert_raises
+
+from megaman.geometry import RadiusFamily, compute_adjacency_matrix
+
+
+def test_radius_family():
+    rand = np.random.RandomState(36)
+    X = rand.rand(80, 3)
+    rmax = 0.5
+    family = RadiusFamily.from_data(X, rmax, method='kd_tree')
+
+    def check_radius(radius):
+        G_true = compute_adjacency_matrix(X, method='kd_tree', radius=radius)
+        G = family.adjacency_matrix(radius)
+        assert_equal(G.nnz, G_true.nnz)
+        assert_allclose(G.toarray(), G_true.toarray())
+        assert_equal(family.n_neighbors(radius), np.diff(G_true.indptr))
+        # each row is sorted by distance
+        for i in range(0, X.shape[0], 10):
+            assert np.all(np.diff(G.data[G.indptr[i]:G.indptr[i + 1]]) >= 0)
+
+    for radius in [0.1, 0.25, 0.3, rmax]:
+        yield check_radius, radius
+
+    # the full radius shares the family arrays
+    G = family.adjacency_matrix(rmax)
+    assert np.may_share_memory(G.data, family.data)
+    assert_raises(ValueError, family.adjacency_matrix, 2 * rmax)
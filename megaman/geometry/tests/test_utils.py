@@ -0,0 +1,134 @@
+# LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal, assert_raises
+from scipy import sparse
+
+from megaman.geometry.utils import (flag_symmetric, is_flagged_symmetric,
+                                    symmetrize, SYMMETRIZE_RULES)
+
+
+def _dense_symmetrize(A, mask, rule):
+    # reference: combine the stored entries (mask) of A and A.T
+    mask_t = mask.T
+    if rule == 'average':
+        S = 0.5 * (A + A.T)
+        stored = mask | mask_t
+    elif rule == 'max':
+        S = np.where(mask & mask_t, np.maximum(A, A.T), A + A.T)
+        stored = mask | mask_t
+    else:
+        S = np.minimum(A, A.T)
+        stored = mask & mask_t
+    return np.where(stored, S, 0), stored
+
+
+def test_symmetrize():
+    rand = np.random.RandomState(42)
+
+    def check_symmetrize(rule, dtype, index_dtype):
+        A = sparse.random(50, 50, density=0.1, random_state=rand,
+                          format='csr', dtype=dtype)
+        # explicit zeros, on and off the diagonal
+        A.data[::5] = 0
+        A.indices = A.indices.astype(index_dtype)
+        A.indptr = A.indptr.astype(index_dtype)
+        mask = np.zeros(A.shape, dtype=bool)
+        mask[np.repeat(np.arange(50), np.diff(A.indptr)), A.indices] = True
+        S_true, stored = _dense_symmetrize(A.toarray(), mask, rule)
+
+        S = symmetrize(A, rule)
+        assert sparse.isspmatrix_csr(S)
+        assert is_flagged_symmetric(S)
+        assert S.has_sorted_indices
+        assert_equal(S.dtype, dtype)
+        assert_allclose(S.toarray(), S_true)
+        # the explicit zeros are stored
+        assert_equal(S.nnz, stored.sum())
+        # the result is returned as is by a second symmetrization
+        assert symmetrize(S, rule) is S
+
+    for rule in SYMMETRIZE_RULES:
+        for dtype in [np.float32, np.float64]:
+            for index_dtype in [np.int32, np.int64]:
+                yield check_symmetrize, rule, dtype, index_dtype
+
+
+def test_symmetrize_symmetric_input():
+    rand = np.random.RandomState(42)
+    X = rand.rand(20, 20)
+    D = X + X.T
+    assert symmetrize(D) is D
+    for S in [sparse.csr_matrix(D), flag_symmetric(sparse.csr_matrix(X))]:
+        assert symmetrize(S, 'min') is S
+    assert_allclose(symmetrize(X), 0.5 * (X + X.T))
+    assert_allclose(symmetrize(X, 'max'), np.maximum(X, X.T))
+
+    # non-canonical and non-float inputs
+    A = sparse.coo_matrix(([1, 2, 3], ([0, 0, 1], [1, 1, 0])), shape=(2, 2))
+    assert_allclose(symmetrize(A).toarray(), [[0, 3], [3, 0]])
+
+    assert_raises(ValueError, symmetrize, X, 'sum')
+    assert_raises(ValueError, symmetrize, X[:5])
+
+
+def test_elementwise_kernels():
+    from megaman.geometry.utils import (divide_gather, get_n_threads,
+                                        scaled_exp, set_n_threads)
+    rand = np.random.RandomState(42)
+
+    def check_kernels(dtype, n_threads):
+        set_n_threads(n_threads)
+        try:
+            data = rand.rand(1000).astype(dtype)
+            # contiguous arrays (kernels) and strided views (NumPy)
+            for x in [data.copy(), data.copy()[::2],
+                      data.reshape(20, 50).T.copy(order='F')]:
+                x_true = np.exp(-x.astype(np.float64) ** 2 / 0.5)
+                assert scaled_exp(x, -0.5, square=True) is x
+                assert_allclose(x, x_true, rtol=1E-6)
+            index = rand.randint(0, 10, 1000)
+            values = 1 + rand.rand(10)
+            for index_dtype in [np.int32, np.int64]:
+                x = data.copy()
+                divide_gather(x, values, index.astype(index_dtype))
+                assert_allclose(x, data / values[index], rtol=1E-6)
+        finally:
+            set_n_threads(1)
+
+    for dtype in [np.float32, np.float64]:
+        for n_threads in [1, 4, -1]:
+            yield check_kernels, dtype, n_threads
+
+    assert_raises(ValueError, set_n_threads, 0)
+    set_n_threads(-1)
+    assert get_n_threads() >= 1
+    set_n_threads(1)
+
+
+def test_reserve_diagonal():
+    from megaman.geometry.utils import reserve_diagonal
+    rand = np.random.RandomState(42)
+    A = sparse.random(30, 30, density=0.2, random_state=rand, format='csr')
+    A.setdiag(0)
+    A.eliminate_zeros()
+    A.data[::3] = 0
+    A_diag = reserve_diagonal(A)
+    assert_equal(A_diag.nnz, A.nnz + 30)
+    assert A_diag.has_sorted_indices
+    assert_allclose(A_diag.toarray(), A.toarray())
+    # the diagonal is set without changing the structure
+    assert reserve_diagonal(A_diag) is A_diag
+    indices = A_diag.indices
+    A_diag.setdiag(1)
+    assert A_diag.indices is indices
+    assert_allclose(A_diag.toarray(), A.toarray() + np.eye(30))
+
+    # symmetric structures are symmetrized in place
+    S = reserve_diagonal(A + A.T)
+    S.data = rand.rand(S.nnz)
+    S_true = 0.5 * (S.toarray() + S.toarray().T)
+    data = S.data
+    S = symmetrize(S, copy=False)
+    assert S.data is data
+    assert_allclose(S.toarray(), S_true)
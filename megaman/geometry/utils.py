@@ -1,6 +1,17 @@
 # LICENSE: Simplified BSD https://github.com/mmp2/megaman/blob/master/LICENSE
 
-__all__ = ["RegisterSubclasses"]
+import multiprocessing
+
+import numpy as np
+from scipy import sparse
+
+from .sparse_ops import elementwise
+from .sparse_ops.csr import symmetrize_csr, symmetrize_csr_sources
+
+__all__ = ["RegisterSubclasses", "flag_symmetric", "is_flagged_symmetric",
+           "narrow_dtype", "symmetrize", "symmetrize_sources",
+           "SYMMETRIZE_RULES", "reserve_diagonal", "set_n_threads", "get_n_threads",
+           "scaled_exp", "divide_gather"]
 
 
 # From six.py
@@ -49,3 +60,262 @@ class RegisterSubclasses(with_metaclass(RegistryMeta)):
     @classmethod
     def methods(cls):
         return cls._method_registry.keys()
+
+
+# Attribute set on sparse matrices which are known to be exactly symmetric.
+# Operations which return a new matrix do not carry it over.
+_SYMMETRIC_FLAG = '_megaman_symmetric'
+
+
+def flag_symmetric(A):
+    """Flag the sparse matrix A as exactly symmetric and return it
+
+    Affinity and Laplacian computations skip their symmetrization step on
+    flagged inputs.
+    """
+    setattr(A, _SYMMETRIC_FLAG, True)
+    return A
+
+
+def is_flagged_symmetric(A):
+    """Return True if A was flagged with flag_symmetric"""
+    return getattr(A, _SYMMETRIC_FLAG, False)
+
+
+def narrow_dtype(A, dtype):
+    """Return A with at most the precision of dtype
+
+    Arrays and sparse matrices with a wider float dtype are cast to dtype
+    (keeping the symmetric flag); others are returned unchanged, without
+    copy.
+    """
+    dtype = np.dtype(dtype)
+    if A.dtype.kind != 'f' or A.dtype.itemsize <= dtype.itemsize:
+        return A
+    symmetric = is_flagged_symmetric(A)
+    A = A.astype(dtype)
+    if symmetric and sparse.issparse(A):
+        flag_symmetric(A)
+    return A
+
+
+SYMMETRIZE_RULES = ['average', 'max', 'min']
+
+
+def _canonical_csr(A):
+    """Return A as a CSR matrix with sorted indices and no duplicates"""
+    A = A.tocsr()
+    if not A.has_canonical_format:
+        A = A.copy()
+        A.sum_duplicates()
+    return A
+
+
+def symmetrize(A, rule='average', copy=True):
+    """Return a symmetric version of the square matrix A
+
+    The rules combine the entries A[i, j] and A[j, i]:
+
+    - 'average': 0.5 * (A + A.T); an entry stored on one side only is
+      halved, as if the other side were zero.
+    - 'max': the larger of the two entries; an entry stored on one side only
+      is kept (the union of the graphs of nonnegative matrices).
+    - 'min': the smaller of the two entries; an entry stored on one side only
+      is dropped (the intersection of the graphs, e.g. mutual kNN).
+
+    For sparse matrices, the sorted rows of A and A.T are merged in one
+    compiled pass (see sparse_ops.csr), and explicit zeros (e.g. the zero
+    distances of an adjacency matrix) are kept. The result is a CSR matrix
+    flagged as symmetric. A matrix flagged as symmetric, or with the same
+    entries as its transpose, is returned as is, without copy.
+
+    A CSR matrix with a symmetric structure (e.g. a radius graph) keeps its
+    structure: with copy=False, its data is symmetrized in place, and only
+    the transpose is allocated.
+    """
+    if rule not in SYMMETRIZE_RULES:
+        raise ValueError("rule={0} not valid. Must be one of "
+                         "{1}".format(rule, SYMMETRIZE_RULES))
+    if A.shape[0] != A.shape[1]:
+        raise ValueError("only square matrices can be symmetrized")
+    if is_flagged_symmetric(A):
+        return A
+
+    if not sparse.issparse(A):
+        A = np.asarray(A)
+        if np.array_equal(A, A.T):
+            return A
+        if rule == 'average':
+            return 0.5 * (A + A.T)
+        elif rule == 'max':
+            return np.maximum(A, A.T)
+        else:
+            return np.minimum(A, A.T)
+
+    A = _canonical_csr(A)
+    # the conversion from CSC sorts the indices of A.T
+    AT = A.T.tocsr()
+    if (np.array_equal(A.indptr, AT.indptr) and
+            np.array_equal(A.indices, AT.indices)):
+        if np.array_equal(A.data, AT.data):
+            return flag_symmetric(A)
+        if copy:
+            A = A.copy()
+        if rule == 'average':
+            A.data += AT.data
+            A.data *= 0.5
+        elif rule == 'max':
+            np.maximum(A.data, AT.data, out=A.data)
+        else:
+            np.minimum(A.data, AT.data, out=A.data)
+        return flag_symmetric(A)
+
+    if A.dtype not in (np.float32, np.float64):
+        A = A.astype(np.float64)
+        AT = AT.astype(np.float64)
+    index_dtype = np.result_type(A.indices, A.indptr, AT.indices, AT.indptr)
+    data, indices, indptr = symmetrize_csr(
+        A.indptr.astype(index_dtype, copy=False),
+        A.indices.astype(index_dtype, copy=False), A.data,
+        AT.indptr.astype(index_dtype, copy=False),
+        AT.indices.astype(index_dtype, copy=False), AT.data, rule)
+    return flag_symmetric(sparse.csr_matrix((data, indices, indptr),
+                                            shape=A.shape))
+
+
+def reserve_diagonal(A):
+    """Return the square matrix A in CSR format storing its whole diagonal
+
+    The missing diagonal entries are inserted as explicit zeros, in one
+    vectorized pass, so that setting the diagonal afterwards (e.g.
+    ``A.setdiag(1)``) does not change the structure of the matrix. A
+    matrix which stores its diagonal is returned without copy.
+    """
+    symmetric = is_flagged_symmetric(A)
+    A = _canonical_csr(A)
+    n = A.shape[0]
+    rows = np.repeat(np.arange(n, dtype=A.indices.dtype), np.diff(A.indptr))
+    stored = np.zeros(n, dtype=bool)
+    stored[rows[rows == A.indices]] = True
+    if stored.all():
+        return A
+    missing = np.flatnonzero(~stored)
+    # each diagonal entry goes after the entries of lower columns of its row
+    n_lower = np.bincount(rows[A.indices < rows], minlength=n)
+    positions = A.indptr[missing] + n_lower[missing]
+    indices = np.insert(A.indices, positions,
+                        missing.astype(A.indices.dtype))
+    data = np.insert(A.data, positions, 0)
+    indptr = A.indptr.copy()
+    indptr[1:] += np.cumsum(~stored).astype(indptr.dtype)
+    A = sparse.csr_matrix((data, indices, indptr), shape=A.shape)
+    if symmetric:
+        flag_symmetric(A)
+    return A
+
+
+def symmetrize_sources(A, rule='average'):
+    """Return the structure of symmetrize(A, rule) and its sources in A
+
+    The data of symmetrize(B, rule), for any sparse B with the structure of
+    A (in canonical CSR format), is computed from B.data alone: each entry
+    combines B.data[source] and B.data[source_t], the stored entries
+    B[i, j] and B[j, i] (a position of -1 marks an entry which is not
+    stored). This computes the symmetrization of several matrices of the
+    same structure with a single merge.
+
+    Returns
+    -------
+    indices, indptr : ndarrays
+        The CSR structure of the symmetrized matrix.
+    source, source_t : ndarrays
+        The positions in the data of A of the entries A[i, j] and A[j, i]
+        of each entry (i, j) of the symmetrized matrix.
+    """
+    if rule not in SYMMETRIZE_RULES:
+        raise ValueError("rule={0} not valid. Must be one of "
+                         "{1}".format(rule, SYMMETRIZE_RULES))
+    if A.shape[0] != A.shape[1]:
+        raise ValueError("only square matrices can be symmetrized")
+    A = _canonical_csr(A)
+    index_dtype = np.result_type(A.indices, A.indptr)
+    indptr = A.indptr.astype(index_dtype, copy=False)
+    indices = A.indices.astype(index_dtype, copy=False)
+    # the transpose of the positions of the entries of A
+    positions = sparse.csr_matrix((np.arange(A.nnz, dtype=index_dtype),
+                                   indices, indptr), shape=A.shape)
+    PT = positions.T.tocsr()
+    return symmetrize_csr_sources(
+        indptr, indices, PT.indptr.astype(index_dtype, copy=False),
+        PT.indices.astype(index_dtype, copy=False),
+        PT.data.astype(index_dtype, copy=False), rule)
+
+
+# number of threads of the elementwise kernels (see set_n_threads)
+_n_threads = 1
+
+
+def set_n_threads(n_threads):
+    """Set the number of threads of the elementwise kernels
+
+    The threads are shared by the elementwise passes over the data of the
+    affinity and Laplacian matrices of the geometry module (scaled_exp,
+    divide_gather). Negative values count from the number of cores: -1
+    means one thread per core. The default is 1.
+    """
+    global _n_threads
+    if n_threads == 0:
+        raise ValueError("n_threads must be nonzero")
+    _n_threads = int(n_threads)
+
+
+def get_n_threads():
+    """Return the number of threads of the elementwise kernels"""
+    if _n_threads < 0:
+        return max(1, multiprocessing.cpu_count() + 1 + _n_threads)
+    return _n_threads
+
+
+def _kernel_array(data):
+    # the flat view of arrays the compiled kernels can update in place
+    if (data.dtype in (np.float32, np.float64) and
+            (data.flags.c_contiguous or data.flags.f_contiguous) and
+            data.flags.writeable):
+        return np.ravel(data, order='K')
+    return None
+
+
+def scaled_exp(data, divisor, square=False):
+    """In place data = exp(data / divisor), or exp(data ** 2 / divisor)
+
+    Contiguous float arrays are updated by a compiled kernel on
+    get_n_threads() threads, other arrays by NumPy. On a single thread,
+    the vectorized exp of NumPy is faster than the kernel. Returns data.
+    """
+    flat = _kernel_array(data)
+    if flat is not None and get_n_threads() > 1:
+        elementwise.scaled_exp(flat, divisor, square, get_n_threads())
+    else:
+        if square:
+            data **= 2
+        data /= divisor
+        np.exp(data, out=data)
+    return data
+
+
+def divide_gather(data, values, index):
+    """In place data /= values[index], for 1D arrays data and index
+
+    Contiguous float arrays are updated by a compiled kernel on
+    get_n_threads() threads, other arrays by NumPy. Returns data.
+    """
+    flat = _kernel_array(data)
+    if flat is not None and index.dtype in (np.int32, np.int64):
+        elementwise.divide_gather(flat,
+                                  np.ascontiguousarray(values,
+                                                       dtype=np.float64),
+                                  np.ascontiguousarray(index),
+                                  get_n_threads())
+    else:
+        data /= values[index]
+    return data
@@ -13,6 +13,8 @@ def configuration(parent_package='', top_path=None):
     config.add_subpackage('embedding/tests')
     config.add_subpackage('geometry')
     config.add_subpackage('geometry/cyflann')
+    config.add_subpackage('geometry/hnsw')
+    config.add_subpackage('geometry/sparse_ops')
     config.add_subpackage('geometry/tests')
     config.add_subpackage('utils')
     config.add_subpackage('utils/tests')
@@ -14,15 +14,20 @@ import numpy as np
 from numpy import polyfit
 
 from megaman.geometry.adjacency import compute_adjacency_matrix
+from megaman.geometry.radius_family import RadiusFamily
+from megaman.geometry.utils import is_flagged_symmetric
 
 def compute_largest_radius_distance(X, rad, adjacency_method, adjacency_kwds):
     print('computing distance matrix...')
     adjacency_kwds['radius'] = rad
     t0 = time.time()
     dists = compute_adjacency_matrix(X,adjacency_method,**adjacency_kwds)
-    print("Symmetrizing distance matrix...")
-    dists = (dists + dists.T) # symmetrize, removes zero on diagonal
-    dists.data = 0.5 * dists.data 
+    if is_flagged_symmetric(dists):
+        dists.eliminate_zeros() # removes zero on diagonal
+    else:
+        print("Symmetrizing distance matrix...")
+        dists = (dists + dists.T) # symmetrize, removes zero on diagonal
+        dists.data = 0.5 * dists.data 
     print("largest distance found: " + str(np.max(dists.data)))
     return(dists)
 
@@ -30,7 +35,10 @@ def neighborhood_analysis(dists, radii):
     n_samples = dists.shape[0]; nradii = len(radii)
     avg_neighbors = np.zeros(nradii); num_no_nbrs = np.zeros(nradii); 
     max_neighbors = np.zeros(nradii); min_neighbors = np.zeros(nradii)
+    # neighbors sorted by distance: each radius is a prefix of every row
     dists = dists.tocsr()
+    dists.eliminate_zeros()
+    family = RadiusFamily(dists, rmax=np.max(radii))
     for ii in range(nradii):
         print("=========================================")
         print("Step " + str(ii +1) + " of " + str(nradii))
@@ -38,13 +46,10 @@ def neighborhood_analysis(dists, radii):
         print(ii)
         rad = radii[ii]
         print("radius: " + str(radii[ii]))
-        print("censoring distance matrix...")
-        dists.data[dists.data > rad] = 0.0
-        dists.eliminate_zeros()   
-        print(dists.nnz)
-        avg_neighbors[ii] = dists.nnz/n_samples
         print('finding neighbors per point...')
-        nbrs_per_row = np.diff(dists.indptr)
+        nbrs_per_row = family.n_neighbors(rad)
+        print(np.sum(nbrs_per_row))
+        avg_neighbors[ii] = np.sum(nbrs_per_row)/n_samples
         min_neighbors[ii] = np.min(nbrs_per_row)
         max_neighbors[ii] = np.max(nbrs_per_row)
         num_no_nbrs[ii] = len(np.where(nbrs_per_row == 0)[0])
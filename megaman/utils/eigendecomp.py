@@ -4,7 +4,7 @@ import warnings
 import numpy as np
 from scipy import sparse
 from scipy.linalg import eigh, eig
-from scipy.sparse.linalg import lobpcg, eigs, eigsh
+from scipy.sparse.linalg import LinearOperator, lobpcg, eigs, eigsh
 from sklearn.utils.validation import check_random_state
 
 from .validation import check_array
@@ -80,16 +80,24 @@ def _is_symmetric(M, tol = 1e-8):
     return(np.all(conditions))
 
 
+def _symmetry_tolerance(dtype):
+    return max(1e-8, 100 * np.finfo(dtype).eps)
+
+
 def eigen_decomposition(G, n_components=8, eigen_solver='auto',
                         random_state=None,
-                        drop_first=True, largest=True, solver_kwds=None):
+                        drop_first=True, largest=True, solver_kwds=None,
+                        dtype=np.float64):
     """
     Function to compute the eigendecomposition of a square matrix.
 
     Parameters
     ----------
-    G : array_like or sparse matrix
+    G : array_like, sparse matrix or LinearOperator
         The square matrix for which to compute the eigen-decomposition.
+        A LinearOperator (e.g. megaman.geometry.laplacian.LaplacianOperator)
+        is used as is, and is symmetric if its ``symmetric`` attribute is
+        True. It cannot be used with the 'amg' solver.
     n_components : integer, optional
         The number of eigenvectors to return
     eigen_solver : {'auto', 'dense', 'arpack', 'lobpcg', or 'amg'}
@@ -117,6 +125,9 @@ def eigen_decomposition(G, n_components=8, eigen_solver='auto',
         lobpcg eigen vectors decomposition when eigen_solver == 'amg'.
         By default, arpack is used.
     solver_kwds : any additional keyword arguments to pass to the selected eigen_solver
+    dtype : numpy float dtype (default: np.float64)
+        precision of the eigendecomposition. G is cast to dtype, without
+        copy if it already has that dtype.
 
     Returns
     -------
@@ -131,19 +142,26 @@ def eigen_decomposition(G, n_components=8, eigen_solver='auto',
                                                    nvec=n_components)
     random_state = check_random_state(random_state)
 
-    # Convert G to best type for eigendecomposition
-    if sparse.issparse(G):
-        if G.getformat() is not 'csr':
-            G.tocsr()
-    G = G.astype(np.float)
+    if isinstance(G, LinearOperator):
+        if eigen_solver == 'amg':
+            raise ValueError("the 'amg' eigen_solver requires a matrix, "
+                             "not a LinearOperator")
+        is_symmetric = getattr(G, 'symmetric', False)
+        if eigen_solver == 'dense':
+            G = G.matmat(np.eye(n_nodes, dtype=G.dtype))
+    else:
+        # Convert G to best type for eigendecomposition
+        if sparse.issparse(G):
+            G = G.tocsr()
+        G = G.astype(dtype, copy=False)
 
-    # Check for symmetry
-    is_symmetric = _is_symmetric(G)
+        # Check for symmetry, up to the rounding errors of dtype
+        is_symmetric = _is_symmetric(G, tol=_symmetry_tolerance(G.dtype))
 
     # Try Eigen Methods:
     if eigen_solver == 'arpack':
         # This matches the internal initial state used by ARPACK
-        v0 = random_state.uniform(-1, 1, G.shape[0])
+        v0 = random_state.uniform(-1, 1, G.shape[0]).astype(G.dtype)
         if is_symmetric:
             if largest:
                 which = 'LM'
@@ -223,7 +241,7 @@ def eigen_decomposition(G, n_components=8, eigen_solver='auto',
 
 
 def null_space(M, k, k_skip=1, eigen_solver='arpack',
-               random_state=None, solver_kwds=None):
+               random_state=None, solver_kwds=None, dtype=np.float64):
     """
     Find the null space of a matrix M: eigenvectors associated with 0 eigenvalues
 
@@ -257,6 +275,9 @@ def null_space(M, k, k_skip=1, eigen_solver='arpack',
         The generator or seed used to determine the starting vector for arpack
         iterations.  Defaults to numpy.random.
     solver_kwds : any additional keyword arguments to pass to the selected eigen_solver
+    dtype : numpy float dtype (default: np.float64)
+        precision of the eigendecomposition. M is cast to dtype, without copy
+        if it already has that dtype.
 
     Returns
     -------
@@ -284,10 +305,12 @@ def null_space(M, k, k_skip=1, eigen_solver='arpack',
                                                    size=M.shape[0],
                                                    nvec=k + k_skip)
     random_state = check_random_state(random_state)
+    if hasattr(M, 'astype'):
+        M = M.astype(dtype, copy=False)
 
     if eigen_solver == 'arpack':
         # This matches the internal initial state used by ARPACK
-        v0 = random_state.uniform(-1, 1, M.shape[0])
+        v0 = random_state.uniform(-1, 1, M.shape[0]).astype(dtype)
         try:
             eigen_values, eigen_vectors = eigsh(M, k + k_skip, sigma=0.0,
                                                 v0=v0,**(solver_kwds or {}))
@@ -317,14 +340,15 @@ def null_space(M, k, k_skip=1, eigen_solver='arpack',
     elif (eigen_solver == 'amg' or eigen_solver == 'lobpcg'):
         # M should be positive semi-definite. Add 1 to make it pos. def.
         try:
-            M = sparse.identity(M.shape[0]) + M
+            M = sparse.identity(M.shape[0], dtype=dtype) + M
             n_components = min(k + k_skip + 10, M.shape[0])
             eigen_values, eigen_vectors = eigen_decomposition(M, n_components,
                                                               eigen_solver = eigen_solver,
                                                               drop_first = False,
                                                               largest = False,
                                                               random_state=random_state,
-                                                              solver_kwds=solver_kwds)
+                                                              solver_kwds=solver_kwds,
+                                                              dtype=dtype)
             eigen_values = eigen_values -1
             index = np.argsort(np.abs(eigen_values))
             eigen_values = eigen_values[index]
@@ -332,14 +356,15 @@ def null_space(M, k, k_skip=1, eigen_solver='arpack',
             return eigen_vectors[:, k_skip:k+1], np.sum(eigen_values[k_skip:k+1])
         except np.linalg.LinAlgError: # try again with bigger increase
             warnings.warn("LOBPCG failed the first time. Increasing Pos Def adjustment.")
-            M = 2.0*sparse.identity(M.shape[0]) + M
+            M = 2.0*sparse.identity(M.shape[0], dtype=dtype) + M
             n_components = min(k + k_skip + 10, M.shape[0])
             eigen_values, eigen_vectors = eigen_decomposition(M, n_components,
                                                               eigen_solver = eigen_solver,
                                                               drop_first = False,
                                                               largest = False,
                                                               random_state=random_state,
-                                                              solver_kwds=solver_kwds)
+                                                              solver_kwds=solver_kwds,
+                                                              dtype=dtype)
             eigen_values = eigen_values - 2
             index = np.argsort(np.abs(eigen_values))
             eigen_values = eigen_values[index]
@@ -3,6 +3,7 @@ import sys, time
 from megaman.geometry.rmetric import riemann_metric_lazy
 from megaman.geometry.affinity import compute_affinity_matrix
 from megaman.geometry.laplacian import compute_laplacian_matrix
+from megaman.geometry.radius_family import RadiusFamily
 import multiprocessing as mp
 
 # GLOBALS
@@ -70,10 +71,8 @@ def evaluate_radius(radius, d, sample):
     global X
     
     t0 = time.time()
-    D = DIST.copy()
+    D = DIST.adjacency_matrix(radius)
     (n, dim) = X.shape
-    D.data[D.data > radius] = 0.0
-    D.eliminate_zeros()    
     h = np.sqrt(2)*radius / 3.0
     affinity_kwds = {'radius':h}
     A = compute_affinity_matrix(D, 'gaussian', **affinity_kwds)
@@ -142,13 +141,13 @@ def run_estimate_radius(data, dists, sample, d, rmin, rmax, ntry, run_parallel):
     global DIST
     global X
 
-    # process distance matrix 
+    # process distance matrix: sort the neighbors of each row by distance,
+    # so that the graph at each radius is a prefix of every row
     dists = dists.tocsr()
-    dists.data[dists.data > rmax] = 0.0
-    dists.eliminate_zeros()    
+    dists.eliminate_zeros()
 
     # Assign global variables
-    DIST = dists
+    DIST = RadiusFamily(dists, rmax)
     X = data
 
     n, dim = X.shape
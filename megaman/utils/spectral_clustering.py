@@ -49,11 +49,14 @@ class SpectralClustering(BaseEmbedding):
                  this can improve label quality
     stabalize : (bool) whether or not to compute the (more stable) eigenvectors of L = D^-1/2*S*D^-1/2
                 instead of P = D^-1*S 
+    dtype : numpy float dtype (optional)
+        precision of the geometry computations, overriding the dtype of
+        `geom` (see megaman.geometry.Geometry).
     """    
     def __init__(self,K,eigen_solver='auto', 
                  random_state=None, solver_kwds = None,
                  geom = None, radius = None, renormalize = True, stabalize = True,
-                 additional_vectors=0):
+                 additional_vectors=0, dtype=None):
         self.eigen_solver = eigen_solver
         self.random_state = random_state             
         self.K = K
@@ -63,6 +66,7 @@ class SpectralClustering(BaseEmbedding):
         self.renormalize = renormalize
         self.stabalize = stabalize
         self.additional_vectors = 0
+        self.dtype = dtype
      
     def fit(self, X, y=None, input_type='affinity'):
         """
@@ -158,7 +162,7 @@ def spectral_clustering(geom, K, eigen_solver = 'dense', random_state = None, so
     # Step 2: get the Laplacian matrix
     P = geom.compute_laplacian_matrix(return_lapsym = return_lapsym)
     # by default the Laplacian is subtracted from the Identify matrix (this step may not be needed)
-    P += identity(P.shape[0])        
+    P += identity(P.shape[0], dtype=P.dtype)        
     
     # Step 3: Compute the top K eigenvectors and drop the first 
     if eigen_solver in ['auto', 'amg', 'lobpcg']:
@@ -169,7 +173,7 @@ def spectral_clustering(geom, K, eigen_solver = 'dense', random_state = None, so
     n_components = min(n_components, P.shape[0])
     (lambdas, eigen_vectors) = eigen_decomposition(P, n_components=n_components, eigen_solver=eigen_solver, 
                                                    random_state=random_state, drop_first = True,
-                                                   solver_kwds=solver_kwds)
+                                                   solver_kwds=solver_kwds, dtype=geom.dtype)
     # the first vector is usually uninformative 
     if eigen_solver in ['auto', 'lobpcg', 'amg']:
         if np.abs(lambdas[0] - 1) > 1e-4:
@@ -107,3 +107,32 @@ def test_null_eigen_solver_kwds():
     X = rng.uniform(size=(100, 40))
     S = np.dot(X.T, X)
     _test_all_null_solvers(solvers_to_test, S, solver_kwds_dict=SOLVER_KWDS_DICT)
+
+def test_float32_eigen_decomposition():
+    rng = np.random.RandomState(0)
+    X = rng.uniform(size=(100, 40))
+    S = np.dot(X.T, X)
+    for eigen_solver in ['dense', 'arpack']:
+        lambdas64, diffusion_map64 = eigen_decomposition(
+            S, 5, eigen_solver, random_state=0, largest=True)
+        lambdas32, diffusion_map32 = eigen_decomposition(
+            S.astype(np.float32), 5, eigen_solver, random_state=0,
+            largest=True, dtype=np.float32)
+        assert diffusion_map32.dtype == np.float32
+        assert_array_almost_equal(np.sort(lambdas32) / lambdas64.max(),
+                                  np.sort(lambdas64) / lambdas64.max(), 4)
+
+def test_linear_operator_eigen_decomposition():
+    from scipy.sparse.linalg import aslinearoperator
+    rng = np.random.RandomState(0)
+    X = rng.uniform(size=(100, 40))
+    S = np.dot(X.T, X)
+    operator = aslinearoperator(S)
+    operator.symmetric = True
+    for eigen_solver in ['dense', 'arpack', 'lobpcg']:
+        lambdas, diffusion_map = eigen_decomposition(
+            S, 3, eigen_solver, random_state=0, largest=True)
+        lambdas_op, diffusion_map_op = eigen_decomposition(
+            operator, 3, eigen_solver, random_state=0, largest=True)
+        assert_array_almost_equal(np.sort(lambdas_op) / lambdas.max(),
+                                  np.sort(lambdas) / lambdas.max(), 4)